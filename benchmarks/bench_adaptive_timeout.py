@@ -0,0 +1,115 @@
+"""
+Benchmark: adaptive vs fixed timeouts on simulated downstream latencies
+
+Replays a seeded stream of call latencies through o11y_common.adaptivetimeout
+(no network, calls are not actually made) and through the old fixed
+timeouts. The stream has log-normal jitter around the downstream's median,
+a fraction of hung calls that never answer, and optionally a phase in which
+the downstream becomes slower (--slowdown).
+
+Reports per policy:
+
+- false timeouts: calls that would have answered but were cut
+- time spent waiting on hung calls, per hung call
+- the timeout at the end of every phase
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_adaptive_timeout.py [--calls 20000] [--json out.json]
+"""
+import argparse
+import json
+import random
+
+from o11y_common.adaptivetimeout import AdaptiveTimeouts
+
+# Downstreams of Service A and the gateway: median latency, jitter sigma, old fixed timeout, floor
+DOWNSTREAMS = {
+    "service_d": (0.3, 0.35, 10.0, 1.0),
+    "service_b": (0.01, 0.5, 10.0, 0.5),
+    "third_party_api": (0.15, 0.6, 5.0, 0.5),
+    "service_a": (0.45, 0.3, 30.0, 2.0),
+}
+
+
+class _Timeout(Exception):
+    pass
+
+
+def latencies(rng, median, sigma, calls, hung_rate, slowdown):
+    """(phase, latency or None for a hung call)"""
+    phases = [("normal", 1.0)] + ([("slow", slowdown)] if slowdown > 1 else [])
+    for phase, factor in phases:
+        for _ in range(calls // len(phases)):
+            if rng.random() < hung_rate:
+                yield phase, None
+            else:
+                yield phase, median * factor * rng.lognormvariate(0, sigma)
+
+
+def replay(stream, timeout_for, observe):
+    result = {"calls": 0, "false_timeouts": 0, "hung": 0, "hung_wait": 0.0, "timeouts": {}}
+    for phase, latency in stream:
+        timeout = timeout_for()
+        result["calls"] += 1
+        if latency is None:
+            result["hung"] += 1
+            result["hung_wait"] += timeout
+            observe(None, timeout)
+        elif latency > timeout:
+            result["false_timeouts"] += 1
+            observe(None, timeout)
+        else:
+            observe(latency, timeout)
+        result["timeouts"][phase] = round(timeout, 3)
+    result["hung_wait_per_call"] = round(result["hung_wait"] / max(1, result["hung"]), 3)
+    result["false_timeout_pct"] = round(result["false_timeouts"] / result["calls"] * 100, 3)
+    del result["hung_wait"]
+    return result
+
+
+def run(name, args):
+    median, sigma, fixed, floor = DOWNSTREAMS[name]
+    stream = list(latencies(random.Random(args.seed), median, sigma, args.calls, args.hung_rate, args.slowdown))
+
+    fixed_result = replay(stream, lambda: fixed, lambda latency, timeout: None)
+
+    registry = AdaptiveTimeouts(timeout_errors=(_Timeout,), multiplier=args.multiplier)
+    downstream = registry.downstream(name, floor=floor, ceiling=fixed)
+
+    def observe(latency, timeout):
+        # As track(): only answered calls are observed
+        if latency is not None:
+            downstream.observe(latency)
+
+    adaptive_result = replay(stream, downstream.current, observe)
+    return {"fixed": fixed_result, "adaptive": adaptive_result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000, help="calls per downstream")
+    parser.add_argument("--hung-rate", type=float, default=0.002, help="fraction of calls that never answer")
+    parser.add_argument("--slowdown", type=float, default=3.0, help="latency factor of the second phase, 1 = none")
+    parser.add_argument("--multiplier", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    args = parser.parse_args()
+
+    results = {name: run(name, args) for name in DOWNSTREAMS}
+
+    print(f"{'downstream':16s} {'policy':9s} {'false timeouts':>15s} {'wait per hung call':>19s}  timeout per phase")
+    for name, by_policy in results.items():
+        for policy, r in by_policy.items():
+            phases = ", ".join(f"{phase} {timeout:.2f}s" for phase, timeout in r["timeouts"].items())
+            print(
+                f"{name:16s} {policy:9s} {r['false_timeouts']:>7d} ({r['false_timeout_pct']:.2f}%)"
+                f" {r['hung_wait_per_call']:>18.2f}s  {phases}"
+            )
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
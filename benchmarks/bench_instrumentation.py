@@ -0,0 +1,286 @@
+"""
+Benchmark: per-request cost of Service A's instrumentation modes
+
+Runs Service A's FastAPI app in-process (httpx ASGITransport, no server socket)
+in a fresh interpreter per mode, against local stand-ins started in separate
+processes so their CPU is not charged to the service:
+
+harness.py: fake Postgres, Service B, Service D, third-party API and an OTLP
+receiver, whose span / data point / log record counts are reported per mode.
+
+Modes:
+
+- none:            services/service-a/main.py with OTEL_SDK_DISABLED=true
+- programmatic:    services/service-a/main.py (TelemetryBootstrap)
+- auto:            main_hybrid.py under opentelemetry-instrument, with the
+                   business spans disabled (module tracer swapped for a no-op)
+- hybrid:          main_hybrid.py under opentelemetry-instrument
+- hybrid_sampled:  hybrid with parentbased_traceidratio (--sample-ratio)
+
+For each mode a closed-loop client drives GET /process for --duration seconds
+after a warm-up, and the script reports requests/sec, p50 / p99 latency, CPU
+time per request (process_time of the whole service process, exporter threads
+included; the in-process client's own cost is the same in every mode) and RSS.
+Results are medians over --runs. Compare with an earlier --json file through
+--baseline.
+
+Service A creates a new httpx.AsyncClient for its downstream calls, and each
+one loads the CA bundle into a fresh SSL context (tens of ms of CPU). As long
+as that is the case it dominates CPU per request and hides most of the
+instrumentation cost; use --runs to get the differences above the noise.
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_instrumentation.py [--duration 10] [--runs 3] [--json out.json] [--baseline old.json]
+"""
+import argparse
+import asyncio
+import gc
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_DIR = os.path.join(REPO_ROOT, "services", "service-a")
+COMMON_DIR = os.path.join(REPO_ROOT, "services", "common")
+
+# mode -> (script, run under opentelemetry-instrument)
+MODES = {
+    "none": ("main.py", False),
+    "programmatic": ("main.py", False),
+    "auto": ("main_hybrid.py", True),
+    "hybrid": ("main_hybrid.py", True),
+    "hybrid_sampled": ("main_hybrid.py", True),
+}
+
+METRICS = ("requests_per_sec", "p50_ms", "p99_ms", "cpu_ms_per_request", "rss_mib")
+
+
+def _env(mode, harness_env, sample_ratio):
+    env = dict(os.environ)
+    env.update(harness_env)
+    env.update({
+        "PYTHONPATH": COMMON_DIR,
+        # opentelemetry-instrument settings of service-a-hybrid in docker-compose.yaml
+        "OTEL_SERVICE_NAME": "service-a-hybrid",
+        "OTEL_TRACES_EXPORTER": "otlp",
+        "OTEL_METRICS_EXPORTER": "otlp",
+        "OTEL_LOGS_EXPORTER": "otlp",
+    })
+    if mode == "none":
+        env["OTEL_SDK_DISABLED"] = "true"
+    if mode == "hybrid_sampled":
+        env["OTEL_TRACES_SAMPLER"] = "parentbased_traceidratio"
+        env["OTEL_TRACES_SAMPLER_ARG"] = str(sample_ratio)
+    return env
+
+
+def _opentelemetry_instrument():
+    local = os.path.join(os.path.dirname(sys.executable), "opentelemetry-instrument")
+    return local if os.path.exists(local) else shutil.which("opentelemetry-instrument")
+
+
+def run_mode(mode, harness, args):
+    """Run one mode in a fresh interpreter and return its measurements"""
+    script, auto_instrumented = MODES[mode]
+    with tempfile.NamedTemporaryFile(suffix=".json") as out:
+        command = [
+            sys.executable, os.path.abspath(__file__), "--child", mode, "--child-out", out.name,
+            "--duration", str(args.duration), "--warmup", str(args.warmup),
+            "--concurrency", str(args.concurrency),
+        ]
+        if auto_instrumented:
+            command = [_opentelemetry_instrument()] + command
+        proc = subprocess.run(command, env=_env(mode, harness.env, args.sample_ratio), capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"{mode} failed:\n{proc.stderr[-3000:]}")
+        with open(out.name) as f:
+            return json.load(f)
+
+
+# ---------------------------------------------------------------- child process
+
+def _load_service(script):
+    sys.path.insert(0, SERVICE_DIR)
+    spec = importlib.util.spec_from_file_location("main", os.path.join(SERVICE_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+async def _closed_loop(client, concurrency, duration):
+    latencies = []
+    errors = 0
+    stop_at = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            resp = await client.get("/process")
+            if resp.status_code != 200:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+async def _drive(app, concurrency, warmup, duration):
+    import httpx
+    # httpx.AsyncClient may already be the instrumented subclass; the load
+    # generator must not create client spans of its own
+    from httpx._client import AsyncClient
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://service-a", timeout=30) as client:
+            warmup_latencies, _ = await _closed_loop(client, concurrency, warmup)
+            gc.collect()
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            latencies, errors = await _closed_loop(client, concurrency, duration)
+            cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "requests": count,
+        "total_requests": count + len(warmup_latencies),
+        "errors": errors,
+        "requests_per_sec": round(count / wall, 1),
+        "p50_ms": round(latencies[int(0.50 * (count - 1))] * 1000, 2),
+        "p99_ms": round(latencies[int(0.99 * (count - 1))] * 1000, 2),
+        "cpu_ms_per_request": round(cpu / count * 1000, 3),
+    }
+
+
+def _rss_mib():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(args):
+    script, _ = MODES[args.child]
+    service = _load_service(script)
+    if args.child == "auto":
+        from opentelemetry import trace
+        service.tracer = trace.NoOpTracer()
+
+    result = asyncio.run(_drive(service.app, args.concurrency, args.warmup, args.duration))
+    result["rss_mib"] = round(_rss_mib(), 1)
+    result["max_rss_mib"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    with open(args.child_out, "w") as f:
+        json.dump(result, f)
+
+
+# ---------------------------------------------------------------- parent process
+
+def _median_run(runs):
+    merged = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    merged["runs"] = len(runs)
+    return merged
+
+
+def bench(args):
+    from harness import Harness
+
+    harness = Harness(
+        service_b_delay=args.downstream_delay, service_d_delay=args.downstream_delay,
+        third_party_delay=args.downstream_delay, db_delay=args.db_delay,
+    )
+    modes = {}
+    with harness:
+        for mode in args.modes:
+            runs = []
+            for _ in range(args.runs):
+                harness.receiver.reset()
+                run = run_mode(mode, harness, args)
+                # The child flushed its exporters on exit, so everything it sent has arrived
+                otlp = harness.receiver.stats()
+                for signal, key in (("traces", "spans"), ("metrics", "metric_points"), ("logs", "log_records")):
+                    run[f"{key}_per_request"] = round(otlp[signal]["items"] / run["total_requests"], 2)
+                runs.append(run)
+            modes[mode] = _median_run(runs)
+
+    if "none" in modes:
+        base = modes["none"]
+        for r in modes.values():
+            r["cpu_overhead_pct"] = round((r["cpu_ms_per_request"] / base["cpu_ms_per_request"] - 1) * 100, 1)
+
+    from opentelemetry.sdk.version import __version__ as sdk_version
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "opentelemetry_sdk": sdk_version,
+            "cpus": os.cpu_count(),
+            "duration_s": args.duration,
+            "concurrency": args.concurrency,
+            "sample_ratio": args.sample_ratio,
+        },
+        "modes": modes,
+    }
+
+
+def _print_baseline_diff(results, baseline):
+    print(f"\nchange vs baseline ({baseline['meta'].get('opentelemetry_sdk')}):")
+    for mode, r in results["modes"].items():
+        old = baseline["modes"].get(mode)
+        if not old:
+            continue
+        changes = "  ".join(
+            f"{key}={(r[key] / old[key] - 1) * 100:+.1f}%" for key in METRICS if old.get(key)
+        )
+        print(f"  {mode:16s} {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds before each run")
+    parser.add_argument("--runs", type=int, default=3, help="runs per mode, the median is reported")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent in-flight requests")
+    parser.add_argument("--sample-ratio", type=float, default=0.1, help="trace ratio of hybrid_sampled")
+    parser.add_argument("--db-delay", type=float, default=0.0, help="fake Postgres seconds per statement")
+    parser.add_argument("--downstream-delay", type=float, default=0.0, help="fake HTTP seconds per request")
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    parser.add_argument("--baseline", help="earlier --json output to compare against")
+    parser.add_argument("--child", choices=list(MODES), help=argparse.SUPPRESS)
+    parser.add_argument("--child-out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    results = bench(args)
+    meta = results["meta"]
+    print(f"cpus={meta['cpus']} concurrency={meta['concurrency']} sdk={meta['opentelemetry_sdk']}")
+    for mode, r in results["modes"].items():
+        overhead = f"  cpu {r['cpu_overhead_pct']:+6.1f}%" if "cpu_overhead_pct" in r else ""
+        print(f"{mode:16s} {r['requests_per_sec']:>7.1f} req/s  p50 {r['p50_ms']:>7.2f} ms  p99 {r['p99_ms']:>7.2f} ms  "
+              f"cpu {r['cpu_ms_per_request']:>6.2f} ms/req  rss {r['rss_mib']:>6.1f} MiB  "
+              f"spans/req {r['spans_per_request']:>5.2f}{overhead}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            _print_baseline_diff(results, json.load(f))
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark: JsonFormatter vs the legacy %-style JSON format string
+
+Both variants log the same messages inside an active span. The legacy variant
+uses LoggingInstrumentor (record factory injecting otelTraceID/otelSpanID) and
+the old format string, exactly like the services did before.
+
+Reports records/sec and how many lines are valid JSON.
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_jsonlog.py [--records 50000] [--json out.json]
+"""
+import argparse
+import io
+import json
+import logging
+import sys
+import time
+
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+
+from o11y_common.jsonlog import JsonFormatter
+
+LEGACY_FORMAT = (
+    '{"time":"%(asctime)s", "level":"%(levelname)s", "service":"service-a", '
+    '"trace_id":"%(otelTraceID)s", "span_id":"%(otelSpanID)s", "message":"%(message)s"}'
+)
+
+# Representative messages from the services, including the payload dumps that break the old format
+MESSAGES = [
+    ("Starting process request in Service A", ()),
+    ("Database query completed in %.3fs, log_id=%d, recent_requests=%d", (0.0042, 1234, 87)),
+    ("Service D response: %s", ({"status": "success", "results": {"statistics": {"mean": 51.3}}, "note": 'say "hi"'},)),
+    ("Third-party API response: %s...", ("Design for failure.\nKeep it logically awesome.",)),
+    ("Failed to call Service B: %s", ('Client error \'404 Not Found\' for url "http://service-b:8002/enqueue"',)),
+]
+
+
+def _make_logger(name, formatter, stream):
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(formatter)
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def _run(logger, records, tracer):
+    with tracer.start_as_current_span("bench"):
+        start = time.perf_counter()
+        for i in range(records):
+            msg, args = MESSAGES[i % len(MESSAGES)]
+            logger.info(msg, *args)
+        return time.perf_counter() - start
+
+
+def _valid_lines(output):
+    valid = total = 0
+    for line in output.splitlines():
+        total += 1
+        try:
+            json.loads(line)
+            valid += 1
+        except ValueError:
+            pass
+    return valid, total
+
+
+def bench(records):
+    trace.set_tracer_provider(TracerProvider())
+    tracer = trace.get_tracer(__name__)
+    results = {}
+
+    # Legacy: LoggingInstrumentor record factory + format string. The services no
+    # longer depend on opentelemetry-instrumentation-logging, so it may be missing.
+    try:
+        from opentelemetry.instrumentation.logging import LoggingInstrumentor
+    except ImportError:
+        print("opentelemetry-instrumentation-logging is not installed, skipping legacy_format_string "
+              "(pip install -r services/service-a/requirements_hybrid.txt)", file=sys.stderr)
+    else:
+        LoggingInstrumentor().instrument(set_logging_format=False)
+        try:
+            stream = io.StringIO()
+            logger = _make_logger("bench.legacy", logging.Formatter(LEGACY_FORMAT), stream)
+            elapsed = _run(logger, records, tracer)
+            valid, total = _valid_lines(stream.getvalue())
+            results["legacy_format_string"] = {
+                "records_per_sec": round(records / elapsed),
+                "us_per_record": round(elapsed / records * 1e6, 2),
+                "valid_json_lines": valid,
+                "total_lines": total,
+            }
+        finally:
+            LoggingInstrumentor().uninstrument()
+
+    stream = io.StringIO()
+    logger = _make_logger("bench.json", JsonFormatter("service-a"), stream)
+    elapsed = _run(logger, records, tracer)
+    valid, total = _valid_lines(stream.getvalue())
+    results["json_formatter"] = {
+        "records_per_sec": round(records / elapsed),
+        "us_per_record": round(elapsed / records * 1e6, 2),
+        "valid_json_lines": valid,
+        "total_lines": total,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    args = parser.parse_args()
+
+    results = bench(args.records)
+    for name, r in results.items():
+        print(f"{name:22s} {r['records_per_sec']:>9,d} rec/s  {r['us_per_record']:>7.2f} us/rec  "
+              f"valid JSON {r['valid_json_lines']}/{r['total_lines']}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
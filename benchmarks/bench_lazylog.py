@@ -0,0 +1,158 @@
+"""
+Benchmark: eager f-string logging vs lazy rendering + hot-path filters
+
+Replays the log calls Service A makes for one /process request (including the
+downstream payload dumps) N times, once the old way (f-strings, every record
+emitted) and once with %-style Truncated/Lazy arguments plus
+install_hot_path_filters(). Spans are created with a TraceIdRatioBased sampler
+so the effect of "full logs only for sampled traces" is visible.
+
+Reports CPU microseconds and log bytes per request.
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_lazylog.py [--requests 20000] [--sample-ratio 0.1] [--json out.json]
+"""
+import argparse
+import json
+import logging
+import time
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+from o11y_common.jsonlog import JsonFormatter
+from o11y_common.lazylog import Truncated, install_hot_path_filters
+
+SERVICE_D_DATA = {
+    "status": "success",
+    "service": "service-d",
+    "trace_id": "4bf92f3577b34da6a3ce929d0e0e4736",
+    "input_value": 84,
+    "results": {
+        "fibonacci": {"input": 20, "result": 6765},
+        "prime_factors": {"input": 84, "factors": [2, 2, 3, 7]},
+        "statistics": {"mean": 47.3, "max": 98, "min": 3, "sum": 473},
+    },
+    "duration_seconds": 0.312,
+}
+SERVICE_B_DATA = {
+    "status": "success",
+    "service": "service-b",
+    "message": "Message enqueued to Kafka",
+    "trace_id": "4bf92f3577b34da6a3ce929d0e0e4736",
+}
+THIRD_PARTY_DATA = "Practicality beats purity. " * 4
+
+
+class CountingStream:
+    """Discard output, only count bytes"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data.encode("utf-8"))
+
+    def flush(self):
+        pass
+
+
+def eager_request(logger):
+    logger.info("Starting process request in Service A")
+    logger.info("Querying database")
+    logger.info(f"Database query completed in {0.0042:.3f}s, log_id={1234}, recent_requests={87}")
+    logger.info(f"Calling third-party API: {'https://api.github.com/zen'}")
+    logger.info(f"Third-party API response: {THIRD_PARTY_DATA[:50]}...")
+    logger.info("Calling Service D and Service B")
+    logger.info(f"Service D response: {SERVICE_D_DATA}")
+    logger.info(f"Service B response: {SERVICE_B_DATA}")
+    logger.info(f"Process request completed in {0.412:.3f}s")
+
+
+def lazy_request(logger):
+    logger.info("Starting process request in Service A")
+    logger.info("Querying database")
+    logger.info("Database query completed in %.3fs, log_id=%s, recent_requests=%s", 0.0042, 1234, 87)
+    logger.info("Calling third-party API: %s", "https://api.github.com/zen")
+    logger.info("Third-party API response: %s", Truncated(THIRD_PARTY_DATA, 50))
+    logger.info("Calling Service D and Service B")
+    logger.info("Service D response: %s", Truncated(SERVICE_D_DATA))
+    logger.info("Service B response: %s", Truncated(SERVICE_B_DATA))
+    logger.info("Process request completed in %.3fs", 0.412)
+
+
+def _make_logger(name, stream):
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter("service-a"))
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.filters = []
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def _run(tracer, logger, request_fn, requests):
+    start = time.process_time()
+    for _ in range(requests):
+        with tracer.start_as_current_span("service_a.process"):
+            request_fn(logger)
+    return time.process_time() - start
+
+
+def bench(requests, sample_ratio, rate):
+    provider = TracerProvider(sampler=ParentBased(TraceIdRatioBased(sample_ratio)))
+    tracer = provider.get_tracer(__name__)
+    results = {"sample_ratio": sample_ratio, "callsite_rate": rate}
+
+    # Baseline: spans only, no logging, subtracted from both variants
+    null_logger = logging.getLogger("bench.null")
+    null_logger.disabled = True
+    span_cpu = _run(tracer, null_logger, lambda _: None, requests)
+
+    stream = CountingStream()
+    eager_cpu = _run(tracer, _make_logger("bench.eager", stream), eager_request, requests) - span_cpu
+    results["eager"] = {
+        "cpu_us_per_request": round(eager_cpu / requests * 1e6, 2),
+        "bytes_per_request": round(stream.bytes / requests, 1),
+    }
+
+    stream = CountingStream()
+    logger = _make_logger("bench.lazy", stream)
+    # The replay runs far faster than real traffic, so the rate limit defaults to
+    # unlimited and only the sampling filter is measured unless --rate is given
+    install_hot_path_filters(logger, rate=rate, burst=rate)
+    lazy_cpu = _run(tracer, logger, lazy_request, requests) - span_cpu
+    results["lazy_filtered"] = {
+        "cpu_us_per_request": round(lazy_cpu / requests * 1e6, 2),
+        "bytes_per_request": round(stream.bytes / requests, 1),
+    }
+
+    results["saved"] = {
+        "cpu_us_per_request": round((eager_cpu - lazy_cpu) / requests * 1e6, 2),
+        "bytes_per_request": round(results["eager"]["bytes_per_request"] - results["lazy_filtered"]["bytes_per_request"], 1),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--sample-ratio", type=float, default=0.1, help="trace sampling ratio")
+    parser.add_argument("--rate", type=float, default=1e9,
+                        help="per-callsite records/sec (default: unlimited, measures sampling only)")
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    args = parser.parse_args()
+
+    results = bench(args.requests, args.sample_ratio, args.rate)
+    for name in ("eager", "lazy_filtered", "saved"):
+        r = results[name]
+        print(f"{name:14s} {r['cpu_us_per_request']:>8.2f} us CPU/req  {r['bytes_per_request']:>8.1f} bytes/req")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Benchmark: overhead and attribution accuracy of the span profiler
+
+Runs a Service D-like request handler (a /compute span with fibonacci and
+prime_factors CPU work and a sleep in child spans) on worker threads, as
+Flask does, or as asyncio tasks, as the FastAPI services do, with
+o11y_common.profiler.SpanProfiler off and at the given sampling rates.
+
+Reports per workload and rate:
+
+- requests/sec and process CPU ms per request (overhead = difference to hz=0)
+- CPU used by the sampler thread itself
+- attribution: share of the profiled CPU charged to fibonacci / prime_factors
+  vs the share measured with time.thread_time() around the calls
+
+Rounds of all rates are interleaved and the median round is reported, with
+the spread (min-max) of CPU ms per request over the rounds. An overhead
+smaller than the noise (half the spreads of the rate and of hz=0 together)
+is marked "within noise". Rates whose achieved tick rate stays below
+LOW_TICK_RATIO of the requested one are flagged: the sampler needs the GIL,
+so under contention it takes fewer samples (and costs less) than asked.
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_profiler.py [--hz 0,100,1000] [--duration 5] [--json out.json]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+from collections import Counter
+
+from opentelemetry.sdk.trace import TracerProvider
+
+from o11y_common.profiler import SpanProfiler
+
+FIB_N = 26
+PRIME = 10_000_000_019  # prime_factors() of a prime loops to its square root
+SLEEP = 0.02
+LOW_TICK_RATIO = 0.8
+
+
+def fibonacci(n):
+    if n <= 1:
+        return n
+    return fibonacci(n - 1) + fibonacci(n - 2)
+
+
+def prime_factors(n):
+    factors = []
+    d = 2
+    while d * d <= n:
+        while (n % d) == 0:
+            factors.append(d)
+            n //= d
+        d += 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+
+class Truth:
+    """CPU measured around the work functions, per worker"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cpu = Counter()
+
+    def timed(self, name, fn, *args):
+        start = time.thread_time()
+        result = fn(*args)
+        with self.lock:
+            self.cpu[name] += time.thread_time() - start
+        return result
+
+
+def handle_sync(tracer, truth):
+    with tracer.start_as_current_span("/compute"):
+        with tracer.start_as_current_span("service_d.fibonacci"):
+            truth.timed("fibonacci", fibonacci, FIB_N)
+        with tracer.start_as_current_span("service_d.prime_factors"):
+            truth.timed("prime_factors", prime_factors, PRIME)
+        with tracer.start_as_current_span("service_d.simulate_processing"):
+            time.sleep(SLEEP)
+
+
+async def handle_async(tracer, truth):
+    with tracer.start_as_current_span("GET /compute"):
+        with tracer.start_as_current_span("service_d.fibonacci"):
+            truth.timed("fibonacci", fibonacci, FIB_N)
+        await asyncio.sleep(0)
+        with tracer.start_as_current_span("service_d.prime_factors"):
+            truth.timed("prime_factors", prime_factors, PRIME)
+        with tracer.start_as_current_span("service_d.simulate_processing"):
+            await asyncio.sleep(SLEEP)
+
+
+def run_threads(tracer, truth, workers, duration):
+    done = [0] * workers
+    deadline = time.monotonic() + duration
+
+    def worker(i):
+        while time.monotonic() < deadline:
+            handle_sync(tracer, truth)
+            done[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(done)
+
+
+def run_asyncio(tracer, truth, workers, duration):
+    done = [0]
+
+    async def worker(deadline):
+        while time.monotonic() < deadline:
+            await handle_async(tracer, truth)
+            done[0] += 1
+
+    async def main():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(worker(deadline) for _ in range(workers)))
+
+    asyncio.run(main())
+    return done[0]
+
+
+WORKLOADS = {"threads": run_threads, "asyncio": run_asyncio}
+
+
+def _share(profile, name):
+    total = sum(profile.values())
+    if not total:
+        return 0.0
+    return sum(us for stack, us in profile.items() if f";{name} (" in stack) / total
+
+
+def run_once(workload, hz, workers, duration):
+    profiler = SpanProfiler("bench", hz=hz, mode="cpu")
+    provider = TracerProvider()
+    for processor in profiler.span_processors():
+        provider.add_span_processor(processor)
+    tracer = provider.get_tracer("bench")
+    truth = Truth()
+
+    profiler.start()
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    requests = WORKLOADS[workload](tracer, truth, workers, duration)
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    profiler.stop()
+    provider.shutdown()
+
+    result = {
+        "requests": requests,
+        "rps": round(requests / wall, 1),
+        "cpu_ms_per_request": round(cpu * 1000 / requests, 3),
+    }
+    if profiler.enabled:
+        summary = profiler.summary()
+        profile = profiler.profile()
+        measured = sum(truth.cpu.values())
+        result.update({
+            "ticks_per_sec": round(summary["ticks"] / wall, 1),
+            "sampler_cpu_pct": round(summary["sampler_cpu_seconds"] / wall * 100, 2),
+            "profiled_cpu_s": round(summary["sampled_us"] / 1e6, 3),
+            "untagged_cpu_s": round(summary["untagged_us"] / 1e6, 3),
+            "attribution": {
+                name: {
+                    "profiled_pct": round(_share(profile, name) * 100, 1),
+                    "measured_pct": round(truth.cpu[name] / cpu * 100, 1),
+                }
+                for name in ("fibonacci", "prime_factors")
+            },
+            "work_cpu_pct": round(measured / cpu * 100, 1),
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hz", default="0,100,1000", help="comma separated sampling rates, 0 = profiler off")
+    parser.add_argument("--workloads", default="threads,asyncio")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per round")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    args = parser.parse_args()
+
+    rates = [float(hz) for hz in args.hz.split(",")]
+    results = {}
+    for workload in args.workloads.split(","):
+        rounds = {hz: [] for hz in rates}
+        for _ in range(args.rounds):
+            for hz in rates:
+                rounds[hz].append(run_once(workload, hz, args.workers, args.duration))
+        results[workload] = {}
+        for hz in rates:
+            cpu = sorted(r["cpu_ms_per_request"] for r in rounds[hz])
+            # Median round (the lower middle one for an even number of rounds)
+            result = dict(next(r for r in rounds[hz] if r["cpu_ms_per_request"] == cpu[(len(cpu) - 1) // 2]))
+            result["cpu_ms_per_request_min"] = cpu[0]
+            result["cpu_ms_per_request_max"] = cpu[-1]
+            if hz:
+                result["low_tick_rate"] = result["ticks_per_sec"] < LOW_TICK_RATIO * hz
+            results[workload][f"{hz:g}"] = result
+        base = results[workload].get("0")
+        for hz, r in results[workload].items():
+            if base is None or hz == "0":
+                continue
+            spreads = (r["cpu_ms_per_request_max"] - r["cpu_ms_per_request_min"]
+                       + base["cpu_ms_per_request_max"] - base["cpu_ms_per_request_min"])
+            r["overhead_pct"] = round((r["cpu_ms_per_request"] / base["cpu_ms_per_request"] - 1) * 100, 1)
+            r["noise_pct"] = round(spreads / 2 / base["cpu_ms_per_request"] * 100, 1)
+
+    for workload, by_hz in results.items():
+        print(f"{workload} ({args.rounds} rounds of {args.duration:g}s):")
+        for hz, r in by_hz.items():
+            line = (f"  hz {hz:>5s}  {r['rps']:>7.1f} req/s  {r['cpu_ms_per_request']:>7.3f} CPU ms/req"
+                    f" [{r['cpu_ms_per_request_min']:.3f}-{r['cpu_ms_per_request_max']:.3f}]")
+            if "overhead_pct" in r:
+                line += f" ({r['overhead_pct']:+.1f}% +-{r['noise_pct']:.1f}%"
+                line += ", within noise)" if abs(r["overhead_pct"]) <= r["noise_pct"] else ")"
+            if "attribution" in r:
+                shares = "  ".join(
+                    f"{name} {a['profiled_pct']:.1f}% (measured {a['measured_pct']:.1f}%)"
+                    for name, a in r["attribution"].items()
+                )
+                line += f"  sampler {r['sampler_cpu_pct']:.2f}% CPU, {r['ticks_per_sec']:.0f} ticks/s"
+                if r["low_tick_rate"]:
+                    line += f" (LOW: {r['ticks_per_sec'] / float(hz):.0%} of hz)"
+                line += f"  {shares}"
+            print(line)
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Benchmark: OTLP bytes saved by the span budget on real /process traces
+
+Runs Service A's app in-process (httpx ASGITransport) in a fresh interpreter
+per variant, against the harness.py stand-ins, with a fraction of failing
+downstream calls so that error attributes and exception events occur. The
+spans of --requests GET /process calls are captured as the SDK hands them to
+the exporter, then:
+
+1. encoded with the OTLP exporter's encoder in batches of 512 (what
+   BatchSpanProcessor sends), before
+2. passed through o11y_common.spanbudget.SpanBudgetProcessor.on_end (timed)
+3. encoded again, after
+
+Reports per variant: spans and OTLP bytes per request before and after, the
+processor's own estimate of the bytes it saved (span_budget_saved_bytes_total)
+against the measured difference, its cost per span and the changes per action.
+
+Variants:
+
+- main:    services/service-a/main.py (TelemetryBootstrap)
+- hybrid:  main_hybrid.py under opentelemetry-instrument, with its business spans
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_span_budget.py [--requests 200] [--rules "trace_id=drop,..."] [--json out.json]
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_DIR = os.path.join(REPO_ROOT, "services", "service-a")
+COMMON_DIR = os.path.join(REPO_ROOT, "services", "common")
+
+# variant -> (script, run under opentelemetry-instrument)
+VARIANTS = {
+    "main": ("main.py", False),
+    "hybrid": ("main_hybrid.py", True),
+}
+
+EXPORT_BATCH = 512
+
+
+def _opentelemetry_instrument():
+    local = os.path.join(os.path.dirname(sys.executable), "opentelemetry-instrument")
+    return local if os.path.exists(local) else shutil.which("opentelemetry-instrument")
+
+
+def run_variant(variant, harness, args):
+    script, auto_instrumented = VARIANTS[variant]
+    env = dict(os.environ)
+    env.update(harness.env)
+    env.update({
+        "PYTHONPATH": COMMON_DIR,
+        "OTEL_SERVICE_NAME": "service-a-hybrid",
+        "OTEL_TRACES_EXPORTER": "otlp",
+        "OTEL_METRICS_EXPORTER": "otlp",
+        "OTEL_LOGS_EXPORTER": "otlp",
+        "SPAN_BUDGET": "false",
+    })
+    with tempfile.NamedTemporaryFile(suffix=".json") as out:
+        command = [
+            sys.executable, os.path.abspath(__file__), "--child", variant, "--child-out", out.name,
+            "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+        ]
+        if args.rules is not None:
+            command += ["--rules", args.rules]
+        if auto_instrumented:
+            command = [_opentelemetry_instrument()] + command
+        proc = subprocess.run(command, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"{variant} failed:\n{proc.stderr[-3000:]}")
+        with open(out.name) as f:
+            return json.load(f)
+
+
+# ---------------------------------------------------------------- child process
+
+class _Capture:
+    """Span processor keeping the ended spans"""
+
+    def __init__(self):
+        self.spans = []
+
+    def on_start(self, span, parent_context=None):
+        pass
+
+    def on_end(self, span):
+        self.spans.append(span)
+
+    def shutdown(self):
+        pass
+
+    def force_flush(self, timeout_millis=30000):
+        return True
+
+
+class _Tally:
+    """Stands in for a counter of the processor, summing per action"""
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, amount, attributes):
+        action = attributes["action"]
+        self.totals[action] = self.totals.get(action, 0) + amount
+
+
+def _load_service(script):
+    sys.path.insert(0, SERVICE_DIR)
+    spec = importlib.util.spec_from_file_location("main", os.path.join(SERVICE_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+async def _drive(app, requests, concurrency):
+    import httpx
+    from httpx._client import AsyncClient
+
+    remaining = requests
+
+    async def worker(client):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await client.get("/process")
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://service-a", timeout=30) as client:
+            await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+
+
+def _encoded_bytes(spans):
+    from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+
+    return sum(
+        len(encode_spans(spans[i:i + EXPORT_BATCH]).SerializeToString())
+        for i in range(0, len(spans), EXPORT_BATCH)
+    )
+
+
+def child(args):
+    from opentelemetry import trace
+
+    script, _ = VARIANTS[args.child]
+    service = _load_service(script)
+    provider = getattr(getattr(service, "telemetry", None), "tracer_provider", None) or trace.get_tracer_provider()
+    capture = _Capture()
+    provider.add_span_processor(capture)
+
+    asyncio.run(_drive(service.app, args.requests, args.concurrency))
+    provider.force_flush()
+
+    from o11y_common.spanbudget import SpanBudgetProcessor
+
+    spans = capture.spans
+    before = _encoded_bytes(spans)
+    processor = SpanBudgetProcessor(rules=args.rules, enabled=True)
+    processor.saved_bytes, processor.changes = _Tally(), _Tally()
+    start = time.perf_counter()
+    for span in spans:
+        processor.on_end(span)
+    elapsed = time.perf_counter() - start
+    after = _encoded_bytes(spans)
+
+    result = {
+        "requests": args.requests,
+        "spans_per_request": round(len(spans) / args.requests, 2),
+        "bytes_per_request_before": round(before / args.requests),
+        "bytes_per_request_after": round(after / args.requests),
+        "saved_pct": round((1 - after / before) * 100, 1) if before else 0.0,
+        "saved_bytes_per_request": round((before - after) / args.requests),
+        "estimated_saved_bytes_per_request": round(sum(processor.saved_bytes.totals.values()) / args.requests),
+        "on_end_us_per_span": round(elapsed / max(1, len(spans)) * 1e6, 2),
+        "changes_per_request": {
+            action: round(count / args.requests, 2) for action, count in sorted(processor.changes.totals.items())
+        },
+    }
+    with open(args.child_out, "w") as f:
+        json.dump(result, f)
+
+
+# ---------------------------------------------------------------- parent process
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", nargs="+", choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--error-rate", type=float, default=0.1, help="fraction of failing downstream calls")
+    parser.add_argument("--rules", help="SPAN_BUDGET_RULES to apply (default: the module's defaults)")
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    parser.add_argument("--child", choices=list(VARIANTS), help=argparse.SUPPRESS)
+    parser.add_argument("--child-out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    from harness import Harness
+
+    harness = Harness(
+        service_b_error_rate=args.error_rate, service_d_error_rate=args.error_rate,
+        third_party_error_rate=args.error_rate,
+    )
+    with harness:
+        results = {variant: run_variant(variant, harness, args) for variant in args.variants}
+
+    print(f"{'variant':8s} {'spans/req':>9s} {'bytes/req before':>17s} {'after':>7s} {'saved':>7s}"
+          f" {'estimated':>10s} {'on_end/span':>12s}  changes/req")
+    for variant, r in results.items():
+        changes = ", ".join(f"{action} {count}" for action, count in r["changes_per_request"].items())
+        print(
+            f"{variant:8s} {r['spans_per_request']:>9.2f} {r['bytes_per_request_before']:>17d}"
+            f" {r['bytes_per_request_after']:>7d} {r['saved_pct']:>6.1f}%"
+            f" {r['estimated_saved_bytes_per_request']:>10d} {r['on_end_us_per_span']:>10.2f}us  {changes}"
+        )
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
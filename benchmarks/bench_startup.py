@@ -0,0 +1,160 @@
+"""
+Benchmark: cold start of the Python services, eager vs lazy telemetry init
+
+For api-gateway, service-a and service-d in both OTEL_LAZY_INIT=false/true:
+- import time breakdown of `import main` (python -X importtime), grouped by package
+- time from process spawn to the first successful GET /health
+
+The collector and Postgres do not need to be running: exports go to a local
+OTLP sink (otlp_sink.py) and the database points at a closed local port so
+Service A's init_db() fails fast.
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_startup.py [--runs 5] [--service api-gateway] [--json out.json]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import defaultdict
+
+from otlp_sink import start_otlp_sink
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES_DIR = os.path.join(REPO_ROOT, "services")
+COMMON_DIR = os.path.join(SERVICES_DIR, "common")
+
+SERVICES = {
+    "api-gateway": 8080,
+    "service-a": 8001,
+    "service-d": 8004,
+}
+
+SINK_PORT = 14317
+
+_IMPORTTIME_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def _env(lazy):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": COMMON_DIR,
+        "OTEL_LAZY_INIT": "true" if lazy else "false",
+        "OTEL_COLLECTOR_ENDPOINT": f"http://127.0.0.1:{SINK_PORT}",
+        "DB_HOST": "127.0.0.1",
+        "DB_PORT": "1",
+    })
+    return env
+
+
+def _group(module):
+    parts = module.split(".")
+    if parts[0] == "opentelemetry" and len(parts) > 1:
+        return ".".join(parts[:2])
+    if parts[0] == "o11y_common":
+        return "o11y_common"
+    return parts[0]
+
+
+def import_breakdown(service, lazy):
+    """Self time per package group (ms) of `import main`, plus the total"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.join(SERVICES_DIR, service), env=_env(lazy),
+        capture_output=True, text=True, check=True,
+    )
+    groups = defaultdict(float)
+    total = 0.0
+    for line in proc.stderr.splitlines():
+        m = _IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us, indent, module = int(m.group(1)), int(m.group(2)), m.group(3), m.group(4)
+        groups[_group(module)] += self_us / 1000
+        if len(indent) == 1:
+            total += cumulative_us / 1000
+    return total, dict(groups)
+
+
+def time_to_health(service, lazy, timeout=30.0):
+    """Seconds from spawn until GET /health returns 200"""
+    port = SERVICES[service]
+    url = f"http://127.0.0.1:{port}/health"
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=os.path.join(SERVICES_DIR, service), env=_env(lazy),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"{service} exited with code {proc.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as resp:
+                    if resp.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"{service} did not become healthy within {timeout}s")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def bench(services, runs):
+    results = {}
+    for service in services:
+        for lazy in (False, True):
+            mode = "lazy" if lazy else "eager"
+            imports = [import_breakdown(service, lazy) for _ in range(runs)]
+            health = [time_to_health(service, lazy) for _ in range(runs)]
+
+            groups = defaultdict(list)
+            for _, g in imports:
+                for name, ms in g.items():
+                    groups[name].append(ms)
+            top = sorted(((statistics.median(v), k) for k, v in groups.items()), reverse=True)[:10]
+
+            results[f"{service}/{mode}"] = {
+                "import_ms": round(statistics.median(t for t, _ in imports), 1),
+                "import_breakdown_ms": {k: round(v, 1) for v, k in top},
+                "first_health_ms": round(statistics.median(health) * 1000, 1),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--service", action="append", choices=sorted(SERVICES),
+                        help="service to benchmark (repeatable, default: all)")
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    args = parser.parse_args()
+
+    sink = start_otlp_sink(SINK_PORT)
+    try:
+        results = bench(args.service or list(SERVICES), args.runs)
+    finally:
+        sink.stop(grace=None)
+    for name, r in results.items():
+        print(f"{name:22s} import {r['import_ms']:>7.1f} ms   first /health {r['first_health_ms']:>7.1f} ms")
+        for group, ms in r["import_breakdown_ms"].items():
+            print(f"    {group:40s} {ms:>7.1f} ms")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Benchmark: memory, export size and p99 accuracy of the metric views
+
+Records synthetic observations for the three tuned histograms
+(gateway_request_duration_seconds, service_a_db_query_duration_seconds,
+service_d_compute_duration_seconds) with a leaked high-cardinality attribute,
+under four MeterProvider setups:
+
+- default:                SDK default buckets, all attributes
+- tuned:                  HistogramView buckets, all attributes
+- tuned_allowlist:        HistogramView buckets + attribute allow-list
+- exponential_allowlist:  base-2 exponential histogram + attribute allow-list
+                          (skipped on SDKs older than 1.25, see o11y_common.views)
+
+and reports SDK memory (tracemalloc), OTLP export size, data points,
+Prometheus series (classic histograms: one per bucket + _sum + _count) and
+the relative error of the estimated p99 against the exact p99.
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_views.py [--observations 100000] [--cardinality 200] [--json out.json]
+"""
+import argparse
+import gc
+import json
+import math
+import random
+import tracemalloc
+
+from opentelemetry.exporter.otlp.proto.common.metrics_encoder import encode_metrics
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import (
+    ExponentialHistogramDataPoint,
+    HistogramDataPoint,
+    InMemoryMetricReader,
+)
+
+from o11y_common.views import (
+    COMPUTE_BUCKETS, DB_QUERY_BUCKETS, REQUEST_BUCKETS, HistogramView, exponential_histograms_supported,
+)
+
+# instrument -> (bucket layout, allowed attributes, value generator)
+INSTRUMENTS = {
+    "gateway_request_duration_seconds": (
+        REQUEST_BUCKETS, {"endpoint", "method", "status"},
+        lambda rnd: rnd.uniform(0.15, 0.6) + rnd.expovariate(20),
+    ),
+    "service_a_db_query_duration_seconds": (
+        DB_QUERY_BUCKETS, {"operation"},
+        lambda rnd: rnd.lognormvariate(math.log(0.0008), 0.8),
+    ),
+    "service_d_compute_duration_seconds": (
+        COMPUTE_BUCKETS, {"operation"},
+        lambda rnd: rnd.uniform(0.1, 0.5) + rnd.expovariate(200),
+    ),
+}
+
+BASE_ATTRIBUTES = {
+    "gateway_request_duration_seconds": {"endpoint": "/api/process", "method": "GET", "status": "success"},
+    "service_a_db_query_duration_seconds": {"operation": "insert_and_query"},
+    "service_d_compute_duration_seconds": {"operation": "compute"},
+}
+
+
+def _views(config):
+    if config == "default":
+        return []
+    views = []
+    for name, (buckets, allowed, _) in INSTRUMENTS.items():
+        views.append(HistogramView(
+            name,
+            boundaries=buckets,
+            attribute_keys=allowed if config.endswith("allowlist") else None,
+            exponential=config.startswith("exponential"),
+        ).to_sdk_view())
+    return views
+
+
+def _explicit_quantile(points, q):
+    bounds = points[0].explicit_bounds
+    counts = [0] * (len(bounds) + 1)
+    for p in points:
+        for i, c in enumerate(p.bucket_counts):
+            counts[i] += c
+    rank = q * sum(counts)
+    cumulative = 0
+    for i, c in enumerate(counts):
+        if cumulative + c >= rank and c:
+            lower = bounds[i - 1] if i > 0 else 0.0
+            upper = bounds[i] if i < len(bounds) else max(p.max for p in points)
+            return lower + (upper - lower) * (rank - cumulative) / c
+        cumulative += c
+    return 0.0
+
+
+def _exponential_quantile(points, q):
+    # Bring every point down to the smallest scale, then merge the positive buckets
+    scale = min(p.scale for p in points)
+    counts = {}
+    for p in points:
+        shift = p.scale - scale
+        for i, c in enumerate(p.positive.bucket_counts):
+            index = (p.positive.offset + i) >> shift
+            counts[index] = counts.get(index, 0) + c
+    base = 2 ** (2 ** -scale)
+    rank = q * sum(counts.values())
+    cumulative = 0
+    for index in sorted(counts):
+        c = counts[index]
+        if cumulative + c >= rank and c:
+            lower, upper = base ** index, base ** (index + 1)
+            return lower + (upper - lower) * (rank - cumulative) / c
+        cumulative += c
+    return 0.0
+
+
+def run_config(config, observations, cardinality, seed):
+    rnd = random.Random(seed)
+    exact = {name: [] for name in INSTRUMENTS}
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    reader = InMemoryMetricReader()
+    provider = MeterProvider(metric_readers=[reader], views=_views(config))
+    meter = provider.get_meter("bench")
+    histograms = {name: meter.create_histogram(name, unit="s") for name in INSTRUMENTS}
+
+    for i in range(observations):
+        name = list(INSTRUMENTS)[i % len(INSTRUMENTS)]
+        value = INSTRUMENTS[name][2](rnd)
+        exact[name].append(value)
+        attributes = dict(BASE_ATTRIBUTES[name])
+        # A high-cardinality attribute somebody added "for debugging"
+        attributes["db.log_id"] = rnd.randrange(cardinality)
+        histograms[name].record(value, attributes)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    memory = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+    data = reader.get_metrics_data()
+    export_bytes = encode_metrics(data).ByteSize()
+
+    data_points = 0
+    prometheus_series = 0
+    p99_error = {}
+    for rm in data.resource_metrics:
+        for sm in rm.scope_metrics:
+            for metric in sm.metrics:
+                points = list(metric.data.data_points)
+                data_points += len(points)
+                if isinstance(points[0], HistogramDataPoint):
+                    prometheus_series += sum(len(p.bucket_counts) + 2 for p in points)
+                    estimate = _explicit_quantile(points, 0.99)
+                elif isinstance(points[0], ExponentialHistogramDataPoint):
+                    estimate = _exponential_quantile(points, 0.99)
+                else:
+                    continue
+                values = sorted(exact[metric.name])
+                true_p99 = values[int(0.99 * (len(values) - 1))]
+                p99_error[metric.name] = round(abs(estimate - true_p99) / true_p99 * 100, 2)
+
+    provider.shutdown()
+    return {
+        "sdk_memory_kib": round(memory / 1024, 1),
+        "export_bytes": export_bytes,
+        "data_points": data_points,
+        "prometheus_series": prometheus_series,
+        "p99_error_pct": p99_error,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--observations", type=int, default=100000)
+    parser.add_argument("--cardinality", type=int, default=200, help="distinct values of the leaked attribute")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    args = parser.parse_args()
+
+    configs = ["default", "tuned", "tuned_allowlist"]
+    if exponential_histograms_supported():
+        configs.append("exponential_allowlist")
+    else:
+        print("exponential_allowlist skipped: installed opentelemetry-sdk exports misaligned buckets (< 1.25)")
+
+    results = {}
+    for config in configs:
+        results[config] = run_config(config, args.observations, args.cardinality, args.seed)
+
+    for config, r in results.items():
+        errors = "  ".join(f"{name.split('_')[1]}={err:.1f}%" for name, err in r["p99_error_pct"].items())
+        print(f"{config:22s} mem {r['sdk_memory_kib']:>8.1f} KiB  export {r['export_bytes']:>8d} B  "
+              f"points {r['data_points']:>5d}  prom series {r['prometheus_series']:>6d}  p99 err {errors}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
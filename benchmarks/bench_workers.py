@@ -0,0 +1,164 @@
+"""
+Benchmark: API gateway throughput vs number of uvicorn workers
+
+Starts services/api-gateway/main.py with WEB_CONCURRENCY=1,2,4,... against a
+fake Service A (fake_http.py) and a local OTLP sink, drives GET /api/process
+with a closed-loop client for a fixed duration and reports requests/sec and
+p50 / p99 latency per worker count.
+
+Use at least as many CPUs as the largest worker count plus the load
+generator processes, otherwise the numbers only show CPU contention.
+
+Usage:
+    PYTHONPATH=services/common python benchmarks/bench_workers.py [--workers 1 2 4] [--duration 15] [--json out.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+import httpx
+
+from fake_http import start_json_server_process
+from otlp_sink import start_otlp_sink
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GATEWAY_DIR = os.path.join(REPO_ROOT, "services", "api-gateway")
+COMMON_DIR = os.path.join(REPO_ROOT, "services", "common")
+
+GATEWAY_PORT = 8080
+FAKE_SERVICE_A_PORT = 18001
+SINK_PORT = 14317
+
+FAKE_SERVICE_A_BODY = {
+    "status": "success",
+    "service": "service-a",
+    "trace_id": "0" * 32,
+    "duration_ms": 1,
+    "data": {"log_id": 1, "recent_requests": 1},
+}
+
+
+def _start_gateway(workers):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": COMMON_DIR,
+        "WEB_CONCURRENCY": str(workers),
+        "SERVICE_A_URL": f"http://127.0.0.1:{FAKE_SERVICE_A_PORT}",
+        "OTEL_COLLECTOR_ENDPOINT": f"http://127.0.0.1:{SINK_PORT}",
+    })
+    proc = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=GATEWAY_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{GATEWAY_PORT}/health", timeout=1):
+                return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise TimeoutError("gateway did not become healthy")
+
+
+async def _load(url, concurrency, duration):
+    latencies = []
+    errors = 0
+    stop_at = time.perf_counter() + duration
+
+    async def worker(client):
+        nonlocal errors
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            try:
+                resp = await client.get(url)
+                if resp.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def _load_process(args):
+    return asyncio.run(_load(*args))
+
+
+def run_load(url, concurrency, duration, procs):
+    per_proc = max(1, concurrency // procs)
+    # spawn: the OTLP sink's gRPC threads make fork() unsafe in this process
+    with multiprocessing.get_context("spawn").Pool(procs) as pool:
+        parts = pool.map(_load_process, [(url, per_proc, duration)] * procs)
+    latencies = sorted(l for part, _ in parts for l in part)
+    errors = sum(e for _, e in parts)
+    return latencies, errors
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def bench(worker_counts, concurrency, duration, load_procs):
+    url = f"http://127.0.0.1:{GATEWAY_PORT}/api/process"
+    results = {"cpus": os.cpu_count(), "concurrency": concurrency, "duration_s": duration, "runs": {}}
+    for workers in worker_counts:
+        gateway = _start_gateway(workers)
+        try:
+            run_load(url, concurrency, 2, load_procs)  # warm up every worker
+            latencies, errors = run_load(url, concurrency, duration, load_procs)
+        finally:
+            gateway.terminate()
+            gateway.wait(timeout=30)
+        results["runs"][str(workers)] = {
+            "requests_per_sec": round(len(latencies) / duration, 1),
+            "p50_ms": round(_quantile(latencies, 0.50) * 1000, 2),
+            "p99_ms": round(_quantile(latencies, 0.99) * 1000, 2),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+            "errors": errors,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent in-flight requests")
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per worker count")
+    parser.add_argument("--load-procs", type=int, default=2, help="load generator processes")
+    parser.add_argument("--json", dest="json_out", help="write results to this file")
+    args = parser.parse_args()
+
+    sink = start_otlp_sink(SINK_PORT)
+    fake_a = start_json_server_process(FAKE_SERVICE_A_PORT, FAKE_SERVICE_A_BODY)
+    try:
+        results = bench(args.workers, args.concurrency, args.duration, args.load_procs)
+    finally:
+        fake_a.terminate()
+        sink.stop(grace=None)
+
+    print(f"cpus={results['cpus']} concurrency={args.concurrency}")
+    for workers, r in results["runs"].items():
+        print(f"workers={workers:>2s}  {r['requests_per_sec']:>8.1f} req/s  p50 {r['p50_ms']:>7.2f} ms  "
+              f"p99 {r['p99_ms']:>7.2f} ms  errors {r['errors']}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
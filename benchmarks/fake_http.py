@@ -0,0 +1,207 @@
+"""
+Minimal keep-alive HTTP/1.1 server with canned responses per path
+
+Stands in for a downstream service when the service under test is started as a
+real process. Implemented on raw asyncio streams so that it is never the
+bottleneck of a benchmark.
+
+Every endpoint has a fixed response, a delay (fixed or uniform between two
+bounds) and an error rate; delays and errors come from a seeded random
+generator so runs are repeatable. GET /__stats returns the number of requests
+per path, injected errors and requests that carried a W3C traceparent header.
+
+service_b_routes(), service_d_routes() and third_party_routes() mimic the
+responses of the lab's services.
+"""
+import asyncio
+import json
+import multiprocessing
+import random
+import signal
+from collections import Counter
+
+
+class FakeEndpoint:
+    """
+    Canned response of one path
+
+    Args:
+        body: JSON-serializable object, str for a text/plain response, or a
+            function building the JSON response from the JSON request body
+        status: HTTP status of the normal response
+        delay: seconds before answering, or (low, high) for a uniform delay
+        error_rate: fraction of requests answered with `error_status` instead
+        error_status: status of the injected errors
+    """
+
+    def __init__(self, body, status=200, delay=0.0, error_rate=0.0, error_status=503):
+        self.body = body
+        self.status = status
+        self.delay = delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def next_delay(self, rnd):
+        if isinstance(self.delay, (tuple, list)):
+            return rnd.uniform(*self.delay)
+        return self.delay
+
+
+_REASONS = {200: b"OK", 404: b"Not Found", 429: b"Too Many Requests", 500: b"Internal Server Error",
+            502: b"Bad Gateway", 503: b"Service Unavailable", 504: b"Gateway Timeout"}
+
+
+def _response(body, status=200):
+    if isinstance(body, str):
+        payload, content_type = body.encode(), b"text/plain; charset=utf-8"
+    else:
+        payload, content_type = json.dumps(body).encode(), b"application/json"
+    return (
+        b"HTTP/1.1 " + str(status).encode() + b" " + _REASONS.get(status, b"Unknown") + b"\r\n"
+        b"Content-Type: " + content_type + b"\r\n"
+        b"Content-Length: " + str(len(payload)).encode() + b"\r\n"
+        b"\r\n" + payload
+    )
+
+
+class _Server:
+    def __init__(self, routes, seed):
+        self.routes = routes
+        self.rendered = {
+            path: (None if callable(ep.body) else _response(ep.body, ep.status),
+                   _response({"error": "injected"}, ep.error_status))
+            for path, ep in routes.items()
+        }
+        self.not_found = _response({"error": "not found"}, 404)
+        self.rnd = random.Random(seed)
+        self.requests = Counter()
+        self.errors = Counter()
+        self.traceparent = 0
+
+    def stats(self):
+        return {
+            "requests": dict(self.requests),
+            "errors_injected": dict(self.errors),
+            "with_traceparent": self.traceparent,
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.split(b"\r\n")
+                path = lines[0].split(b" ")[1].split(b"?")[0].decode()
+                length = 0
+                for line in lines[1:]:
+                    name = line[:15].lower()
+                    if name == b"content-length:":
+                        length = int(line[15:])
+                    elif name.startswith(b"traceparent:"):
+                        self.traceparent += 1
+                body = await reader.readexactly(length) if length else b""
+                writer.write(await self._respond(path, body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, path, body=b""):
+        if path == "/__stats":
+            return _response(self.stats())
+        key = path if path in self.routes else "*"
+        endpoint = self.routes.get(key)
+        if endpoint is None:
+            return self.not_found
+        self.requests[path] += 1
+        delay = endpoint.next_delay(self.rnd)
+        if delay:
+            await asyncio.sleep(delay)
+        ok, error = self.rendered[key]
+        if endpoint.error_rate and self.rnd.random() < endpoint.error_rate:
+            self.errors[path] += 1
+            return error
+        if ok is None:
+            return _response(endpoint.body(json.loads(body or b"null")), endpoint.status)
+        return ok
+
+
+async def serve_routes(port, routes, seed=0):
+    """Serve {path: FakeEndpoint} on 127.0.0.1:`port` forever; "*" matches any other path"""
+    state = _Server(routes, seed)
+    server = await asyncio.start_server(state.handle, "127.0.0.1", port)
+    async with server:
+        await server.serve_forever()
+
+
+async def serve_json(port, body, delay=0.0):
+    """Serve `body` as JSON on 127.0.0.1:`port` forever, after `delay` seconds per request"""
+    await serve_routes(port, {"*": FakeEndpoint(body, delay=delay)})
+
+
+def _run_server(port, routes, seed):
+    # Ctrl-C reaches the whole process group; the parent stops this process with terminate()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_routes(port, routes, seed))
+
+
+def start_fake_server_process(port, routes, seed=0):
+    """Run serve_routes in a separate process and return the started Process"""
+    ctx = multiprocessing.get_context("spawn")
+    proc = ctx.Process(target=_run_server, args=(port, routes, seed), daemon=True)
+    proc.start()
+    return proc
+
+
+def start_json_server_process(port, body, delay=0.0):
+    """Run serve_json in a separate process and return the started Process"""
+    return start_fake_server_process(port, {"*": FakeEndpoint(body, delay=delay)})
+
+
+def _enqueue_batch(request):
+    results = [
+        {"status": "success", "service": "service-b", "message": "Message enqueued to Kafka", "trace_id": m.get("trace_id", "")}
+        for m in request["messages"]
+    ]
+    return {"status": "success", "service": "service-b", "count": len(results), "failed": 0, "results": results}
+
+
+def service_b_routes(delay=0.0, error_rate=0.0):
+    """Service B (Go, Kafka producer): POST /enqueue and POST /enqueue/batch"""
+    return {
+        "/enqueue": FakeEndpoint(
+            {"status": "success", "service": "service-b", "message": "Message enqueued to Kafka", "trace_id": ""},
+            delay=delay, error_rate=error_rate, error_status=500,
+        ),
+        "/enqueue/batch": FakeEndpoint(_enqueue_batch, delay=delay, error_rate=error_rate, error_status=500),
+        "/health": FakeEndpoint({"status": "healthy", "service": "service-b"}),
+    }
+
+
+def service_d_routes(delay=0.0, error_rate=0.0):
+    """Service D (Flask): GET /compute; the real service sleeps 0.1-0.5s per request"""
+    return {
+        "/compute": FakeEndpoint(
+            {
+                "status": "success",
+                "service": "service-d",
+                "trace_id": "",
+                "input_value": 42,
+                "results": {
+                    "fibonacci": {"input": 20, "result": 6765},
+                    "prime_factors": {"input": 42, "factors": [2, 3, 7]},
+                    "statistics": {"mean": 50.5, "max": 97, "min": 3, "sum": 505},
+                },
+                "duration_seconds": 0.0,
+            },
+            delay=delay, error_rate=error_rate, error_status=500,
+        ),
+        "/health": FakeEndpoint({"status": "healthy", "service": "service-d"}),
+        # Polled by Service A's background health check
+        "/health/live": FakeEndpoint({"status": "healthy", "service": "service-d"}),
+    }
+
+
+def third_party_routes(delay=0.0, error_rate=0.0):
+    """The third-party API Service A calls (https://api.github.com/zen)"""
+    return {"/zen": FakeEndpoint("Design for failure.", delay=delay, error_rate=error_rate)}
@@ -0,0 +1,156 @@
+"""
+Minimal PostgreSQL stand-in speaking enough of the v3 wire protocol for psycopg2
+
+Accepts any user without a password and answers the simple-query messages
+Service A sends (CREATE TABLE, BEGIN / COMMIT, INSERT ... RETURNING id,
+SELECT COUNT(*) ..., UPDATE) with plausible results, so the services' real
+database code paths and the psycopg2 instrumentation run without a database.
+Nothing is stored: INSERT returns increasing ids and SELECT returns the number
+of rows inserted so far for every `AS <name>` column.
+
+Implemented on raw asyncio streams like fake_http.py.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import re
+import signal
+import struct
+
+_SSL_REQUEST = 80877103
+_GSSENC_REQUEST = 80877104
+_CANCEL_REQUEST = 80877102
+
+_INT4_OID = 23
+_INT8_OID = 20
+
+_PARAMETERS = {
+    "server_version": "15.0",
+    "server_encoding": "UTF8",
+    "client_encoding": "UTF8",
+    "DateStyle": "ISO, MDY",
+    "TimeZone": "UTC",
+    "integer_datetimes": "on",
+    "standard_conforming_strings": "on",
+}
+
+_ALIAS_RE = re.compile(r"\bas\s+(\w+)", re.IGNORECASE)
+
+
+def _message(kind, payload=b""):
+    return kind + struct.pack("!I", len(payload) + 4) + payload
+
+
+def _ready(in_transaction):
+    return _message(b"Z", b"T" if in_transaction else b"I")
+
+
+def _row(columns):
+    """RowDescription + DataRow for [(name, type oid, value), ...]"""
+    description = struct.pack("!H", len(columns))
+    data = struct.pack("!H", len(columns))
+    for name, oid, value in columns:
+        size = 4 if oid == _INT4_OID else 8
+        description += name.encode() + b"\0" + struct.pack("!IhIhih", 0, 0, oid, size, -1, 0)
+        text = str(value).encode()
+        data += struct.pack("!i", len(text)) + text
+    return _message(b"T", description) + _message(b"D", data)
+
+
+class _Database:
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.rows = 0
+
+    def execute(self, sql):
+        """Return (response messages, command tag) for one statement"""
+        command = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+        if command == "INSERT":
+            self.rows += 1
+            if "RETURNING" in sql.upper():
+                return _row([("id", _INT4_OID, next(self.ids))]), "INSERT 0 1"
+            return b"", "INSERT 0 1"
+        if command == "SELECT":
+            select_list = re.split(r"\bfrom\b", sql, 1, flags=re.IGNORECASE)[0]
+            names = _ALIAS_RE.findall(select_list) or ["?column?"]
+            return _row([(name, _INT8_OID, self.rows) for name in names]), "SELECT 1"
+        if command == "UPDATE":
+            return b"", "UPDATE 1"
+        if command == "CREATE":
+            return b"", "CREATE TABLE"
+        return b"", command
+
+
+async def _handle(reader, writer, db, delay):
+    try:
+        # Startup phase: answer "N" to SSL / GSS encryption requests until the real startup packet
+        while True:
+            length, code = struct.unpack("!II", await reader.readexactly(8))
+            await reader.readexactly(length - 8)
+            if code in (_SSL_REQUEST, _GSSENC_REQUEST):
+                writer.write(b"N")
+                continue
+            if code == _CANCEL_REQUEST:
+                return
+            break
+
+        response = _message(b"R", struct.pack("!I", 0))
+        for name, value in _PARAMETERS.items():
+            response += _message(b"S", name.encode() + b"\0" + value.encode() + b"\0")
+        response += _message(b"K", struct.pack("!II", 1, 1))
+        writer.write(response + _ready(False))
+        await writer.drain()
+
+        in_transaction = False
+        while True:
+            kind = await reader.readexactly(1)
+            (length,) = struct.unpack("!I", await reader.readexactly(4))
+            payload = await reader.readexactly(length - 4)
+            if kind == b"X":
+                return
+            if kind != b"Q":
+                writer.write(_message(b"E", b"SERROR\0C0A000\0Monly simple queries are supported\0\0"))
+                writer.write(_ready(in_transaction))
+                await writer.drain()
+                continue
+
+            sql = payload.rstrip(b"\0").decode()
+            rows, tag = db.execute(sql)
+            if tag == "BEGIN":
+                in_transaction = True
+            elif tag in ("COMMIT", "ROLLBACK"):
+                in_transaction = False
+            elif delay:
+                await asyncio.sleep(delay)
+            if tag:
+                writer.write(rows + _message(b"C", tag.encode() + b"\0"))
+            else:
+                writer.write(_message(b"I"))
+            writer.write(_ready(in_transaction))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_postgres(port, delay=0.0):
+    """Serve the fake database on 127.0.0.1:`port`, `delay` seconds per statement"""
+    db = _Database()
+    server = await asyncio.start_server(lambda r, w: _handle(r, w, db, delay), "127.0.0.1", port)
+    async with server:
+        await server.serve_forever()
+
+
+def _run_server(port, delay):
+    # Ctrl-C reaches the whole process group; the parent stops this process with terminate()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_postgres(port, delay))
+
+
+def start_postgres_process(port, delay=0.0):
+    """Run serve_postgres in a separate process and return the started Process"""
+    ctx = multiprocessing.get_context("spawn")
+    proc = ctx.Process(target=_run_server, args=(port, delay), daemon=True)
+    proc.start()
+    return proc
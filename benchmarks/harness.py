@@ -0,0 +1,175 @@
+"""
+Offline stand-ins for everything the gateway and Service A talk to
+
+Starts, on 127.0.0.1 only:
+
+- an OTLP gRPC + HTTP receiver (otlp_sink.OtlpReceiver) in this process
+- fake Service B, Service D and third-party HTTP endpoints (fake_http.py)
+- a fake Postgres (fake_postgres.py)
+
+each downstream in its own process, and prints the environment variables that
+point the services at them. Latency, error rate and backpressure of every
+stand-in are configurable and seeded, so runs are repeatable on one machine
+without docker-compose or network access.
+
+Benchmarks use `Harness` as a context manager; run as a script it prints the
+receiver's throughput every --report-interval seconds until interrupted:
+
+    PYTHONPATH=services/common python benchmarks/harness.py --service-d-delay 0.1:0.5
+    # in another shell, with the printed variables exported:
+    PYTHONPATH=services/common python services/service-a/main.py
+"""
+import argparse
+import json
+import time
+import urllib.request
+
+from fake_http import service_b_routes, service_d_routes, start_fake_server_process, third_party_routes
+from fake_postgres import start_postgres_process
+from otlp_sink import OtlpReceiver
+
+OTLP_GRPC_PORT = 14317
+OTLP_HTTP_PORT = 14318
+POSTGRES_PORT = 15432
+SERVICE_B_PORT = 18002
+SERVICE_D_PORT = 18004
+THIRD_PARTY_PORT = 18080
+
+
+class Harness:
+    """
+    Start / stop all stand-ins
+
+    Args:
+        otlp_latency, otlp_error_rate, otlp_max_items_per_sec: see OtlpReceiver
+        service_b_delay, service_d_delay, third_party_delay: seconds or (low, high)
+        service_b_error_rate, service_d_error_rate, third_party_error_rate: fraction of 5xx answers
+        db_delay: fake Postgres seconds per statement
+        seed: seed of every injected delay and error
+    """
+
+    def __init__(self, otlp_latency=0.0, otlp_error_rate=0.0, otlp_max_items_per_sec=0,
+                 service_b_delay=0.0, service_b_error_rate=0.0,
+                 service_d_delay=0.0, service_d_error_rate=0.0,
+                 third_party_delay=0.0, third_party_error_rate=0.0,
+                 db_delay=0.0, seed=0):
+        self.receiver = OtlpReceiver(otlp_latency, otlp_error_rate, otlp_max_items_per_sec, seed)
+        self._downstreams = [
+            (SERVICE_B_PORT, service_b_routes(service_b_delay, service_b_error_rate)),
+            (SERVICE_D_PORT, service_d_routes(service_d_delay, service_d_error_rate)),
+            (THIRD_PARTY_PORT, third_party_routes(third_party_delay, third_party_error_rate)),
+        ]
+        self.db_delay = db_delay
+        self.seed = seed
+        self._procs = []
+
+    @property
+    def env(self):
+        """Environment variables pointing api-gateway / service-a / service-a-hybrid at the stand-ins"""
+        return {
+            "OTEL_COLLECTOR_ENDPOINT": f"http://127.0.0.1:{OTLP_GRPC_PORT}",
+            "OTEL_EXPORTER_OTLP_ENDPOINT": f"http://127.0.0.1:{OTLP_GRPC_PORT}",
+            "OTEL_EXPORTER_OTLP_INSECURE": "true",
+            "SERVICE_B_URL": f"http://127.0.0.1:{SERVICE_B_PORT}",
+            "SERVICE_D_URL": f"http://127.0.0.1:{SERVICE_D_PORT}",
+            "THIRD_PARTY_API": f"http://127.0.0.1:{THIRD_PARTY_PORT}/zen",
+            "DB_HOST": "127.0.0.1",
+            "DB_PORT": str(POSTGRES_PORT),
+            # Every run starts with empty /stats sketches, whatever SKETCH_STATE_DIR the shell has
+            "SKETCH_PERSIST_INTERVAL": "0",
+        }
+
+    def start(self, timeout=10.0):
+        self.receiver.start(grpc_port=OTLP_GRPC_PORT, http_port=OTLP_HTTP_PORT)
+        self._procs.append(start_postgres_process(POSTGRES_PORT, self.db_delay))
+        for port, routes in self._downstreams:
+            self._procs.append(start_fake_server_process(port, routes, self.seed))
+        self._wait_ready(timeout)
+        return self
+
+    def _wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        for port, _ in self._downstreams:
+            while True:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/__stats", timeout=1):
+                        break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"fake server on port {port} did not start")
+                    time.sleep(0.05)
+
+    def downstream_stats(self):
+        """Request counters of the fake HTTP endpoints"""
+        stats = {}
+        for name, (port, _) in zip(("service_b", "service_d", "third_party"), self._downstreams):
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/__stats", timeout=1) as resp:
+                stats[name] = json.load(resp)
+        return stats
+
+    def stop(self):
+        self.receiver.stop(grace=None)
+        for proc in self._procs:
+            proc.terminate()
+        self._procs = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _delay(value):
+    """"0.2" -> 0.2, "0.1:0.5" -> (0.1, 0.5)"""
+    if ":" in value:
+        low, high = value.split(":")
+        return float(low), float(high)
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--otlp-latency", type=float, default=0.0)
+    parser.add_argument("--otlp-error-rate", type=float, default=0.0)
+    parser.add_argument("--otlp-max-items-per-sec", type=int, default=0)
+    for name in ("service-b", "service-d", "third-party"):
+        parser.add_argument(f"--{name}-delay", type=_delay, default=0.0, help="seconds, or low:high")
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+    parser.add_argument("--db-delay", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    parser.add_argument("--json", dest="json_out", help="write the final counters to this file")
+    args = parser.parse_args()
+
+    harness = Harness(
+        otlp_latency=args.otlp_latency, otlp_error_rate=args.otlp_error_rate,
+        otlp_max_items_per_sec=args.otlp_max_items_per_sec,
+        service_b_delay=args.service_b_delay, service_b_error_rate=args.service_b_error_rate,
+        service_d_delay=args.service_d_delay, service_d_error_rate=args.service_d_error_rate,
+        third_party_delay=args.third_party_delay, third_party_error_rate=args.third_party_error_rate,
+        db_delay=args.db_delay, seed=args.seed,
+    )
+    with harness:
+        print(" ".join(f"{k}={v}" for k, v in harness.env.items()), flush=True)
+        try:
+            while True:
+                time.sleep(args.report_interval)
+                stats = harness.receiver.stats()
+                print("  ".join(
+                    f"{signal} {stats[signal]['items_per_sec']:>8.1f}/s (refused {stats[signal]['refused_items']}, "
+                    f"failed exports {stats[signal]['failed_exports']})"
+                    for signal in ("traces", "metrics", "logs")
+                ), flush=True)
+        except KeyboardInterrupt:
+            pass
+        results = {"otlp": harness.receiver.stats(), "downstreams": harness.downstream_stats()}
+
+    print(json.dumps(results, indent=2))
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+"""
+Open-model load generator for the gateway's /api/process
+
+The k6 scripts use closed-model VU loops: a VU waits for its response before
+sending the next request, so when the gateway stalls the load generator stops
+sending too and the stall only shows up as a handful of slow samples
+(coordinated omission). This generator schedules requests at a constant (or
+Poisson) arrival rate independent of the responses, and measures every
+request from its *intended* send time:
+
+- response time: intended send -> response (queueing included, the corrected value)
+- service time:  actual send -> response, after waiting for a pooled
+                 connection (what a closed-model tool reports)
+
+Both are kept in HDR-style log-linear histograms (~1% precision, 1 us - 1 h).
+Each request carries a W3C traceparent, so the trace IDs of the slowest
+requests are known without looking at the responses; --sample-ratio sets the
+sampled flag (the services use parent-based samplers, so this decides whether
+the trace is recorded).
+
+The report follows the rows of the "4 Golden Signals" Grafana dashboard:
+traffic, latency (p50 / p95 / p99), errors (5xx / 4xx rate) and saturation
+(mean latency and the <=10ms / 10-100ms / 100-500ms / >500ms request rates of
+"Request Saturation by Latency Buckets"), plus a per-interval timeline with
+unix timestamps to line it up with the dashboard's time series.
+
+Requests go through a pool of keep-alive HTTP/1.1 connections on raw asyncio
+streams, which sustains thousands of requests per second on one core. If the
+generator itself falls behind, the scheduler lag in the report grows; that
+delay is part of the response time but says nothing about the gateway.
+
+Usage:
+    python benchmarks/loadgen.py [--url http://localhost:8080/api/process] [--rate 100] [--duration 60] [--json report.json]
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+# ---------------------------------------------------------------- histogram
+
+_SUB_BITS = 7                       # 128 sub-buckets per power of two: <0.8% relative error
+_MAX_US = 3600 * 1_000_000
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of durations, in the spirit of HdrHistogram
+
+    Values are recorded in microseconds. Below 256us every microsecond has its
+    own bucket; above that each power of two is split into 128 buckets.
+    """
+
+    def __init__(self):
+        self.counts = [0] * ((_MAX_US.bit_length() - _SUB_BITS + 1) << _SUB_BITS)
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+
+    @staticmethod
+    def _index(us):
+        shift = max(0, us.bit_length() - _SUB_BITS - 1)
+        return (shift << _SUB_BITS) + (us >> shift)
+
+    @staticmethod
+    def _highest_equivalent(index):
+        shift = max(0, (index >> _SUB_BITS) - 1)
+        mantissa = index - (shift << _SUB_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        us = min(_MAX_US, max(0, int(seconds * 1_000_000)))
+        self.counts[self._index(us)] += 1
+        self.total += 1
+        self.sum_us += us
+        if us > self.max_us:
+            self.max_us = us
+
+    def quantile(self, q):
+        """Value (seconds) below which a fraction q of the recorded values fall"""
+        if not self.total:
+            return 0.0
+        rank = max(1, int(q * self.total + 0.5))
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= rank:
+                return min(self._highest_equivalent(i), self.max_us) / 1_000_000
+        return self.max_us / 1_000_000
+
+    def count_below(self, seconds):
+        """Number of values <= seconds (at bucket precision)"""
+        limit = self._index(min(_MAX_US, int(seconds * 1_000_000)))
+        return sum(self.counts[:limit + 1])
+
+    def mean(self):
+        return self.sum_us / self.total / 1_000_000 if self.total else 0.0
+
+    def summary_ms(self):
+        return {
+            "count": self.total,
+            "mean_ms": round(self.mean() * 1000, 3),
+            **{f"p{label}_ms": round(self.quantile(q) * 1000, 3)
+               for label, q in (("50", 0.50), ("95", 0.95), ("99", 0.99), ("99.9", 0.999))},
+            "max_ms": round(self.max_us / 1000, 3),
+        }
+
+
+# ---------------------------------------------------------------- HTTP client
+
+class _ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one host, at most `size` open at once"""
+
+    def __init__(self, host, port, size):
+        self.host = host
+        self.port = port
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+
+    async def get(self, request):
+        """Send a pre-rendered GET; returns the status code and when it was sent"""
+        async with self._slots:
+            if self._idle:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            sent = time.perf_counter()
+            try:
+                writer.write(request)
+                head = await reader.readuntil(b"\r\n\r\n")
+                status, length, chunked, close = _parse_head(head)
+                if chunked:
+                    await _read_chunked(reader)
+                elif length:
+                    await reader.readexactly(length)
+            except BaseException:
+                writer.close()
+                raise
+            if close:
+                writer.close()
+            else:
+                self._idle.append((reader, writer))
+            return status, sent
+
+    def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+
+def _parse_head(head):
+    lines = head.split(b"\r\n")
+    status = int(lines[0].split(b" ", 2)[1])
+    length, chunked, close = 0, False, False
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"transfer-encoding":
+            chunked = b"chunked" in value.lower()
+        elif name == b"connection":
+            close = b"close" in value.lower()
+    return status, length, chunked, close
+
+
+async def _read_chunked(reader):
+    while True:
+        size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+        await reader.readexactly(size + 2)
+        if size == 0:
+            return
+
+
+# ---------------------------------------------------------------- load
+
+class _Interval:
+    def __init__(self, start):
+        self.start = start
+        self.histogram = LatencyHistogram()
+        self.status = Counter()
+
+
+class LoadGenerator:
+    """
+    Constant-arrival-rate load against one URL
+
+    Args:
+        url: http:// URL to GET
+        rate: requests per second
+        duration: seconds of measured load (after `warmup` seconds of unmeasured load)
+        connections: size of the keep-alive connection pool
+        timeout: seconds before a request counts as a timeout error
+        arrival: "constant" or "poisson" inter-arrival times
+        sample_ratio: fraction of requests whose traceparent has the sampled flag
+        slowest: number of slowest requests to keep with their trace IDs
+        interval: seconds per timeline row
+    """
+
+    def __init__(self, url, rate, duration, warmup=0.0, connections=256, timeout=30.0,
+                 arrival="constant", sample_ratio=1.0, slowest=10, interval=10.0, seed=0):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError("only http:// URLs are supported")
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.connections = connections
+        self.timeout = timeout
+        self.arrival = arrival
+        self.sample_ratio = sample_ratio
+        self.slowest_n = slowest
+        self.interval = interval
+        self._rnd = random.Random(seed)
+
+        self.response_time = LatencyHistogram()
+        self.service_time = LatencyHistogram()
+        self.scheduler_lag = LatencyHistogram()
+        self.status = Counter()
+        self.slowest = []           # min-heap of (response time, trace id, ...)
+        self.intervals = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.completed_in_window = 0
+
+    def _request_bytes(self, trace_id, sampled):
+        span_id = self._rnd.getrandbits(64) or 1
+        return (
+            f"GET {self.target} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"traceparent: 00-{trace_id}-{span_id:016x}-{'01' if sampled else '00'}\r\n"
+            f"\r\n"
+        ).encode()
+
+    async def _one(self, pool, intended, measured):
+        trace_id = f"{self._rnd.getrandbits(128) or 1:032x}"
+        sampled = self._rnd.random() < self.sample_ratio
+        request = self._request_bytes(trace_id, sampled)
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        started = sent = time.perf_counter()
+        try:
+            status, sent = await asyncio.wait_for(pool.get(request), self.timeout)
+        except asyncio.TimeoutError:
+            status = "timeout"
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            status = "connection_error"
+        finally:
+            self.inflight -= 1
+        done = time.perf_counter()
+        if not measured:
+            return
+        if done <= self._measure_end:
+            self.completed_in_window += 1
+
+        response_time = done - intended
+        self.response_time.record(response_time)
+        self.service_time.record(done - sent)
+        self.scheduler_lag.record(started - intended)
+        self.status[status] += 1
+
+        interval = self.intervals[min(int((intended - self._measure_start) / self.interval), len(self.intervals) - 1)]
+        interval.histogram.record(response_time)
+        interval.status[status] += 1
+
+        entry = (response_time, trace_id, sampled, status, done - sent, intended - self._measure_start)
+        if len(self.slowest) < self.slowest_n:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def _next_gap(self):
+        if self.arrival == "poisson":
+            return self._rnd.expovariate(self.rate)
+        return 1.0 / self.rate
+
+    async def run(self):
+        pool = _ConnectionPool(self.host, self.port, self.connections)
+        tasks = set()
+        start = time.perf_counter()
+        self._measure_start = start + self.warmup
+        self._unix_measure_start = time.time() + self.warmup
+        end = self._measure_end = self._measure_start + self.duration
+        n_intervals = max(1, int(-(-self.duration // self.interval)))
+        self.intervals = [_Interval(self._unix_measure_start + i * self.interval) for i in range(n_intervals)]
+
+        intended = start
+        while intended < end:
+            now = time.perf_counter()
+            if intended > now:
+                await asyncio.sleep(intended - now)
+            # Catch up on every arrival that is due; they keep their intended times
+            now = time.perf_counter()
+            while intended <= now and intended < end:
+                task = asyncio.create_task(self._one(pool, intended, intended >= self._measure_start))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                intended += self._next_gap()
+
+        if tasks:
+            await asyncio.wait(tasks)
+        pool.close()
+        return self.report()
+
+    def report(self):
+        total = self.response_time.total
+        errors_5xx = sum(c for s, c in self.status.items() if isinstance(s, int) and s >= 500)
+        errors_4xx = sum(c for s, c in self.status.items() if isinstance(s, int) and 400 <= s < 500)
+        transport = sum(c for s, c in self.status.items() if not isinstance(s, int))
+        h = self.response_time
+        below_10ms, below_100ms, below_500ms = (h.count_below(s) for s in (0.01, 0.1, 0.5))
+        per_sec = 1.0 / self.duration
+
+        def pct(n):
+            return round(100.0 * n / total, 3) if total else 0.0
+
+        return {
+            "config": {
+                "url": self.url, "rate": self.rate, "duration_s": self.duration, "arrival": self.arrival,
+                "connections": self.connections, "timeout_s": self.timeout, "sample_ratio": self.sample_ratio,
+                "start_unix": round(self._unix_measure_start, 3),
+            },
+            "traffic": {
+                "offered_rps": self.rate,
+                # Responses received during the measured window (requests still in flight at its end are
+                # awaited and included in the latency, but not in this rate)
+                "completed_rps": round(self.completed_in_window * per_sec, 2),
+                "requests": total,
+            },
+            "latency": {
+                "response_time": self.response_time.summary_ms(),
+                "service_time": self.service_time.summary_ms(),
+            },
+            "errors": {
+                "error_rate_5xx_pct": pct(errors_5xx),
+                "error_rate_4xx_pct": pct(errors_4xx),
+                "transport_error_pct": pct(transport),
+                "status_codes": {str(s): c for s, c in sorted(self.status.items(), key=str)},
+            },
+            "saturation": {
+                "mean_latency_ms": round(h.mean() * 1000, 3),
+                "latency_bucket_rps": {
+                    "le_10ms": round(below_10ms * per_sec, 2),
+                    "10ms_100ms": round((below_100ms - below_10ms) * per_sec, 2),
+                    "100ms_500ms": round((below_500ms - below_100ms) * per_sec, 2),
+                    "gt_500ms": round((total - below_500ms) * per_sec, 2),
+                },
+                "max_inflight": self.max_inflight,
+                "scheduler_lag": self.scheduler_lag.summary_ms(),
+            },
+            "timeline": [
+                {
+                    "start_unix": round(iv.start, 3),
+                    "rps": round(iv.histogram.total / self.interval, 2),
+                    "p50_ms": round(iv.histogram.quantile(0.50) * 1000, 3),
+                    "p99_ms": round(iv.histogram.quantile(0.99) * 1000, 3),
+                    "error_rate_5xx_pct": round(100.0 * sum(
+                        c for s, c in iv.status.items() if isinstance(s, int) and s >= 500
+                    ) / iv.histogram.total, 3) if iv.histogram.total else 0.0,
+                }
+                for iv in self.intervals
+            ],
+            "slowest": [
+                {
+                    "trace_id": trace_id,
+                    "sampled": sampled,
+                    "status": status,
+                    "response_time_ms": round(rt * 1000, 3),
+                    "service_time_ms": round(st * 1000, 3),
+                    "at_s": round(at, 3),
+                }
+                for rt, trace_id, sampled, status, st, at in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+
+def _print_report(r):
+    t, lat, err, sat = r["traffic"], r["latency"], r["errors"], r["saturation"]
+    rt, st = lat["response_time"], lat["service_time"]
+    print(f"Traffic     offered {t['offered_rps']:.1f} req/s  completed {t['completed_rps']:.1f} req/s  "
+          f"({t['requests']} requests)")
+    print(f"Latency     response time  p50 {rt['p50_ms']:.2f}  p95 {rt['p95_ms']:.2f}  p99 {rt['p99_ms']:.2f}  "
+          f"max {rt['max_ms']:.2f} ms   (corrected for coordinated omission)")
+    print(f"            service time   p50 {st['p50_ms']:.2f}  p95 {st['p95_ms']:.2f}  p99 {st['p99_ms']:.2f}  "
+          f"max {st['max_ms']:.2f} ms")
+    print(f"Errors      5xx {err['error_rate_5xx_pct']:.2f}%  4xx {err['error_rate_4xx_pct']:.2f}%  "
+          f"transport {err['transport_error_pct']:.2f}%  {err['status_codes']}")
+    buckets = "  ".join(f"{k} {v:.1f}/s" for k, v in sat["latency_bucket_rps"].items())
+    print(f"Saturation  mean {sat['mean_latency_ms']:.2f} ms  {buckets}  max in-flight {sat['max_inflight']}")
+    lag = sat["scheduler_lag"]
+    print(f"Generator   scheduler lag p99 {lag['p99_ms']:.2f} ms  max {lag['max_ms']:.2f} ms")
+    if r["slowest"]:
+        print("Slowest requests (search the trace ID in Grafana Tempo):")
+        for s in r["slowest"]:
+            flag = "" if s["sampled"] else "  (not sampled)"
+            print(f"  {s['trace_id']}  {s['response_time_ms']:>9.2f} ms  status {s['status']}  "
+                  f"at +{s['at_s']:.1f}s{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080/api/process")
+    parser.add_argument("--rate", type=float, default=100.0, help="requests per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="unmeasured seconds before the measurement")
+    parser.add_argument("--connections", type=int, default=256, help="keep-alive connection pool size")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--arrival", choices=("constant", "poisson"), default="constant")
+    parser.add_argument("--sample-ratio", type=float, default=1.0, help="fraction of requests sent as sampled")
+    parser.add_argument("--slowest", type=int, default=10, help="slowest requests to report")
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds per timeline row")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_out", help="write the report to this file")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(
+        args.url, args.rate, args.duration, warmup=args.warmup, connections=args.connections,
+        timeout=args.timeout, arrival=args.arrival, sample_ratio=args.sample_ratio,
+        slowest=args.slowest, interval=args.interval, seed=args.seed,
+    )
+    report = asyncio.run(generator.run())
+    _print_report(report)
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
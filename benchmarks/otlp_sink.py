@@ -0,0 +1,224 @@
+"""
+Local OTLP receiver (gRPC and HTTP/protobuf) standing in for the collector
+
+Accepts trace, metric and log exports, counts spans, metric data points and
+log records, and discards them. Latency, errors and backpressure can be
+injected to see how the services' exporters behave when the collector is slow
+or refuses data:
+
+- latency:            seconds to wait before answering each export
+- error_rate:         fraction of exports failing with UNAVAILABLE / HTTP 503
+- max_items_per_sec:  token bucket over all signals; exports beyond it are
+                      refused with RESOURCE_EXHAUSTED / HTTP 429 + Retry-After,
+                      the OTLP throttling signal
+
+Errors are drawn from a seeded random generator so runs are repeatable.
+`stats()` reports per signal the accepted / refused exports and items, bytes,
+mean batch size and items per second since start (or the last `reset()`),
+i.e. the exporters' effective throughput.
+"""
+import gzip
+import random
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+from opentelemetry.proto.collector.logs.v1 import logs_service_pb2, logs_service_pb2_grpc
+from opentelemetry.proto.collector.metrics.v1 import metrics_service_pb2, metrics_service_pb2_grpc
+from opentelemetry.proto.collector.trace.v1 import trace_service_pb2, trace_service_pb2_grpc
+
+# signal -> (request type, response type, OTLP/HTTP path)
+_SIGNALS = {
+    "traces": (trace_service_pb2.ExportTraceServiceRequest, trace_service_pb2.ExportTraceServiceResponse,
+               "/v1/traces"),
+    "metrics": (metrics_service_pb2.ExportMetricsServiceRequest, metrics_service_pb2.ExportMetricsServiceResponse,
+                "/v1/metrics"),
+    "logs": (logs_service_pb2.ExportLogsServiceRequest, logs_service_pb2.ExportLogsServiceResponse,
+             "/v1/logs"),
+}
+
+
+def _count_items(signal, request):
+    """Spans, metric data points or log records in an export request"""
+    if signal == "traces":
+        return sum(len(ss.spans) for rs in request.resource_spans for ss in rs.scope_spans)
+    if signal == "logs":
+        return sum(len(sl.log_records) for rl in request.resource_logs for sl in rl.scope_logs)
+    points = 0
+    for rm in request.resource_metrics:
+        for sm in rm.scope_metrics:
+            for metric in sm.metrics:
+                data = getattr(metric, metric.WhichOneof("data"))
+                points += len(data.data_points)
+    return points
+
+
+class _SignalStats:
+    def __init__(self):
+        self.exports = 0
+        self.items = 0
+        self.bytes = 0
+        self.refused_exports = 0
+        self.refused_items = 0
+        self.failed_exports = 0
+
+    def as_dict(self, elapsed):
+        return {
+            "exports": self.exports,
+            "items": self.items,
+            "bytes": self.bytes,
+            "refused_exports": self.refused_exports,
+            "refused_items": self.refused_items,
+            "failed_exports": self.failed_exports,
+            "mean_batch_size": round(self.items / self.exports, 1) if self.exports else 0.0,
+            "items_per_sec": round(self.items / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+class OtlpReceiver:
+    """
+    OTLP gRPC / HTTP receiver with counters and fault injection
+
+    Args:
+        latency: seconds to wait before answering each export
+        error_rate: fraction of exports answered with UNAVAILABLE / 503
+        max_items_per_sec: refuse exports beyond this many items per second (0: unlimited)
+        seed: seed of the error injection
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, max_items_per_sec=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_items_per_sec = max_items_per_sec
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._grpc_server = None
+        self._http_server = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {signal: _SignalStats() for signal in _SIGNALS}
+            self._started = time.monotonic()
+            self._tokens = float(self.max_items_per_sec)
+            self._refilled = self._started
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                "elapsed_s": round(elapsed, 3),
+                **{signal: s.as_dict(elapsed) for signal, s in self._stats.items()},
+            }
+
+    def _admit(self, items):
+        """Token bucket: True if `items` fit into the configured rate"""
+        if not self.max_items_per_sec:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.max_items_per_sec, self._tokens + (now - self._refilled) * self.max_items_per_sec)
+        self._refilled = now
+        if self._tokens < items:
+            return False
+        self._tokens -= items
+        return True
+
+    def handle(self, signal, request, size):
+        """Account one export; returns "ok", "refused" or "failed" """
+        items = _count_items(signal, request)
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            stats = self._stats[signal]
+            if not self._admit(items):
+                stats.refused_exports += 1
+                stats.refused_items += items
+                return "refused"
+            if self.error_rate and self._rnd.random() < self.error_rate:
+                stats.failed_exports += 1
+                return "failed"
+            stats.exports += 1
+            stats.items += items
+            stats.bytes += size
+            return "ok"
+
+    def start(self, grpc_port=4317, http_port=None):
+        """Listen for OTLP/gRPC on 127.0.0.1:`grpc_port` and, if given, OTLP/HTTP on `http_port`"""
+        self._grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+        trace_service_pb2_grpc.add_TraceServiceServicer_to_server(_GrpcService(self, "traces"), self._grpc_server)
+        metrics_service_pb2_grpc.add_MetricsServiceServicer_to_server(_GrpcService(self, "metrics"), self._grpc_server)
+        logs_service_pb2_grpc.add_LogsServiceServicer_to_server(_GrpcService(self, "logs"), self._grpc_server)
+        self._grpc_server.add_insecure_port(f"127.0.0.1:{grpc_port}")
+        self._grpc_server.start()
+
+        if http_port:
+            handler = type("_Handler", (_HttpHandler,), {"receiver": self})
+            self._http_server = ThreadingHTTPServer(("127.0.0.1", http_port), handler)
+            self._http_server.daemon_threads = True
+            threading.Thread(target=self._http_server.serve_forever, name="otlp-http", daemon=True).start()
+        return self
+
+    def stop(self, grace=None):
+        if self._grpc_server is not None:
+            self._grpc_server.stop(grace)
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+
+
+class _GrpcService:
+    """Servicer for any of the three OTLP services (they all have one Export method)"""
+
+    def __init__(self, receiver, signal):
+        self.receiver = receiver
+        self.signal = signal
+        self.response = _SIGNALS[signal][1]
+
+    def Export(self, request, context):
+        outcome = self.receiver.handle(self.signal, request, request.ByteSize())
+        if outcome == "refused":
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "receiver over capacity")
+        elif outcome == "failed":
+            context.abort(grpc.StatusCode.UNAVAILABLE, "injected failure")
+        return self.response()
+
+
+class _HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    receiver = None
+
+    def do_POST(self):
+        signal = next((s for s, (_, _, path) in _SIGNALS.items() if path == self.path), None)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if signal is None:
+            self._reply(404, b"")
+            return
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        request_type, response_type, _ = _SIGNALS[signal]
+        outcome = self.receiver.handle(signal, request_type.FromString(body), len(body))
+        if outcome == "refused":
+            self._reply(429, b"", {"Retry-After": "1"})
+        elif outcome == "failed":
+            self._reply(503, b"")
+        else:
+            self._reply(200, response_type().SerializeToString())
+
+    def _reply(self, status, payload, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-protobuf")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_otlp_sink(port=4317, http_port=None):
+    """Start a receiver without fault injection on 127.0.0.1:`port` and return it"""
+    return OtlpReceiver().start(grpc_port=port, http_port=http_port)
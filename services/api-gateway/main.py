@@ -3,76 +3,106 @@ API Gateway - 统一的请求入口
 使用 OpenTelemetry 自动埋点
 """
 import os
+import asyncio
+import json
 import logging
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+import time
+from functools import partial
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import httpx
 from opentelemetry import trace, metrics
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
-from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME, SERVICE_VERSION
-from opentelemetry.instrumentation.logging import LoggingInstrumentor
-from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
-from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='{"time":"%(asctime)s", "level":"%(levelname)s", "service":"api-gateway", "trace_id":"%(otelTraceID)s", "span_id":"%(otelSpanID)s", "message":"%(message)s"}'
+from o11y_common.adaptivetimeout import AdaptiveTimeouts
+from o11y_common.bootstrap import (
+    TelemetryBootstrap, instrument_fastapi, instrument_httpx, instrument_httpx_client, worker_count,
 )
+from o11y_common.deadline import Deadline, DeadlineExceeded, DeadlineMiddleware, current_deadline
+from o11y_common.health import HealthChecks, exporter_backlog_check, http_check, install_probe_log_filter
+from o11y_common.jsonlog import configure_logging
+from o11y_common.lazylog import Truncated, install_hot_path_filters
+from o11y_common.loopmonitor import LoopMonitor, loop_monitor_views
+from o11y_common.profiler import SpanProfiler
+from o11y_common.spanbudget import SpanBudgetProcessor
+from o11y_common.views import HistogramView, REQUEST_BUCKETS
+
+configure_logging("api-gateway")
 logger = logging.getLogger(__name__)
+# 热路径日志: 按调用点限流, 未采样的 trace 只保留 WARNING 及以上
+install_hot_path_filters(
+    logger,
+    rate=float(os.getenv("LOG_CALLSITE_RATE", "10")),
+    unsampled_level=os.getenv("LOG_UNSAMPLED_LEVEL", "WARNING"),
+)
+# 探针请求 (/health, /health/live, /health/ready) 不写 access log
+install_probe_log_filter()
 
 # 配置 OpenTelemetry
 SERVICE_A_URL = os.getenv("SERVICE_A_URL", "http://service-a:8001")
 OTEL_COLLECTOR_ENDPOINT = os.getenv("OTEL_COLLECTOR_ENDPOINT", "http://otel-collector:4317")
+# 每个请求的时间预算, 经 x-request-budget-ms header 传给下游 (客户端可以要求更短的预算)
+REQUEST_BUDGET_SECONDS = float(os.getenv("REQUEST_BUDGET_SECONDS", "30"))
+# POST /api/process/batch: 每批最多的 item 数, 同时发往 Service A 的请求数, 每个 item 的超时
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_ITEM_TIMEOUT_SECONDS = float(os.getenv("BATCH_ITEM_TIMEOUT_SECONDS", "10"))
+# WEB_CONCURRENCY > 1: 多 worker 进程, 每个 worker 启动后各自初始化 telemetry
+WORKERS = worker_count()
 
-resource = Resource(attributes={
-    SERVICE_NAME: "api-gateway",
-    SERVICE_VERSION: "1.0.0",
-    "service.namespace": "o11y-lab",
-    "deployment.environment": "lab"
-})
-
-# 配置 Tracer Provider
-trace_provider = TracerProvider(resource=resource)
-trace_provider.add_span_processor(
-    BatchSpanProcessor(OTLPSpanExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True))
-)
-trace.set_tracer_provider(trace_provider)
+app = FastAPI(title="API Gateway", version="1.0.0")
+app.add_middleware(DeadlineMiddleware, default_budget=REQUEST_BUDGET_SECONDS)
 
-# 配置 Meter Provider
-metric_reader = PeriodicExportingMetricReader(
-    OTLPMetricExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True)
-)
-meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
-metrics.set_meter_provider(meter_provider)
+# 采样 profiler (PROFILER_HZ > 0 时启用), 样本按 span / trace 归类
+profiler = SpanProfiler("api-gateway")
+# 导出前按规则删除 / 截断 / hash span 属性, 限制属性与事件数 (SPAN_BUDGET=true 时启用)
+span_budget = SpanBudgetProcessor()
 
-# 配置 Logger Provider for OTLP log export
-logger_provider = LoggerProvider(resource=resource)
-logger_provider.add_log_record_processor(
-    BatchLogRecordProcessor(OTLPLogExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True))
+# batch 的 item 共用一个连接池, 连接数与并发数一致
+# lazy / 多 worker 模式下 instrument_httpx 在创建之后才执行, 所以由 instrument_httpx_client 单独埋点
+service_a_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=BATCH_CONCURRENCY, max_keepalive_connections=BATCH_CONCURRENCY)
 )
 
-handler = LoggingHandler(level=logging.NOTSET, logger_provider=logger_provider)
-logging.getLogger().addHandler(handler)
-
-LoggingInstrumentor().instrument(set_logging_format=True)
-
-app = FastAPI(title="API Gateway", version="1.0.0")
-
-FastAPIInstrumentor.instrument_app(app)
+# Tracer / Meter / Logger Provider + FastAPI, HTTPX 自动埋点
+telemetry = TelemetryBootstrap(
+    resource_attributes={
+        "service.name": "api-gateway",
+        "service.version": "1.0.0",
+        "service.namespace": "o11y-lab",
+        "deployment.environment": "lab"
+    },
+    endpoint=OTEL_COLLECTOR_ENDPOINT,
+    per_worker=WORKERS > 1,
+    span_processors=profiler.span_processors() + span_budget.span_processors(),
+    views=[
+        HistogramView(
+            "gateway_request_duration_seconds", REQUEST_BUCKETS,
+            attribute_keys={"endpoint", "method", "status"},
+        ),
+        *loop_monitor_views(),
+    ],
+    instrumentors=[
+        partial(instrument_fastapi, app), partial(instrument_httpx_client, service_a_client), instrument_httpx,
+    ],
+)
+# OTEL_LAZY_INIT=true 或多 worker 时延迟到 startup 初始化
+telemetry.init_at_import()
 
-HTTPXClientInstrumentor().instrument()
+# Event loop 延迟 / 阻塞调用监控 (LOOP_MONITOR_INTERVAL, LOOP_SLOW_CALLBACK_THRESHOLD)
+loop_monitor = LoopMonitor()
 
 tracer = trace.get_tracer(__name__)
 meter = metrics.get_meter(__name__)
 
+# 依赖检查在后台定期执行 (HEALTH_CHECK_INTERVAL), /health/ready 直接返回缓存的结果
+# Service A 不可用只算 degraded: gateway 本身仍可接收请求
+health_checks = HealthChecks("api-gateway")
+health_checks.add("service_a", http_check(f"{SERVICE_A_URL}/health/live"), critical=False)
+health_checks.add("exporter_backlog", exporter_backlog_check(telemetry), critical=False)
+
+# 下游超时 = 观测到的 p99 x 倍数, 限制在 floor / ceiling 之间 (ADAPTIVE_TIMEOUTS=false: 固定 ceiling)
+timeouts = AdaptiveTimeouts(timeout_errors=(httpx.TimeoutException, asyncio.TimeoutError))
+service_a_timeout = timeouts.downstream("service_a", floor=2.0, ceiling=30.0)
+
 request_counter = meter.create_counter(
     name="gateway_requests_total",
     description="Total number of requests received by gateway",
@@ -85,17 +115,52 @@ request_duration = meter.create_histogram(
     unit="s"
 )
 
+batch_item_counter = meter.create_counter(
+    name="gateway_batch_items_total",
+    description="Items of /api/process/batch requests by result",
+    unit="1"
+)
+
+@app.on_event("startup")
+async def startup_event():
+    """Initialize telemetry in lazy / multi-worker mode"""
+    telemetry.init_at_startup()
+    if not telemetry.disabled:
+        loop_monitor.start()
+        profiler.start()
+    health_checks.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the pooled Service A client"""
+    health_checks.stop()
+    await service_a_client.aclose()
+
 @app.get("/health")
 async def health():
-    """Health check endpoint"""
-    logger.info("Health check called")
-    return {"status": "healthy", "service": "api-gateway"}
+    """Liveness check endpoint (kept for existing probes), not logged or traced"""
+    return health_checks.live()[1]
+
+@app.get("/health/live")
+async def health_live():
+    """Liveness: 进程能处理请求即可"""
+    code, body = health_checks.live()
+    return JSONResponse(body, status_code=code)
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness: 后台依赖检查的缓存结果"""
+    code, body = health_checks.ready()
+    return JSONResponse(body, status_code=code)
 
 @app.get("/api/process")
 async def process_request():
     """
     Main API endpoint that processes requests by calling Service A
     """
+    start_time = time.time()
+    status = "error"
+    deadline = current_deadline()
     logger.info("Received process request at gateway")
 
     request_counter.add(1, {"endpoint": "/api/process", "method": "GET"})
@@ -105,27 +170,37 @@ async def process_request():
         span.set_attribute("gateway.version", "1.0.0")
 
         try:
-            logger.info(f"Calling Service A at {SERVICE_A_URL}/process")
+            deadline.check("call_service_a")
+            logger.info("Calling Service A at %s/process", SERVICE_A_URL)
 
             async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{SERVICE_A_URL}/process",
-                    timeout=30.0
-                )
+                try:
+                    with service_a_timeout.track(deadline) as timeout:
+                        response = await client.get(
+                            f"{SERVICE_A_URL}/process",
+                            headers=deadline.headers(),
+                            timeout=timeout
+                        )
+                except httpx.TimeoutException:
+                    # 预算用完时的超时: 对 Service A 的调用被取消
+                    if deadline.expired():
+                        raise deadline.exceeded("call_service_a")
+                    raise
 
                 span.set_attribute("http.status_code", response.status_code)
 
                 if response.status_code == 200:
                     result = response.json()
-                    logger.info(f"Successfully received response from Service A: {result}")
+                    logger.info("Successfully received response from Service A: %s", Truncated(result))
                     span.set_attribute("response.status", "success")
+                    status = "success"
                     return {
                         "status": "success",
                         "message": "Request processed through gateway",
                         "data": result
                     }
                 else:
-                    logger.error(f"Service A returned error: {response.status_code}")
+                    logger.error("Service A returned error: %s", response.status_code)
                     span.set_attribute("response.status", "error")
                     span.set_attribute("error", True)
                     raise HTTPException(
@@ -133,8 +208,12 @@ async def process_request():
                         detail=f"Service A returned error: {response.text}"
                     )
 
+        except DeadlineExceeded as e:
+            logger.warning("Request budget exhausted: %s", e)
+            span.set_attribute("error", True)
+            raise HTTPException(status_code=504, detail=str(e))
         except httpx.RequestError as e:
-            logger.error(f"Failed to connect to Service A: {str(e)}", exc_info=True)
+            logger.error("Failed to connect to Service A: %s", e, exc_info=True)
             span.set_attribute("error", True)
             span.set_attribute("error.type", type(e).__name__)
             span.set_attribute("error.message", str(e))
@@ -142,6 +221,125 @@ async def process_request():
                 status_code=503,
                 detail=f"Failed to connect to Service A: {str(e)}"
             )
+        finally:
+            request_duration.record(time.time() - start_time, {"endpoint": "/api/process", "status": status})
+
+async def process_batch_item(index, item, deadline):
+    """处理 batch 中的一个 item: 在自己的 span 与预算 (BATCH_ITEM_TIMEOUT_SECONDS) 内调用 Service A"""
+    start_time = time.time()
+    result = {"index": index, "id": item.get("id", index)}
+    with tracer.start_as_current_span("gateway.process_batch.item") as span:
+        span.set_attribute("batch.item.index", index)
+        # item 的预算: 单个 item 的超时与整批剩余预算中较短者, 同样传给 Service A
+        item_deadline = Deadline(max(0.0, min(BATCH_ITEM_TIMEOUT_SECONDS, deadline.remaining())))
+        try:
+            item_deadline.check("call_service_a")
+            with service_a_timeout.track(item_deadline) as timeout:
+                response = await asyncio.wait_for(
+                    service_a_client.get(
+                        f"{SERVICE_A_URL}/process",
+                        headers=item_deadline.headers(),
+                        timeout=timeout
+                    ),
+                    item_deadline.remaining()
+                )
+            span.set_attribute("http.status_code", response.status_code)
+            result["status_code"] = response.status_code
+            if response.status_code == 200:
+                result["status"] = "success"
+                result["data"] = response.json()
+            else:
+                result["status"] = "error"
+                result["error"] = f"Service A returned error: {response.text}"
+        except DeadlineExceeded as e:
+            result["status"] = "timeout"
+            result["error"] = str(e)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            result["status"] = "timeout"
+            result["error"] = str(item_deadline.exceeded("call_service_a"))
+        except httpx.RequestError as e:
+            result["status"] = "error"
+            result["error"] = f"Failed to connect to Service A: {e}"
+            span.set_attribute("error.type", type(e).__name__)
+        except Exception as e:
+            # 其余 item 不受影响, 该 item 记为失败
+            logger.error("Batch item %s failed: %s", index, e, exc_info=True)
+            result["status"] = "error"
+            result["error"] = str(e)
+            span.set_attribute("error.type", type(e).__name__)
+        span.set_attribute("response.status", result["status"])
+        if result["status"] != "success":
+            span.set_attribute("error", True)
+            logger.warning("Batch item %s failed: %s", index, Truncated(result["error"]))
+    batch_item_counter.add(1, {"status": result["status"]})
+    result["duration_ms"] = int((time.time() - start_time) * 1000)
+    return result
+
+async def stream_batch(items, deadline):
+    """
+    BATCH_CONCURRENCY 个 worker 依次取 item 调用 Service A, 结果按完成顺序输出为 NDJSON,
+    最后一行为汇总
+    """
+    start_time = time.time()
+    status = "error"
+    with tracer.start_as_current_span("gateway.process_batch") as span:
+        span.set_attribute("endpoint", "/api/process/batch")
+        span.set_attribute("batch.items", len(items))
+        span.set_attribute("batch.concurrency", BATCH_CONCURRENCY)
+
+        pending = asyncio.Queue()
+        for index, item in enumerate(items):
+            pending.put_nowait((index, item))
+        results = asyncio.Queue()
+
+        async def worker():
+            while not pending.empty():
+                index, item = pending.get_nowait()
+                await results.put(await process_batch_item(index, item, deadline))
+
+        # worker 在当前 context 中创建, item span 都是 batch span 的子 span
+        workers = [asyncio.create_task(worker()) for _ in range(min(BATCH_CONCURRENCY, len(items)))]
+        counts = {}
+        try:
+            for _ in range(len(items)):
+                result = await results.get()
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+                yield json.dumps(result) + "\n"
+            status = "success" if counts.get("success") == len(items) else "partial"
+            for name, count in counts.items():
+                span.set_attribute(f"batch.items.{name}", count)
+            yield json.dumps({
+                "summary": {
+                    "items": len(items),
+                    **counts,
+                    "duration_ms": int((time.time() - start_time) * 1000)
+                }
+            }) + "\n"
+        finally:
+            # 客户端断开时不再调用剩余的 item
+            for task in workers:
+                task.cancel()
+            request_duration.record(time.time() - start_time, {"endpoint": "/api/process/batch", "status": status})
+
+@app.post("/api/process/batch")
+async def process_batch(request: Request):
+    """
+    Batch API endpoint: {"items": [{"id": ...}, ...]}, each item processed by Service A
+    Streams one NDJSON line per item as it finishes, then a summary line
+    """
+    request_counter.add(1, {"endpoint": "/api/process/batch", "method": "POST"})
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be JSON")
+    items = body.get("items") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        raise HTTPException(status_code=400, detail='Expected {"items": [{...}, ...]} with at least one item')
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+
+    logger.info("Received batch of %d items at gateway", len(items))
+    return StreamingResponse(stream_batch(items, current_deadline()), media_type="application/x-ndjson")
 
 @app.get("/api/info")
 async def get_info():
@@ -157,6 +355,20 @@ async def get_info():
         }
     }
 
+@app.get("/debug/profile")
+async def debug_profile(endpoint: str = None, trace_id: str = None, span_id: str = None, format: str = "folded"):
+    """采样 profiler 的 folded stacks (µs), 可按 endpoint 或 trace_id / span_id 过滤"""
+    if not profiler.enabled:
+        raise HTTPException(status_code=404, detail="Profiler disabled, set PROFILER_HZ")
+    filters = {"endpoint": endpoint, "trace_id": trace_id, "span_id": span_id}
+    if format == "json":
+        return profiler.report(**filters)
+    return PlainTextResponse(profiler.folded(**filters))
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    if WORKERS > 1:
+        # worker 进程重新 import main, telemetry 在各自的 startup 中初始化
+        uvicorn.run("main:app", host="0.0.0.0", port=8080, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,7 @@
+"""
+o11y_common - shared telemetry helpers for the Python services
+
+Copied into the api-gateway, service-a and service-d images next to main.py.
+Submodules are imported explicitly by each service so that nothing here is
+loaded unless it is actually used.
+"""
@@ -0,0 +1,172 @@
+"""
+Outbound call timeouts derived from the observed downstream latency
+
+A fixed timeout is either loose enough for the slowest downstream on its
+worst day (a hung connection holds the request for 30s) or tight enough to
+cut healthy calls during normal jitter. AdaptiveTimeouts keeps, per
+downstream, the latencies of the last `window` calls and sets the timeout to
+
+    clamp(multiplier * quantile(latencies), floor, ceiling)
+
+recomputed every few calls. Until `min_samples` calls were observed the
+ceiling applies, so a new process starts with the old fixed timeout.
+
+Only answered calls are observed. Counting timed-out calls with the timeout
+as their latency would let a few hung calls (more than 1% for the p99) drive
+the timeout up to the ceiling, which is when it is needed most. A downstream
+that slows down gradually raises its timeout: calls up to `multiplier` times
+the old quantile answer and move the quantile up. One that steps above the
+timeout at once gets no answered call in: after `_WIDEN_AFTER` consecutive
+timeouts the timeout is doubled (up to the ceiling) and the latencies observed
+so far are discarded, so the timeout holds until `min_samples` calls of the
+new regime are observed.
+
+Pass the request's Deadline (o11y_common.deadline) to track() and the yielded
+timeout is also bounded by the remaining budget. A call cut short by the
+budget is the caller's deadline, not the downstream's timeout: it is not
+counted in downstream_timeouts_total (see request_deadline_exceeded_total)
+and does not widen the timeout.
+
+    timeouts = AdaptiveTimeouts(timeout_errors=(httpx.TimeoutException,))
+    service_d = timeouts.downstream("service_d", floor=1.0, ceiling=10.0)
+
+    with service_d.track(deadline) as timeout:
+        response = await client.get(url, timeout=timeout)
+
+Metrics, per `downstream`:
+
+    downstream_timeout_seconds                 gauge, current timeout
+    downstream_latency_quantile_seconds        gauge, observed quantile
+    downstream_timeouts_total                  counter
+
+Configured with ADAPTIVE_TIMEOUTS (false: always the ceiling),
+ADAPTIVE_TIMEOUT_MULTIPLIER, ADAPTIVE_TIMEOUT_QUANTILE and
+ADAPTIVE_TIMEOUT_MIN_SAMPLES.
+"""
+import contextlib
+import math
+import os
+import time
+from collections import deque
+
+from opentelemetry import metrics
+
+_RECOMPUTE_EVERY = 16
+# Consecutive timeouts after which the timeout is widened
+_WIDEN_AFTER = 3
+
+
+def adaptive_timeouts_enabled():
+    return os.getenv("ADAPTIVE_TIMEOUTS", "true").lower() == "true"
+
+
+class AdaptiveTimeouts:
+    """
+    Registry of the per-downstream timeouts of one service
+
+    Args:
+        timeout_errors: exception types raised by the client when a call times out
+        multiplier: timeout = multiplier * observed quantile (ADAPTIVE_TIMEOUT_MULTIPLIER, default 3)
+        quantile: latency quantile tracked (ADAPTIVE_TIMEOUT_QUANTILE, default 0.99)
+        min_samples: calls observed before leaving the ceiling (ADAPTIVE_TIMEOUT_MIN_SAMPLES, default 50)
+        window: latest calls the quantile is computed from
+    """
+
+    def __init__(self, timeout_errors=(TimeoutError,), multiplier=None, quantile=None, min_samples=None,
+                 window=1000):
+        self.timeout_errors = tuple(timeout_errors)
+        self.enabled = adaptive_timeouts_enabled()
+        self.multiplier = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "3")) if multiplier is None else multiplier
+        self.quantile = float(os.getenv("ADAPTIVE_TIMEOUT_QUANTILE", "0.99")) if quantile is None else quantile
+        self.min_samples = (
+            int(os.getenv("ADAPTIVE_TIMEOUT_MIN_SAMPLES", "50")) if min_samples is None else min_samples
+        )
+        self.window = window
+        self._downstreams = {}
+
+        meter = metrics.get_meter(__name__)
+        self.timeouts = meter.create_counter(
+            "downstream_timeouts_total", description="Outbound calls that timed out", unit="1",
+        )
+        meter.create_observable_gauge(
+            "downstream_timeout_seconds", callbacks=[self._observe_timeouts],
+            description="Current timeout of the calls to a downstream", unit="s",
+        )
+        meter.create_observable_gauge(
+            "downstream_latency_quantile_seconds", callbacks=[self._observe_quantiles],
+            description="Observed latency quantile the timeout is derived from", unit="s",
+        )
+
+    def downstream(self, name, floor, ceiling):
+        """Timeout of the calls to one downstream, between `floor` and `ceiling` seconds"""
+        if floor > ceiling:
+            raise ValueError(f"{name}: timeout floor {floor} is above the ceiling {ceiling}")
+        timeout = self._downstreams[name] = DownstreamTimeout(self, name, floor, ceiling)
+        return timeout
+
+    def _observe_timeouts(self, options):
+        return [metrics.Observation(d.current(), {"downstream": d.name}) for d in self._downstreams.values()]
+
+    def _observe_quantiles(self, options):
+        return [
+            metrics.Observation(d.latency_quantile, {"downstream": d.name, "quantile": str(self.quantile)})
+            for d in self._downstreams.values() if d.latency_quantile is not None
+        ]
+
+
+class DownstreamTimeout:
+    def __init__(self, registry, name, floor, ceiling):
+        self.registry = registry
+        self.name = name
+        self.floor = floor
+        self.ceiling = ceiling
+        self.latency_quantile = None
+        self._latencies = deque(maxlen=registry.window)
+        self._observed = 0
+        self._timeout = ceiling
+        self._consecutive_timeouts = 0
+        self._attributes = {"downstream": name}
+
+    def current(self):
+        return self._timeout
+
+    @contextlib.contextmanager
+    def track(self, deadline=None):
+        """Yield the timeout for one call, bounded by `deadline` if given, and observe how long the call took"""
+        adaptive = self._timeout
+        timeout = adaptive if deadline is None else deadline.timeout(adaptive)
+        start = time.monotonic()
+        try:
+            yield timeout
+        except self.registry.timeout_errors:
+            # Only when the adaptive timeout was the one in force, not the budget
+            if timeout >= adaptive:
+                self.registry.timeouts.add(1, self._attributes)
+                self._timed_out()
+            raise
+        self._consecutive_timeouts = 0
+        self.observe(time.monotonic() - start)
+
+    def _timed_out(self):
+        self._consecutive_timeouts += 1
+        if (self.registry.enabled and self._consecutive_timeouts >= _WIDEN_AFTER
+                and self._timeout < self.ceiling):
+            self._timeout = min(self.ceiling, 2 * self._timeout)
+            self._consecutive_timeouts = 0
+            # The latencies seen so far no longer describe the downstream
+            self._latencies.clear()
+            self._observed = 0
+
+    def observe(self, latency):
+        self._latencies.append(latency)
+        self._observed += 1
+        if self._observed % _RECOMPUTE_EVERY == 0:
+            self._recompute()
+
+    def _recompute(self):
+        registry = self.registry
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, math.ceil(registry.quantile * len(latencies)) - 1)
+        self.latency_quantile = latencies[index]
+        if registry.enabled and len(latencies) >= registry.min_samples:
+            self._timeout = min(self.ceiling, max(self.floor, registry.multiplier * self.latency_quantile))
@@ -0,0 +1,315 @@
+"""
+Telemetry bootstrap with lazy (deferred) and per-worker startup modes
+
+Every service used to import the whole SDK, three OTLP gRPC exporters and all
+instrumentors at module import and create the providers before the app object
+existed. TelemetryBootstrap keeps that setup in one place and can run it
+
+- eagerly:    at import time (previous behavior)
+- lazily:     on a background thread from the server startup hook, so the
+              server binds and answers /health while the SDK is still being
+              imported (OTEL_LAZY_INIT=true)
+- per worker: from the startup hook of every worker process (WEB_CONCURRENCY > 1).
+              Exporter threads and gRPC channels do not survive fork(), so the
+              providers must never be created in the supervisor process. Each
+              worker gets its own service.instance.id so that cumulative metric
+              series of different workers do not overwrite each other.
+
+Services call `init_at_import()` after creating the app and `init_at_startup()`
+from their startup hook; the mode decides which of the two does the work.
+OTEL_SDK_DISABLED=true skips initialization altogether (no providers, no
+instrumentors), which is the "no instrumentation" baseline of the benchmarks.
+
+Module level `trace.get_tracer()` / `metrics.get_meter()` calls keep working in
+lazy mode: the API returns proxy tracers and instruments that switch to the
+real SDK objects once the providers are set.
+
+Only the OpenTelemetry API is imported by this module, the SDK, exporters and
+instrumentation packages are imported inside `init()`.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def lazy_init_enabled():
+    """OTEL_LAZY_INIT=true selects the deferred startup mode"""
+    return os.getenv("OTEL_LAZY_INIT", "false").lower() == "true"
+
+
+def sdk_disabled():
+    """OTEL_SDK_DISABLED=true turns telemetry off (OpenTelemetry SDK environment variable)"""
+    return os.getenv("OTEL_SDK_DISABLED", "false").lower() == "true"
+
+
+def self_telemetry_enabled():
+    """OTEL_SELF_TELEMETRY=false turns off the export pipeline metrics (o11y_common.selftelemetry)"""
+    return os.getenv("OTEL_SELF_TELEMETRY", "true").lower() == "true"
+
+
+def worker_count():
+    """Number of server worker processes (WEB_CONCURRENCY, also read by gunicorn)"""
+    return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
+class TelemetryBootstrap:
+    """
+    Create tracer / meter / logger providers with OTLP gRPC exporters and run instrumentors
+
+    Args:
+        resource_attributes: attributes of the SDK Resource
+        endpoint: OTLP gRPC collector endpoint
+        instrumentors: callables run once the providers are installed
+            (see instrument_fastapi / instrument_httpx / ... below)
+        warm_channels: open a gRPC connection to the collector in the background
+            so the first export does not pay for DNS + TCP + HTTP/2 setup
+        lazy: initialize on a background thread at startup (default: OTEL_LAZY_INIT)
+        per_worker: the server runs several worker processes; initialize in each
+            worker at startup and label the resource with the worker's pid
+        views: o11y_common.views.HistogramView objects for the MeterProvider
+        self_telemetry: export queue / drop / export latency metrics of the
+            processors and exporters themselves (default: OTEL_SELF_TELEMETRY)
+        span_processors: extra span processors added before the exporting one
+    """
+
+    def __init__(self, resource_attributes, endpoint, instrumentors=(), warm_channels=True,
+                 lazy=None, per_worker=False, views=(), self_telemetry=None,
+                 span_processors=()):
+        self.resource_attributes = dict(resource_attributes)
+        self.endpoint = endpoint
+        self.instrumentors = list(instrumentors)
+        self.warm_channels = warm_channels
+        self.lazy = lazy_init_enabled() if lazy is None else lazy
+        self.per_worker = per_worker
+        self.views = list(views)
+        self.self_telemetry = self_telemetry_enabled() if self_telemetry is None else self_telemetry
+        self.span_processors = list(span_processors)
+        self.disabled = sdk_disabled()
+
+        self.tracer_provider = None
+        self.meter_provider = None
+        self.logger_provider = None
+        # Exporting processors, whose queues the health checks read
+        self.span_processor = None
+        self.log_processor = None
+        # Step name -> seconds, exposed for the startup benchmark
+        self.timings = {}
+        self.ready = threading.Event()
+
+        self._lock = threading.Lock()
+        self._warm_channel = None
+        self._pid = None
+
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._check_after_fork)
+
+    def _check_after_fork(self):
+        if self.ready.is_set() and self._pid != os.getpid():
+            logger.warning(
+                "Telemetry was initialized before fork (pid %s); exporters will not work in "
+                "worker %s. Set WEB_CONCURRENCY so initialization happens per worker.",
+                self._pid, os.getpid(),
+            )
+
+    def init_at_import(self):
+        """Initialize now unless the mode defers initialization to startup"""
+        if not (self.disabled or self.lazy or self.per_worker):
+            self.init()
+
+    def init_at_startup(self):
+        """Called from the server startup hook (once per worker process)"""
+        if self.disabled:
+            logger.info("OTEL_SDK_DISABLED=true, telemetry not initialized")
+        elif self.lazy:
+            self.init_in_background()
+        elif self.per_worker:
+            self.init()
+
+    def _timed(self, name, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.timings[name] = time.perf_counter() - start
+        return result
+
+    def init(self):
+        """Create the providers and run the instrumentors; safe to call more than once"""
+        with self._lock:
+            if self.ready.is_set():
+                return
+            start = time.perf_counter()
+            self._pid = os.getpid()
+            self._timed("providers", self._init_providers)
+            for instrument in self.instrumentors:
+                name = getattr(instrument, "func", instrument).__name__
+                self._timed(name, instrument)
+            self.timings["total"] = time.perf_counter() - start
+            self.ready.set()
+
+        if self.warm_channels:
+            threading.Thread(target=self._warm_up, name="otel-warmup", daemon=True).start()
+
+    def init_in_background(self):
+        """Run init() on a daemon thread and return immediately"""
+        thread = threading.Thread(target=self._init_logged, name="otel-init", daemon=True)
+        thread.start()
+        return thread
+
+    def _init_logged(self):
+        try:
+            self.init()
+            logger.info("Telemetry initialized in %.3fs", self.timings["total"])
+        except Exception:
+            logger.exception("Telemetry initialization failed")
+
+    def _init_providers(self):
+        from opentelemetry import trace, metrics
+        from opentelemetry._logs import set_logger_provider
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
+        from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+        from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
+
+        attributes = dict(self.resource_attributes)
+        if self.per_worker:
+            attributes["service.instance.id"] = f"{socket.gethostname()}-{self._pid}"
+            attributes["process.pid"] = self._pid
+        resource = Resource(attributes=attributes)
+
+        span_exporter = OTLPSpanExporter(endpoint=self.endpoint, insecure=True)
+        metric_exporter = OTLPMetricExporter(endpoint=self.endpoint, insecure=True)
+        log_exporter = OTLPLogExporter(endpoint=self.endpoint, insecure=True)
+        views = list(self.views)
+        if self.self_telemetry:
+            from .selftelemetry import PipelineTelemetry, pipeline_views
+
+            pipeline = PipelineTelemetry()
+            span_processor = pipeline.span_processor(span_exporter)
+            metric_exporter = pipeline.metric_exporter(metric_exporter)
+            log_processor = pipeline.log_processor(log_exporter)
+            views += pipeline_views()
+        else:
+            span_processor = BatchSpanProcessor(span_exporter)
+            log_processor = BatchLogRecordProcessor(log_exporter)
+
+        self.span_processor = span_processor
+        self.log_processor = log_processor
+        self.tracer_provider = TracerProvider(resource=resource)
+        for processor in self.span_processors:
+            self.tracer_provider.add_span_processor(processor)
+        self.tracer_provider.add_span_processor(span_processor)
+        trace.set_tracer_provider(self.tracer_provider)
+
+        metric_reader = PeriodicExportingMetricReader(metric_exporter)
+        self.meter_provider = MeterProvider(
+            resource=resource,
+            metric_readers=[metric_reader],
+            views=[view.to_sdk_view() for view in views],
+        )
+        metrics.set_meter_provider(self.meter_provider)
+
+        self.logger_provider = LoggerProvider(resource=resource)
+        self.logger_provider.add_log_record_processor(log_processor)
+        set_logger_provider(self.logger_provider)
+
+        handler = LoggingHandler(level=logging.NOTSET, logger_provider=self.logger_provider)
+        logging.getLogger().addHandler(handler)
+
+    def _warm_up(self):
+        """
+        Connect a channel to the collector and keep it open
+
+        gRPC shares subchannels between channels with the same target and
+        arguments, so the exporters' first RPC reuses this connection.
+        """
+        import grpc
+        from opentelemetry.exporter.otlp.proto.grpc.exporter import Compression
+
+        parsed = urlparse(self.endpoint)
+        target = parsed.netloc or self.endpoint
+        start = time.perf_counter()
+        try:
+            channel = grpc.insecure_channel(target, compression=Compression.NoCompression)
+            grpc.channel_ready_future(channel).result(timeout=10)
+            self._warm_channel = channel
+            self.timings["channel_warmup"] = time.perf_counter() - start
+        except Exception as e:
+            logger.warning("Collector channel warm-up failed: %s", e)
+
+    def shutdown(self):
+        """Flush and stop the providers"""
+        for provider in (self.tracer_provider, self.meter_provider, self.logger_provider):
+            if provider is not None:
+                provider.shutdown()
+        if self._warm_channel is not None:
+            self._warm_channel.close()
+
+
+def instrument_fastapi(app):
+    """
+    Add the OpenTelemetry ASGI middleware to a FastAPI app
+
+    Starlette refuses add_middleware() once the middleware stack has been built
+    (first lifespan/request), so in lazy mode the stack is rebuilt with the
+    middleware included, like FastAPIInstrumentor.uninstrument_app() does.
+    """
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+
+    from .health import excluded_urls
+
+    started = app.middleware_stack is not None
+    app.middleware_stack = None
+    # Probe requests get no spans
+    FastAPIInstrumentor.instrument_app(app, excluded_urls=excluded_urls())
+    if started:
+        app.middleware_stack = app.build_middleware_stack()
+
+
+def instrument_httpx():
+    from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+
+    HTTPXClientInstrumentor().instrument()
+
+
+def instrument_httpx_client(client):
+    """
+    instrument_httpx() swaps the httpx client classes, so clients created
+    before it ran (pooled clients created at import, in lazy / per-worker mode)
+    stay uninstrumented: no client span and no traceparent. This instruments
+    such an existing client. List it before instrument_httpx: instrument_client()
+    checks isinstance against httpx.AsyncClient, which instrument_httpx replaces.
+    """
+    from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+
+    if not getattr(client, "_is_instrumented_by_opentelemetry", False):
+        HTTPXClientInstrumentor.instrument_client(client)
+
+
+def instrument_psycopg2():
+    from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
+
+    # The images install psycopg2-binary, which provides the same module but not
+    # the "psycopg2" distribution the dependency check looks for
+    Psycopg2Instrumentor().instrument(skip_dep_check=True)
+
+
+def instrument_flask(app):
+    """
+    Flask forbids registering request hooks after the first request, so this
+    one has to run before the server starts even in lazy mode.
+    """
+    from opentelemetry.instrumentation.flask import FlaskInstrumentor
+
+    from .health import excluded_urls
+
+    FlaskInstrumentor().instrument_app(app, excluded_urls=excluded_urls())
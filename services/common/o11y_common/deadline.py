@@ -0,0 +1,172 @@
+"""
+Request deadlines propagated between the services
+
+The gateway gives every request a time budget (REQUEST_BUDGET_SECONDS). It
+travels to the next hop as the remaining budget in milliseconds in the
+`x-request-budget-ms` header, minus DEADLINE_HOP_MARGIN_MS so the callee gives
+up before its caller does. A relative budget, as gRPC's grpc-timeout, does
+not depend on the hosts' clocks agreeing.
+
+On the server side DeadlineMiddleware (ASGI) or install_flask_deadline()
+turn the header into a Deadline for the request, available through
+current_deadline(). Handlers use it to:
+
+- bound outgoing calls: `timeout=deadline.timeout(10.0)`,
+  `headers=deadline.headers()`
+- skip work nobody waits for any more: `deadline.check("stage")` records
+  `deadline.remaining_ms` on the current span and, once the budget is used
+  up, raises DeadlineExceeded, adds a `deadline.exceeded` event to the span
+  and counts request_deadline_exceeded_total{stage}. A call cancelled by its
+  deadline-bounded timeout is recorded the same way with
+  `raise deadline.exceeded("stage")`
+
+Requests without the header get an unbounded deadline, so the services keep
+their own timeouts when called directly.
+"""
+import contextvars
+import math
+import os
+import time
+
+from opentelemetry import metrics, trace
+
+DEADLINE_HEADER = "x-request-budget-ms"
+_HEADER_BYTES = DEADLINE_HEADER.encode()
+
+
+def hop_margin():
+    """DEADLINE_HOP_MARGIN_MS: budget kept back per hop for the caller to handle the response"""
+    return float(os.getenv("DEADLINE_HOP_MARGIN_MS", "50")) / 1000
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage, overrun):
+        super().__init__(f"Request deadline exceeded at {stage} (by {overrun * 1000:.0f}ms)")
+        self.stage = stage
+        self.overrun = overrun
+
+
+class Deadline:
+    """
+    Point in time (time.monotonic()) by which the request must be answered
+
+    Args:
+        budget: seconds from now, None for no deadline
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.expires = math.inf if budget is None else time.monotonic() + budget
+
+    @classmethod
+    def from_headers(cls, headers, default=None):
+        """Budget from the request headers, at most `default` seconds when given"""
+        budget = default
+        value = headers.get(DEADLINE_HEADER)
+        if value:
+            try:
+                received = max(0.0, float(value) / 1000)
+            except ValueError:
+                received = None
+            if received is not None:
+                budget = received if default is None else min(default, received)
+        return cls(budget)
+
+    @property
+    def bounded(self):
+        return self.budget is not None
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap):
+        """Timeout for a downstream call: `cap` seconds or the remaining budget, whichever is shorter"""
+        return max(0.001, min(cap, self.remaining()))
+
+    def headers(self):
+        """Headers passing the remaining budget on to the next hop"""
+        if not self.bounded:
+            return {}
+        budget_ms = max(0, int((self.remaining() - hop_margin()) * 1000))
+        return {DEADLINE_HEADER: str(budget_ms)}
+
+    def check(self, stage):
+        """Raise DeadlineExceeded if the budget is used up; record the remaining budget on the current span"""
+        if not self.bounded:
+            return
+        remaining = self.remaining()
+        span = trace.get_current_span()
+        span.set_attribute("deadline.remaining_ms", round(remaining * 1000, 1))
+        if remaining > 0:
+            return
+        raise self.exceeded(stage)
+
+    def exceeded(self, stage):
+        """Record on the current span that `stage` was skipped or cancelled; returns the exception to raise"""
+        overrun = max(0.0, -self.remaining())
+        span = trace.get_current_span()
+        span.set_attribute("deadline.exceeded", True)
+        span.add_event("deadline.exceeded", {
+            "deadline.stage": stage,
+            "deadline.budget_ms": round(self.budget * 1000, 1),
+            "deadline.overrun_ms": round(overrun * 1000, 1),
+        })
+        _exceeded.add(1, {"stage": stage})
+        return DeadlineExceeded(stage, overrun)
+
+
+_current = contextvars.ContextVar("o11y_deadline", default=Deadline())
+_exceeded = metrics.get_meter(__name__).create_counter(
+    "request_deadline_exceeded_total",
+    description="Work skipped because the request deadline had passed", unit="1",
+)
+
+
+def current_deadline():
+    """Deadline of the request being handled (unbounded outside of a request or without the header)"""
+    return _current.get()
+
+
+class DeadlineMiddleware:
+    """
+    ASGI middleware setting current_deadline() for every HTTP request
+
+    Args:
+        default_budget: seconds given to requests without (or with a larger)
+            budget header; None keeps them unbounded
+    """
+
+    def __init__(self, app, default_budget=None):
+        self.app = app
+        self.default_budget = default_budget
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {}
+        for name, value in scope["headers"]:
+            if name == _HEADER_BYTES:
+                headers[DEADLINE_HEADER] = value.decode("latin-1")
+        token = _current.set(Deadline.from_headers(headers, self.default_budget))
+        try:
+            return await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
+
+
+def install_flask_deadline(app, default_budget=None):
+    """Set current_deadline() for every request of a Flask app"""
+    from flask import g, request
+
+    @app.before_request
+    def _set_deadline():
+        g._deadline_token = _current.set(Deadline.from_headers(request.headers, default_budget))
+
+    @app.teardown_request
+    def _reset_deadline(exc):
+        token = g.pop("_deadline_token", None)
+        if token is not None:
+            _current.reset(token)
@@ -0,0 +1,233 @@
+"""
+Cached, dependency-aware liveness and readiness probes
+
+`/health` used to answer "healthy" unconditionally and log a line per probe;
+with Kubernetes probing every pod every few seconds that is log and span
+volume without information. HealthChecks runs the dependency checks of a
+service on a background thread every `interval` seconds and keeps the last
+result, so the probe endpoints answer from memory in constant time:
+
+    /health/live    200 as long as the process serves requests
+    /health/ready   200 "ready" or "degraded", 503 "unready" when a critical
+                    check fails, "starting" before the first round and
+                    "stale" when the last round is older than `ttl` (a check
+                    hangs)
+
+Non-critical checks (other services, the telemetry export queues) only make
+the service "degraded": taking every replica out of rotation because a
+downstream is down turns one failure into a cascade.
+
+A check is a callable run on the checker thread that raises on failure and may
+return a short detail string. Checks must bound their own duration
+(connect / request timeouts). urllib is not instrumented and opening a
+database connection does not create a span, so the checks add no telemetry.
+
+Probe requests are excluded from the FastAPI / Flask instrumentation (see
+excluded_urls(), used by bootstrap) and from the uvicorn / werkzeug access
+logs (install_probe_log_filter()).
+
+Metrics:
+
+    health_check_status{check}     gauge, 1 passing / 0 failing
+
+Configured with HEALTH_CHECK_INTERVAL, HEALTH_CHECK_TTL and
+HEALTH_EXPORTER_BACKLOG_THRESHOLD.
+"""
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+from opentelemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+PROBE_PATHS = ("/health", "/health/live", "/health/ready")
+# Regex for the instrumentations' excluded_urls (matched with re.search against the full URL)
+PROBE_URL_PATTERN = r"/health(/live|/ready)?$"
+
+
+def excluded_urls():
+    """excluded_urls of the FastAPI / Flask instrumentation: the probes and OTEL_PYTHON_EXCLUDED_URLS"""
+    configured = os.getenv("OTEL_PYTHON_EXCLUDED_URLS", "")
+    return ",".join(url for url in (configured, PROBE_URL_PATTERN) if url)
+
+
+class _ProbeLogFilter(logging.Filter):
+    def filter(self, record):
+        args = record.args
+        if not isinstance(args, tuple):
+            return True
+        if record.name == "uvicorn.access" and len(args) >= 3:
+            # '%s - "%s %s HTTP/%s" %d': client, method, path, version, status
+            path = str(args[2])
+        elif record.name == "werkzeug" and args:
+            # '"%s" %s %s': "GET /health HTTP/1.1", status, size
+            parts = str(args[0]).split(" ")
+            path = parts[1] if len(parts) > 1 else ""
+        else:
+            return True
+        return path.split("?", 1)[0] not in PROBE_PATHS
+
+
+def install_probe_log_filter():
+    """Leave the probe requests out of the uvicorn and werkzeug access logs"""
+    probe_filter = _ProbeLogFilter()
+    for name in ("uvicorn.access", "werkzeug"):
+        logging.getLogger(name).addFilter(probe_filter)
+
+
+class HealthChecks:
+    """
+    Args:
+        service: service name in the probe responses
+        interval: seconds between check rounds (default HEALTH_CHECK_INTERVAL or 5)
+        ttl: age after which the last round no longer counts, /health/ready
+            answers 503 "stale" (default HEALTH_CHECK_TTL or 3 * interval)
+    """
+
+    def __init__(self, service, interval=None, ttl=None):
+        self.service = service
+        self.interval = float(os.getenv("HEALTH_CHECK_INTERVAL", "5")) if interval is None else interval
+        if ttl is None:
+            ttl = float(os.getenv("HEALTH_CHECK_TTL", "0")) or 3 * self.interval
+        self.ttl = ttl
+        self._checks = []
+        # (monotonic time of the round, status code, body), replaced as a whole by the checker thread
+        self._result = None
+        self._live = {"status": "healthy", "service": service}
+        self._stop = threading.Event()
+        self._thread = None
+
+        meter = metrics.get_meter(__name__)
+        meter.create_observable_gauge(
+            "health_check_status", callbacks=[self._observe],
+            description="Result of the last dependency check, 1 passing / 0 failing", unit="1",
+        )
+
+    def add(self, name, check, critical=True):
+        self._checks.append((name, check, critical))
+        return self
+
+    def start(self):
+        """Start the checker thread (once per process, after fork)"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="health-checks", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+
+    def live(self):
+        """(status code, body) of /health/live"""
+        return 200, self._live
+
+    def ready(self):
+        """(status code, body) of /health/ready, from the last round"""
+        result = self._result
+        if result is None:
+            return 503, {"status": "starting", "service": self.service}
+        checked_at, code, body = result
+        age = time.monotonic() - checked_at
+        if age > self.ttl:
+            return 503, {**body, "status": "stale", "age_seconds": round(age, 1)}
+        return code, body
+
+    def _run(self):
+        while True:
+            self.run_checks()
+            if self._stop.wait(self.interval):
+                return
+
+    def run_checks(self):
+        checks = {}
+        unready = degraded = False
+        for name, check, critical in self._checks:
+            start = time.perf_counter()
+            try:
+                detail = check()
+                checks[name] = {"status": "pass"}
+                if detail:
+                    checks[name]["detail"] = detail
+            except Exception as e:
+                checks[name] = {"status": "fail", "error": f"{type(e).__name__}: {e}"}
+                if critical:
+                    unready = True
+                else:
+                    degraded = True
+                if self._result is None or self._result[2]["checks"].get(name, {}).get("status") != "fail":
+                    logger.warning("Health check %s failed: %s", name, e)
+            checks[name]["critical"] = critical
+            checks[name]["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        status = "unready" if unready else "degraded" if degraded else "ready"
+        body = {"status": status, "service": self.service, "checks": checks}
+        self._result = (time.monotonic(), 503 if unready else 200, body)
+
+    def _observe(self, options):
+        result = self._result
+        if result is None:
+            return []
+        return [
+            metrics.Observation(1 if check["status"] == "pass" else 0, {"check": name})
+            for name, check in result[2]["checks"].items()
+        ]
+
+
+def http_check(url, timeout=2.0):
+    """Check that `url` answers with a 2xx status"""
+    def check():
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+    return check
+
+
+def exporter_backlog_check(telemetry=None, threshold=None):
+    """
+    Check that the span and log export queues are below `threshold` of their capacity
+
+    Args:
+        telemetry: TelemetryBootstrap whose processors are checked; None for
+            the providers set up by opentelemetry-instrument
+        threshold: default HEALTH_EXPORTER_BACKLOG_THRESHOLD or 0.9
+    """
+    if threshold is None:
+        threshold = float(os.getenv("HEALTH_EXPORTER_BACKLOG_THRESHOLD", "0.9"))
+
+    def check():
+        fills = {}
+        for signal, processor in _export_processors(telemetry):
+            # BatchSpanProcessor: queue / max_queue_size, BatchLogRecordProcessor: _queue / _max_queue_size
+            queue = getattr(processor, "queue", getattr(processor, "_queue", None))
+            capacity = getattr(processor, "max_queue_size", getattr(processor, "_max_queue_size", None))
+            if queue is not None and capacity:
+                fills[signal] = len(queue) / capacity
+        full = {signal: fill for signal, fill in fills.items() if fill >= threshold}
+        if full:
+            raise RuntimeError(", ".join(f"{signal} export queue {fill:.0%} full" for signal, fill in full.items()))
+        return ", ".join(f"{signal} {fill:.0%}" for signal, fill in fills.items())
+    return check
+
+
+def _export_processors(telemetry):
+    if telemetry is not None:
+        for signal in ("spans", "logs"):
+            processor = getattr(telemetry, f"{signal[:-1]}_processor", None)
+            if processor is not None:
+                yield signal, processor
+        return
+    from opentelemetry import trace
+    from opentelemetry._logs import get_logger_provider
+
+    span_processors = getattr(getattr(trace.get_tracer_provider(), "_active_span_processor", None),
+                              "_span_processors", ())
+    for processor in span_processors:
+        yield "spans", processor
+    log_processors = getattr(getattr(get_logger_provider(), "_multi_log_record_processor", None),
+                             "_log_record_processors", ())
+    for processor in log_processors:
+        yield "logs", processor
@@ -0,0 +1,121 @@
+"""
+Structured JSON log formatter
+
+Replaces the hand written `'{"time":"%(asctime)s", ... "message":"%(message)s"}'`
+format string used by the services. That format string is not JSON encoding:
+quotes, newlines or tracebacks in the message produce broken lines and Loki
+has to fall back to slow regex parsing.
+
+JsonFormatter:
+- escapes every value with the C accelerated json encoder
+- formats the timestamp once per second and only appends the milliseconds
+- reads trace_id / span_id straight from the current span context
+  (no LoggingInstrumentor record factory needed)
+- optionally emits `extra={...}` fields passed to the logger call
+"""
+import json
+import logging
+import time
+
+from opentelemetry import trace
+
+# Attributes every LogRecord carries; anything else on the record came from extra={...}
+_RESERVED_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {
+    "message", "asctime",
+    # Injected by LoggingInstrumentor if it is still enabled somewhere
+    "otelTraceID", "otelSpanID", "otelTraceSampled", "otelServiceName",
+    # uvicorn duplicates the message with ANSI colors
+    "color_message",
+}
+
+_encode_str = json.encoder.encode_basestring
+_encode_value = json.JSONEncoder(ensure_ascii=False, default=str, separators=(",", ":")).encode
+
+_INVALID_TRACE_ID = "0"
+_INVALID_SPAN_ID = "0"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Render LogRecords as one JSON object per line
+
+    Args:
+        service: value of the "service" field
+        static_fields: extra constant fields added to every line
+        include_extra: emit fields passed through `logger.info(..., extra={...})`
+    """
+
+    def __init__(self, service, static_fields=None, include_extra=True):
+        super().__init__()
+        fields = {"service": service}
+        fields.update(static_fields or {})
+        # Constant part of every line, encoded once
+        self._static = "".join(f",{_encode_str(k)}:{_encode_value(v)}" for k, v in fields.items())
+        self._include_extra = include_extra
+        self._levels = {}
+        # (epoch second, formatted "YYYY-mm-dd HH:MM:SS") of the last record
+        self._time_cache = (None, "")
+
+    def _format_time(self, record):
+        second = int(record.created)
+        cached_second, prefix = self._time_cache
+        if second != cached_second:
+            prefix = time.strftime("%Y-%m-%d %H:%M:%S", self.converter(second))
+            self._time_cache = (second, prefix)
+        return f"{prefix},{int(record.msecs):03d}"
+
+    def _encode_level(self, levelname):
+        encoded = self._levels.get(levelname)
+        if encoded is None:
+            encoded = self._levels[levelname] = _encode_str(levelname)
+        return encoded
+
+    def format(self, record):
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            trace_id = format(span_context.trace_id, "032x")
+            span_id = format(span_context.span_id, "016x")
+        else:
+            trace_id = _INVALID_TRACE_ID
+            span_id = _INVALID_SPAN_ID
+
+        parts = [
+            '{"time":"', self._format_time(record),
+            '","level":', self._encode_level(record.levelname),
+            self._static,
+            ',"trace_id":"', trace_id,
+            '","span_id":"', span_id,
+            '","message":', _encode_str(record.getMessage()),
+        ]
+
+        if self._include_extra:
+            for key, value in record.__dict__.items():
+                if key not in _RESERVED_ATTRS and key[0] != "_":
+                    parts.append(f",{_encode_str(key)}:{_encode_value(value)}")
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            parts.append(',"exc_info":')
+            parts.append(_encode_str(record.exc_text))
+        if record.stack_info:
+            parts.append(',"stack_info":')
+            parts.append(_encode_str(self.formatStack(record.stack_info)))
+
+        parts.append("}")
+        return "".join(parts)
+
+
+def configure_logging(service, level=logging.INFO, static_fields=None, include_extra=True):
+    """
+    Install a console handler using JsonFormatter on the root logger
+
+    Drop-in replacement for the logging.basicConfig(format=...) call of each service.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter(service, static_fields=static_fields, include_extra=include_extra))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    return handler
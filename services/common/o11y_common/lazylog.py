@@ -0,0 +1,161 @@
+"""
+Lazy log payload rendering and hot-path log filters
+
+f-strings are rendered before the logging module decides whether the record is
+emitted. Pass payloads as %-style arguments instead, wrapped in `Truncated` or
+`Lazy`, so nothing is rendered for records that are filtered out:
+
+    logger.info("Service D response: %s", Truncated(service_d_data))
+
+Filters (attach them to the service logger, library loggers are untouched):
+- CallsiteRateLimiter: token bucket per logging callsite (file:line)
+- TraceSampledFilter: low severity records only for sampled traces
+"""
+import logging
+import random
+import threading
+import time
+
+from opentelemetry import trace
+
+
+class Lazy:
+    """Call `fn(*args)` only when the record is actually rendered"""
+
+    __slots__ = ("fn", "args")
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+class Truncated:
+    """Render `str(obj)` lazily and cut it to `limit` characters"""
+
+    __slots__ = ("obj", "limit")
+
+    def __init__(self, obj, limit=200):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.obj)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}...(+{len(text) - self.limit} chars)"
+
+
+class CallsiteRateLimiter(logging.Filter):
+    """
+    Allow at most `rate` records per second (bursts up to `burst`) per callsite
+
+    Records at or above `always_level` are never dropped. The number of records
+    suppressed since the last emitted one is attached as `suppressed` so the
+    loss stays visible in the logs.
+    """
+
+    def __init__(self, rate=10.0, burst=20, always_level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.always_level = always_level
+        self.dropped_total = 0
+        self._buckets = {}  # (pathname, lineno) -> [tokens, last_refill, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.always_level:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                self.dropped_total += 1
+                return False
+
+            bucket[0] -= 1.0
+            suppressed, bucket[2] = bucket[2], 0
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class TraceSampledFilter(logging.Filter):
+    """
+    Keep records below `unsampled_level` only when the active trace is sampled
+
+    A fraction `unsampled_ratio` of those records from unsampled traces is
+    still kept. Records logged outside any span (startup, background threads)
+    always pass.
+    """
+
+    def __init__(self, unsampled_level=logging.WARNING, unsampled_ratio=0.0):
+        super().__init__()
+        self.unsampled_level = unsampled_level
+        self.unsampled_ratio = unsampled_ratio
+        self.dropped_total = 0
+
+    def filter(self, record):
+        if record.levelno >= self.unsampled_level:
+            return True
+
+        span_context = trace.get_current_span().get_span_context()
+        if not span_context.is_valid or span_context.trace_flags.sampled:
+            return True
+
+        if self.unsampled_ratio and random.random() < self.unsampled_ratio:
+            return True
+
+        self.dropped_total += 1
+        return False
+
+
+def parse_level(level):
+    """
+    Level number of `level`: a number, or a level name in any case ("warning", "WARNING", "30")
+
+    logging.getLevelName() returns the string "Level x" for unknown names,
+    which a filter comparing it with record.levelno turns into a TypeError on
+    every log call; this fails once, at startup, instead.
+    """
+    if isinstance(level, int):
+        return level
+    name = str(level).strip()
+    if name.isdigit():
+        return int(name)
+    number = logging.getLevelName(name.upper())
+    if not isinstance(number, int):
+        raise ValueError(
+            f"Unknown log level {level!r}, expected a number or one of DEBUG, INFO, WARNING, ERROR, CRITICAL"
+        )
+    return number
+
+
+def install_hot_path_filters(logger, rate=10.0, burst=20, unsampled_level=logging.WARNING,
+                             unsampled_ratio=0.0):
+    """
+    Attach TraceSampledFilter and CallsiteRateLimiter to `logger`
+
+    The sampling filter runs first so that records of unsampled traces do not
+    consume rate limit tokens. Pass rate=0 to disable rate limiting.
+    `unsampled_level` may be a level number or name (see parse_level).
+    """
+    filters = [TraceSampledFilter(unsampled_level=parse_level(unsampled_level), unsampled_ratio=unsampled_ratio)]
+    if rate > 0:
+        filters.append(CallsiteRateLimiter(rate=rate, burst=burst))
+    for f in filters:
+        logger.addFilter(f)
+    return filters
@@ -0,0 +1,233 @@
+"""
+Event loop lag and blocking-call monitor for the asyncio services
+
+psycopg2, synchronous logging handlers or CPU-heavy code called from an async
+endpoint block the event loop: every other request waits, but nothing shows
+up in the traces except a slow p99. LoopMonitor measures this from two sides:
+
+- a heartbeat task sleeps `interval` seconds and records how late it woke up
+  (scheduling lag), and samples the number of tasks
+- a watchdog thread notices when the heartbeat has not run for longer than
+  `slow_threshold` seconds, captures the stack of the event loop thread at
+  that moment and adds an `event_loop.slow_callback` event to the span that
+  is active in the blocked task, while that span is still open
+
+The callback being run is found on the captured stack (asyncio Handle._run),
+so nothing is added to the per-callback path. With uvloop the handle frames
+are not visible and only the metrics and the warning log remain.
+
+Metrics:
+
+    event_loop_lag_seconds                     histogram
+    event_loop_slow_callbacks_total            counter
+    event_loop_tasks                           gauge
+    event_loop_executor_queue_depth            gauge (default executor work queue)
+    event_loop_executor_threads{state}         gauge (busy / idle)
+"""
+import asyncio
+import asyncio.events
+import logging
+import os
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+
+from opentelemetry import context, metrics, trace
+
+from .views import HistogramView
+
+logger = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_HANDLE_RUN_CODE = asyncio.events.Handle._run.__code__
+_LIBRARY_PATHS = tuple({sysconfig.get_paths()[name] for name in ("stdlib", "platstdlib", "purelib", "platlib")})
+
+
+def loop_monitor_views():
+    return [HistogramView("event_loop_lag_seconds", LAG_BUCKETS, exponential=False)]
+
+
+class LoopMonitor:
+    """
+    Args:
+        interval: heartbeat period in seconds (LOOP_MONITOR_INTERVAL, 0 disables the monitor)
+        slow_threshold: seconds without heartbeat reported as a slow callback
+            (LOOP_SLOW_CALLBACK_THRESHOLD)
+        stack_limit: frames kept of the captured stack
+    """
+
+    def __init__(self, interval=None, slow_threshold=None, stack_limit=15):
+        self.interval = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1")) if interval is None else interval
+        self.slow_threshold = (
+            float(os.getenv("LOOP_SLOW_CALLBACK_THRESHOLD", "0.1")) if slow_threshold is None else slow_threshold
+        )
+        self.stack_limit = stack_limit
+
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+        self._stop = threading.Event()
+        self._beat = 0.0
+        self._tasks = 0
+
+        meter = metrics.get_meter(__name__)
+        self.lag = meter.create_histogram(
+            "event_loop_lag_seconds", description="Delay of the event loop heartbeat", unit="s",
+        )
+        self.slow_callbacks = meter.create_counter(
+            "event_loop_slow_callbacks_total",
+            description="Times the event loop was blocked longer than the slow callback threshold", unit="1",
+        )
+        meter.create_observable_gauge(
+            "event_loop_tasks", callbacks=[self._observe_tasks],
+            description="Tasks scheduled on the event loop", unit="1",
+        )
+        meter.create_observable_gauge(
+            "event_loop_executor_queue_depth", callbacks=[self._observe_queue_depth],
+            description="Calls waiting for a thread of the loop's default executor", unit="1",
+        )
+        meter.create_observable_gauge(
+            "event_loop_executor_threads", callbacks=[self._observe_threads],
+            description="Threads of the loop's default executor by state", unit="1",
+        )
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        """Start monitoring the running loop; call from the server startup hook"""
+        if not self.enabled or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = self._loop.create_task(self._heartbeat(), name="loop-monitor")
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        interval = self.interval
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self.lag.record(max(0.0, now - expected))
+            self._beat = now
+            self._tasks = len(asyncio.all_tasks())
+
+    def _watch(self):
+        poll = min(self.interval, self.slow_threshold) / 2
+        reported = None
+        while not self._stop.wait(poll):
+            blocked = time.monotonic() - self._beat - self.interval
+            # After shutdown the heartbeat stops without the loop being blocked
+            if blocked <= self.slow_threshold or not self._loop.is_running():
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            # One report per blocking callback, also when several run back to back
+            handle = _running_handle(frame)
+            key = (self._beat, handle)
+            if key == reported:
+                continue
+            reported = key
+            self.slow_callbacks.add(1)
+            try:
+                self._report(blocked, frame, handle)
+            except Exception:
+                logger.debug("Could not inspect the blocked event loop", exc_info=True)
+            del frame, handle
+
+    def _report(self, blocked, frame, handle):
+        stack = traceback.extract_stack(frame, limit=self.stack_limit)
+        # Innermost frame of the service's own code, e.g. the endpoint calling psycopg2
+        location = next((f for f in reversed(stack) if not f.filename.startswith(_LIBRARY_PATHS)), stack[-1])
+        callback = _describe(handle)
+
+        span = _active_span(handle)
+        if span is None or not span.is_recording():
+            span = trace.INVALID_SPAN
+        span.add_event("event_loop.slow_callback", {
+            "event_loop.blocked_seconds": round(blocked, 6),
+            "event_loop.callback": callback,
+            "code.function": location.name,
+            "code.filepath": location.filename,
+            "code.lineno": location.lineno or 0,
+            "code.stacktrace": "".join(stack.format()),
+        })
+        # Logged in the blocked span's context so the record carries its trace_id
+        with trace.use_span(span):
+            logger.warning(
+                "Event loop blocked for %.3fs in %s (%s:%s), callback %s",
+                blocked, location.name, location.filename, location.lineno, callback,
+            )
+
+    # ---- observable callbacks
+
+    def _observe_tasks(self, options):
+        if self._loop is None:
+            return []
+        return [metrics.Observation(self._tasks)]
+
+    def _executor(self):
+        # Created by the first run_in_executor(None, ...) / getaddrinfo() call
+        return getattr(self._loop, "_default_executor", None)
+
+    def _observe_queue_depth(self, options):
+        executor = self._executor()
+        if executor is None:
+            return []
+        return [metrics.Observation(executor._work_queue.qsize())]
+
+    def _observe_threads(self, options):
+        executor = self._executor()
+        if executor is None:
+            return []
+        threads = len(executor._threads)
+        idle = min(threads, executor._idle_semaphore._value)
+        return [
+            metrics.Observation(threads - idle, {"state": "busy"}),
+            metrics.Observation(idle, {"state": "idle"}),
+        ]
+
+
+def _running_handle(frame):
+    """The asyncio Handle whose callback is executing in `frame`'s thread"""
+    while frame is not None:
+        if frame.f_code is _HANDLE_RUN_CODE:
+            return frame.f_locals.get("self")
+        frame = frame.f_back
+    return None
+
+
+def _describe(handle):
+    """Coroutine of the task a handle steps, else the handle's repr"""
+    if handle is None:
+        return "unknown"
+    task = getattr(handle._callback, "__self__", None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        return f"{task.get_name()} {getattr(coro, '__qualname__', coro)}"
+    return repr(handle)
+
+
+def _active_span(handle):
+    """Current span of the contextvars context the handle runs in"""
+    ctx = getattr(handle, "_context", None)
+    if ctx is None:
+        return None
+    # Read from the watchdog thread: Context is an immutable mapping snapshot
+    for value in list(ctx.values()):
+        if isinstance(value, context.Context):
+            return trace.get_current_span(value)
+    return None
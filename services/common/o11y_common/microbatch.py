@@ -0,0 +1,135 @@
+"""
+Client-side micro-batching of small outbound calls
+
+Under load Service A makes one POST /enqueue to Service B per request, and
+Service B one Kafka round trip per call. MicroBatcher coalesces the items
+submitted within `max_wait` seconds (or until `max_size` items) and hands
+them to a `send_batch(items)` coroutine in one call; every submitter awaits
+the result for its own item. Items whose submitter was cancelled before the
+flush (e.g. by asyncio.wait_for) are left out of the batch.
+
+Batches belong to no single request, so send_batch runs outside the
+submitters' trace context. Each item carries the W3C trace context of the
+span that submitted it (see item_context()), and the batch span links to all
+of them, as the OpenTelemetry messaging conventions do for batch publishing.
+
+Metrics, per `batcher`:
+
+    microbatch_size                histogram, items per batch
+    microbatch_flushes_total       counter by `reason` (size / timer / close)
+"""
+import asyncio
+import contextvars
+import os
+
+from opentelemetry import metrics, propagate, trace
+
+from .views import HistogramView
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def microbatch_views():
+    return [HistogramView("microbatch_size", BATCH_SIZE_BUCKETS, attribute_keys={"batcher"}, exponential=False)]
+
+
+def item_context():
+    """W3C trace context (traceparent / tracestate) of the current span, to send along with an item"""
+    carrier = {}
+    propagate.inject(carrier)
+    return carrier
+
+
+def item_links(items, key="context"):
+    """Span links to the trace contexts carried by the items"""
+    links = []
+    for item in items:
+        span_context = trace.get_current_span(propagate.extract(item.get(key) or {})).get_span_context()
+        if span_context.is_valid:
+            links.append(trace.Link(span_context))
+    return links
+
+
+class MicroBatcher:
+    """
+    Args:
+        name: `batcher` attribute of the metrics
+        send_batch: coroutine function taking a list of items and returning
+            one result per item, in order; an exception fails every item
+        max_size: items that trigger a flush (default: MICROBATCH_MAX_SIZE or 32)
+        max_wait: seconds the first item of a batch waits for others
+            (default: MICROBATCH_MAX_WAIT_MS or 5, in milliseconds)
+    """
+
+    def __init__(self, name, send_batch, max_size=None, max_wait=None):
+        self.name = name
+        self.send_batch = send_batch
+        self.max_size = int(os.getenv("MICROBATCH_MAX_SIZE", "32")) if max_size is None else max_size
+        self.max_wait = float(os.getenv("MICROBATCH_MAX_WAIT_MS", "5")) / 1000 if max_wait is None else max_wait
+        self._items = []
+        self._futures = []
+        self._timer = None
+        self._inflight = set()
+
+        meter = metrics.get_meter(__name__)
+        self.batch_size = meter.create_histogram(
+            "microbatch_size", description="Items per micro-batch", unit="1",
+        )
+        self.flushes = meter.create_counter(
+            "microbatch_flushes_total", description="Micro-batches sent, by what triggered them", unit="1",
+        )
+
+    async def submit(self, item):
+        """Add an item to the next batch and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._items.append(item)
+        self._futures.append(future)
+        if len(self._items) >= self.max_size:
+            self._flush("size")
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush, "timer", context=contextvars.Context())
+        return await future
+
+    def _flush(self, reason):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._items:
+            return
+        # Submitters that gave up (asyncio.wait_for timeout, cancelled request) already reported a failure:
+        # their items are not sent
+        pending = [(item, future) for item, future in zip(self._items, self._futures) if not future.cancelled()]
+        self._items, self._futures = [], []
+        if not pending:
+            return
+        items = [item for item, _ in pending]
+        futures = [future for _, future in pending]
+        attributes = {"batcher": self.name}
+        self.batch_size.record(len(items), attributes)
+        self.flushes.add(1, {**attributes, "reason": reason})
+        # In an empty context, not in the one of the submitter whose item filled the batch
+        task = asyncio.get_running_loop().create_task(self._send(items, futures), context=contextvars.Context())
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, items, futures):
+        try:
+            results = await self.send_batch(items)
+            if len(results) != len(items):
+                raise ValueError(f"{self.name}: {len(results)} results for a batch of {len(items)} items")
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        """Send the pending items and wait for the batches in flight"""
+        self._flush("close")
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
@@ -0,0 +1,394 @@
+"""
+In-process sampling profiler correlated with trace and span IDs
+
+Traces tell that service_d.compute took 400ms, not which Python frames spent
+it. SpanProfiler samples the stacks of all threads `hz` times per second
+(sys._current_frames() from a daemon thread, no signals or C extensions) and
+tags every sample with the span that was active in that thread:
+
+- asyncio threads: the span of the task being stepped, read from the context
+  of the running asyncio Handle on the stack (see loopmonitor)
+- other threads (Flask / werkzeug request threads): the innermost span
+  started in that thread and not yet ended, tracked by a span processor that
+  TelemetryBootstrap(span_processors=...) installs
+
+Samples are weighted in microseconds. In "cpu" mode (default) the CPU time a
+thread used since the previous tick (its pthread CPU clock) is charged to the
+stack seen now or, if the thread is now blocked in I/O or sleep() (Linux:
+/proc/self/task/<tid>/wchan), to the stack seen when it was last running. Blocked
+threads weigh nothing and the totals add up to the CPU time spent. In "wall"
+mode every sample weighs one sampling interval. Samples without an active
+span are only summed up.
+
+Samples are aggregated as folded stacks (`frame;frame;frame µs`, the input of
+flamegraph.pl and speedscope):
+
+- per endpoint: name of the local root span (e.g. "GET /process")
+- per trace: the last `max_traces` traces, so the profile of a slow trace
+  found in Tempo can be fetched by its trace_id
+
+Profiles are served on demand by the services' /debug/profile endpoint and,
+with PROFILER_EXPORT_DIR set, written to `<dir>/<service>-<pid>-<time>.folded`
+every PROFILER_EXPORT_INTERVAL seconds.
+
+The sampler thread needs the GIL like any other thread; under CPU contention
+its ticks are delayed to the next GIL switch (5ms), and functions running for
+less than that are under-represented. Waits on threading locks cannot be told
+apart from waits for the GIL and are charged like running code.
+
+Disabled unless PROFILER_HZ > 0.
+"""
+import asyncio.base_events
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+from .loopmonitor import _HANDLE_RUN_CODE, _active_span
+
+logger = logging.getLogger(__name__)
+
+_RUN_ONCE_CODE = asyncio.base_events.BaseEventLoop._run_once.__code__
+
+
+def profiler_hz():
+    """PROFILER_HZ: samples per second, 0 (default) disables the profiler"""
+    return float(os.getenv("PROFILER_HZ", "0"))
+
+
+class SpanProfiler:
+    """
+    Args:
+        service_name: used in the exported file names
+        hz: samples per second (default: PROFILER_HZ)
+        mode: "cpu" or "wall" (default: PROFILER_MODE or "cpu")
+        max_depth: frames kept per stack, from the innermost
+        max_traces: traces whose profiles are kept for lookup by trace_id
+        export_dir: directory of the periodic folded exports (default: PROFILER_EXPORT_DIR)
+        export_interval: seconds between exports (default: PROFILER_EXPORT_INTERVAL or 60)
+    """
+
+    def __init__(self, service_name, hz=None, mode=None, max_depth=64, max_traces=1000,
+                 export_dir=None, export_interval=None):
+        self.service_name = service_name
+        self.hz = profiler_hz() if hz is None else hz
+        self.mode = mode or os.getenv("PROFILER_MODE", "cpu")
+        if self.mode not in ("cpu", "wall"):
+            raise ValueError(f"PROFILER_MODE must be cpu or wall, not {self.mode!r}")
+        if self.mode == "cpu" and not hasattr(time, "pthread_getcpuclockid"):
+            logger.warning("Per-thread CPU clocks are not available on this platform, profiling wall time")
+            self.mode = "wall"
+        self.max_depth = max_depth
+        self.max_traces = max_traces
+        self.export_dir = export_dir if export_dir is not None else os.getenv("PROFILER_EXPORT_DIR")
+        self.export_interval = (
+            float(os.getenv("PROFILER_EXPORT_INTERVAL", "60")) if export_interval is None else export_interval
+        )
+
+        self.tracker = _ActiveSpans()
+        self._lock = threading.Lock()
+        self._endpoints = defaultdict(Counter)   # endpoint -> folded stack -> µs
+        self._traces = OrderedDict()             # trace_id -> (span_id, folded stack) -> µs
+        self._frame_names = {}
+        self._cpu_last = {}
+        self._interval_us = int(1e6 / self.hz) if self.hz > 0 else 0
+        self._running = {}     # thread id -> observation of the last tick it was running
+        self._thread = None
+        self._stop = threading.Event()
+        self._window_start = time.time()
+
+        self.samples = 0
+        self.sampled_us = 0
+        self.untagged_us = 0
+        self.ticks = 0
+        self.sampler_cpu_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.hz > 0
+
+    def span_processors(self):
+        """Span processors to pass to TelemetryBootstrap(span_processors=...)"""
+        return [self.tracker] if self.enabled else []
+
+    def start(self):
+        """Start the sampler thread (once per process, after fork)"""
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="span-profiler", daemon=True)
+        self._thread.start()
+        logger.info("Span profiler started at %.0f Hz (%s mode)", self.hz, self.mode)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # ---- sampling
+
+    def _run(self):
+        interval = 1.0 / self.hz
+        next_tick = time.monotonic()
+        next_export = next_tick + self.export_interval
+        while True:
+            next_tick += interval
+            now = time.monotonic()
+            if next_tick < now:
+                # Fell behind (GIL held by a long C call), skip the missed ticks
+                next_tick = now
+            if self._stop.wait(next_tick - now):
+                break
+            try:
+                self._sample()
+            except Exception:
+                logger.debug("Profiler sample failed", exc_info=True)
+            self.sampler_cpu_seconds = time.thread_time()
+            if self.export_dir and time.monotonic() >= next_export:
+                next_export += self.export_interval
+                self.export()
+
+    def _sample(self):
+        own = threading.get_ident()
+        frames = sys._current_frames()
+        native_ids = {t.ident: t.native_id for t in threading.enumerate()} if self.mode == "cpu" else {}
+        self.ticks += 1
+        for thread_id, frame in frames.items():
+            if thread_id == own:
+                continue
+            observed = self._observe(frame, thread_id)
+            if self.mode == "wall":
+                self._record(self._interval_us, observed)
+                continue
+            used = self._cpu_used(thread_id)
+            if not used:
+                continue
+            if _blocked(native_ids.get(thread_id)):
+                # Blocked now (e.g. in sleep()): the CPU was used before, charge it
+                # to the stack seen when the thread was last running
+                observed = self._running.get(thread_id, observed)
+            else:
+                self._running[thread_id] = observed
+            self._record(used, observed)
+        # Forget threads that exited
+        for thread_id in list(self._cpu_last):
+            if thread_id not in frames:
+                self._cpu_last.pop(thread_id, None)
+                self._running.pop(thread_id, None)
+
+    def _observe(self, frame, thread_id):
+        """(endpoint, trace_id, span_id, folded stack) of the thread, None without active span"""
+        span = self._span_for(frame, thread_id)
+        if span is None:
+            return None
+        ctx = span.get_span_context()
+        return self.tracker.root_name(ctx.span_id, span.name), ctx.trace_id, ctx.span_id, self._fold(frame)
+
+    def _record(self, weight, observed):
+        if observed is None:
+            self.untagged_us += weight
+            return
+        endpoint, trace_id, span_id, stack = observed
+        trace_id = format(trace_id, "032x")
+        with self._lock:
+            self.samples += 1
+            self.sampled_us += weight
+            self._endpoints[endpoint][stack] += weight
+            trace = self._traces.get(trace_id)
+            if trace is None:
+                trace = self._traces[trace_id] = Counter()
+                if len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            trace[(format(span_id, "016x"), stack)] += weight
+
+    def _cpu_used(self, thread_id):
+        """Microseconds of CPU the thread used since the previous sample"""
+        try:
+            # Not cached: werkzeug starts a thread per request and idents are reused
+            cpu = time.clock_gettime_ns(time.pthread_getcpuclockid(thread_id))
+        except OSError:
+            return 0
+        last = self._cpu_last.get(thread_id)
+        self._cpu_last[thread_id] = cpu
+        if self.ticks == 1:
+            return 0
+        if last is None or cpu < last:
+            # Started since the previous tick (a reused ident has a smaller clock)
+            last = 0
+        return (cpu - last) // 1000
+
+    def _span_for(self, frame, thread_id):
+        handle, in_loop = _loop_state(frame)
+        if handle is not None:
+            span = _active_span(handle)
+        elif in_loop:
+            # Event loop waiting for I/O: the thread's open spans belong to suspended tasks
+            return None
+        else:
+            span = self.tracker.current(thread_id)
+        if span is None or not span.get_span_context().is_valid:
+            return None
+        return span
+
+    def _fold(self, frame):
+        names = self._frame_names
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            key = (code, frame.f_lineno)
+            name = names.get(key)
+            if name is None:
+                name = names[key] = (
+                    f"{getattr(code, 'co_qualname', code.co_name)} "
+                    f"({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+            stack.append(name)
+            frame = frame.f_back
+        stack.reverse()
+        return ";".join(stack)
+
+    # ---- profiles
+
+    def profile(self, endpoint=None, trace_id=None, span_id=None):
+        """Counter of folded stack -> µs; by trace (optionally one span), one endpoint, or all endpoints"""
+        profile = Counter()
+        with self._lock:
+            if trace_id is not None:
+                for (sid, stack), count in self._traces.get(trace_id, {}).items():
+                    if span_id is None or sid == span_id:
+                        profile[stack] += count
+            elif endpoint is not None:
+                profile.update(self._endpoints.get(endpoint, {}))
+            else:
+                # Endpoint as root frame, so one flame graph splits by endpoint
+                for name, stacks in self._endpoints.items():
+                    for stack, count in stacks.items():
+                        profile[f"{name};{stack}"] += count
+        return profile
+
+    def folded(self, **filters):
+        """profile() in the folded text format"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.profile(**filters).most_common())
+
+    def summary(self):
+        with self._lock:
+            return {
+                "service": self.service_name,
+                "hz": self.hz,
+                "mode": self.mode,
+                "window_start": self._window_start,
+                "ticks": self.ticks,
+                "samples": self.samples,
+                "sampled_us": self.sampled_us,
+                "untagged_us": self.untagged_us,
+                "sampler_cpu_seconds": round(self.sampler_cpu_seconds, 3),
+                "endpoints": {name: sum(stacks.values()) for name, stacks in self._endpoints.items()},
+                "traces": len(self._traces),
+            }
+
+    def report(self, **filters):
+        """summary() plus the filtered profile, for the JSON form of /debug/profile"""
+        return {**self.summary(), "filters": filters, "profile": dict(self.profile(**filters).most_common())}
+
+    def reset(self):
+        """Start a new window of the per-endpoint profiles (trace profiles are kept)"""
+        with self._lock:
+            self._endpoints = defaultdict(Counter)
+            self._window_start = time.time()
+
+    def export(self):
+        """Write the per-endpoint profile of the current window to export_dir and reset it"""
+        folded = self.folded()
+        self.reset()
+        if not folded:
+            return None
+        path = os.path.join(self.export_dir, f"{self.service_name}-{os.getpid()}-{int(time.time())}.folded")
+        try:
+            os.makedirs(self.export_dir, exist_ok=True)
+            with open(path, "w") as f:
+                f.write(folded)
+        except OSError as e:
+            logger.warning("Could not write profile %s: %s", path, e)
+            return None
+        return path
+
+
+def _loop_state(frame):
+    """(running asyncio Handle or None, whether the thread is inside an event loop iteration)"""
+    while frame is not None:
+        code = frame.f_code
+        if code is _HANDLE_RUN_CODE:
+            return frame.f_locals.get("self"), True
+        if code is _RUN_ONCE_CODE:
+            return None, True
+        frame = frame.f_back
+    return None, False
+
+
+def _blocked(native_id):
+    """Whether the thread sleeps in the kernel other than on a futex (GIL, locks), Linux only"""
+    if native_id is None:
+        return False
+    try:
+        with open(f"/proc/self/task/{native_id}/wchan") as f:
+            wchan = f.read()
+    except OSError:
+        return False
+    return wchan not in ("", "0") and "futex" not in wchan
+
+
+class _ActiveSpans:
+    """
+    Open spans per thread, and the local root span name of every open span
+
+    A span processor by duck typing, so that importing this module does not
+    import the SDK (see bootstrap).
+    """
+
+    def __init__(self):
+        self._threads = {}                  # thread id -> open spans started in it
+        self._open = {}                     # span_id -> (thread id, root name)
+
+    def on_start(self, span, parent_context=None):
+        thread_id = threading.get_ident()
+        parent = span.parent
+        if parent is None or parent.is_remote or parent.span_id not in self._open:
+            root = span.name
+        else:
+            root = self._open[parent.span_id][1]
+        self._open[span.context.span_id] = (thread_id, root)
+        self._threads.setdefault(thread_id, []).append(span)
+
+    def on_end(self, span):
+        # `span` is a ReadableSpan snapshot, not the object passed to on_start
+        span_id = span.context.span_id
+        entry = self._open.pop(span_id, None)
+        if entry is None:
+            return
+        spans = self._threads.get(entry[0])
+        if spans:
+            for i in range(len(spans) - 1, -1, -1):
+                if spans[i].context.span_id == span_id:
+                    del spans[i]
+                    break
+            if not spans:
+                self._threads.pop(entry[0], None)
+
+    def shutdown(self):
+        pass
+
+    def force_flush(self, timeout_millis=30000):
+        return True
+
+    def current(self, thread_id):
+        try:
+            return self._threads[thread_id][-1]
+        except (KeyError, IndexError):
+            # No open span, or it ended while the sampler was reading
+            return None
+
+    def root_name(self, span_id, default):
+        entry = self._open.get(span_id)
+        return entry[1] if entry is not None else default
@@ -0,0 +1,382 @@
+"""
+Mergeable quantile sketches of request durations over rolling windows
+
+Percentiles of `duration_ms` over the raw request_logs rows
+(`percentile_cont`) scan and sort the whole window on every poll.
+QuantileSketch is a DDSketch: values are counted in logarithmic buckets
+whose width grows with the value, so every quantile it returns is within
+`relative_accuracy` (1% by default) of the exact one, whatever the
+distribution, in a few KB. Two sketches with the same accuracy merge
+exactly by adding their bucket counts, which is what lets the sketches of
+several time slots, worker processes or replicas be combined.
+
+RollingQuantiles keeps one sketch per `slot_seconds` (wall clock, so that
+slots of different processes line up) for `slots` slots and merges the ones
+inside the requested window:
+
+    durations = RollingQuantiles()
+    durations.add(duration_ms)
+    durations.window(3600).quantiles((0.5, 0.95, 0.99))
+
+SketchStore persists a RollingQuantiles to
+`<directory>/<name>-<instance>-<pid>.json` every `interval` seconds and at
+stop(), from a background thread. The instance is SKETCH_INSTANCE, by default
+the hostname, which changes when a container or pod is re-created. At start()
+a process takes over (and merges) the files of its instance whose process is
+gone, so the windows survive a restart. Files of any instance that were not
+saved for `3 * interval` are left by dead processes and are taken over too,
+at start() and on every save round, so files of re-created containers do not
+pile up in a shared volume. The files of the other live worker processes of
+the instance are read by siblings() for a host-wide view.
+
+Nothing is persisted unless a directory is given (SKETCH_STATE_DIR): a shared
+default directory would let every local or benchmark run merge the sketches
+of the previous ones.
+
+Configured with SKETCH_RELATIVE_ACCURACY, SKETCH_STATE_DIR (unset: not
+persisted), SKETCH_PERSIST_INTERVAL (0: not persisted) and SKETCH_INSTANCE.
+"""
+import glob
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Values below this are counted as zero (durations are never negative)
+_MIN_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """
+    DDSketch of non-negative values
+
+    Args:
+        relative_accuracy: bound of the relative error of quantile()
+            (default: SKETCH_RELATIVE_ACCURACY or 0.01)
+        max_buckets: when exceeded, the lowest buckets are collapsed into one,
+            keeping the accuracy guarantee for the upper quantiles
+    """
+
+    def __init__(self, relative_accuracy=None, max_buckets=2048):
+        if relative_accuracy is None:
+            relative_accuracy = float(os.getenv("SKETCH_RELATIVE_ACCURACY", "0.01"))
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"relative_accuracy must be between 0 and 1, got {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, count=1):
+        if value < 0:
+            raise ValueError(f"QuantileSketch only counts non-negative values, got {value}")
+        if value < _MIN_VALUE:
+            self.zero_count += count
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + count
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+        self.count += count
+        self.sum += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add the counts of `other`, a sketch with the same relative accuracy"""
+        if other.gamma != self.gamma:
+            raise ValueError(
+                f"Cannot merge sketches of relative accuracy {other.relative_accuracy} and {self.relative_accuracy}"
+            )
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _collapse(self):
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets + 1
+        lowest = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[lowest] += self.buckets.pop(index)
+
+    def quantile(self, q):
+        """Value at quantile q (0..1), None for an empty sketch"""
+        return self.quantiles((q,))[q]
+
+    def quantiles(self, qs):
+        """{q: value} for several quantiles, sorting the buckets once"""
+        if self.count == 0:
+            return {q: None for q in qs}
+        result = {}
+        pending = sorted(qs)
+        seen = self.zero_count
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while pending and pending[0] * (self.count - 1) < seen:
+                q = pending.pop(0)
+                if q * (self.count - 1) < self.zero_count:
+                    result[q] = 0.0
+                else:
+                    # Middle of the bucket (gamma^(i-1), gamma^i]: within relative_accuracy of every value in it
+                    result[q] = min(self.max, max(self.min, 2 * self.gamma ** index / (self.gamma + 1)))
+        for q in pending:
+            result[q] = 0.0 if q * (self.count - 1) < self.zero_count else self.max
+        return result
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        sketch.buckets = {int(index): count for index, count in data["buckets"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if data["count"]:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+
+class RollingQuantiles:
+    """
+    QuantileSketch per time slot over the last `slots * slot_seconds` seconds
+
+    Args:
+        slot_seconds: granularity of the windows
+        slots: slots kept, the longest window is slots * slot_seconds
+        relative_accuracy: see QuantileSketch
+    """
+
+    def __init__(self, slot_seconds=60, slots=60, relative_accuracy=None):
+        self.slot_seconds = slot_seconds
+        self.slots = slots
+        self.relative_accuracy = QuantileSketch(relative_accuracy).relative_accuracy
+        self._sketches = {}
+        # add() runs in the request handlers, to_dict() in SketchStore's thread
+        self._lock = threading.Lock()
+
+    def _slot(self, now):
+        return int(now // self.slot_seconds)
+
+    def _expire(self, current):
+        for slot in [slot for slot in self._sketches if slot <= current - self.slots]:
+            del self._sketches[slot]
+
+    def add(self, value, now=None):
+        slot = self._slot(time.time() if now is None else now)
+        with self._lock:
+            sketch = self._sketches.get(slot)
+            if sketch is None:
+                sketch = self._sketches[slot] = QuantileSketch(self.relative_accuracy)
+                self._expire(slot)
+            sketch.add(value)
+
+    def window(self, seconds, now=None):
+        """Merged sketch of the slots of the last `seconds` (rounded up to whole slots)"""
+        current = self._slot(time.time() if now is None else now)
+        first = current - max(1, math.ceil(seconds / self.slot_seconds)) + 1
+        merged = QuantileSketch(self.relative_accuracy)
+        with self._lock:
+            for slot, sketch in self._sketches.items():
+                if first <= slot <= current:
+                    merged.merge(sketch)
+        return merged
+
+    def merge(self, other):
+        """Add the slots of `other` (same slot_seconds and relative accuracy), e.g. another process's"""
+        if other.slot_seconds != self.slot_seconds:
+            raise ValueError(f"Cannot merge slots of {other.slot_seconds}s and {self.slot_seconds}s")
+        slots = other.snapshot()
+        with self._lock:
+            for slot, sketch in slots.items():
+                mine = self._sketches.get(slot)
+                if mine is None:
+                    self._sketches[slot] = QuantileSketch(self.relative_accuracy).merge(sketch)
+                else:
+                    mine.merge(sketch)
+            if self._sketches:
+                self._expire(max(self._slot(time.time()), max(self._sketches)))
+        return self
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._sketches)
+
+    def to_dict(self):
+        with self._lock:
+            slots = {str(slot): sketch.to_dict() for slot, sketch in self._sketches.items()}
+        return {"slot_seconds": self.slot_seconds, "slots": slots}
+
+    @classmethod
+    def from_dict(cls, data, slots=60, relative_accuracy=None):
+        rolling = cls(data["slot_seconds"], slots, relative_accuracy)
+        for slot, sketch in data["slots"].items():
+            rolling._sketches[int(slot)] = QuantileSketch.from_dict(sketch)
+        return rolling
+
+
+class SketchStore:
+    """
+    Periodic persistence of a RollingQuantiles
+
+    Args:
+        name: file name prefix, one per sketch of the service
+        sketch: the RollingQuantiles saved and restored
+        directory: default SKETCH_STATE_DIR; none disables persistence
+        interval: seconds between saves (default SKETCH_PERSIST_INTERVAL or 30, 0 disables persistence)
+        instance: stable name of this replica (default SKETCH_INSTANCE or the hostname)
+    """
+
+    def __init__(self, name, sketch, directory=None, interval=None, instance=None):
+        self.name = name
+        self.sketch = sketch
+        self.directory = directory or os.getenv("SKETCH_STATE_DIR")
+        self.interval = float(os.getenv("SKETCH_PERSIST_INTERVAL", "30")) if interval is None else interval
+        self.instance = instance or os.getenv("SKETCH_INSTANCE") or socket.gethostname()
+        # A live process saves every interval; older files are left by dead ones
+        self.stale_after = 3 * self.interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.interval > 0
+
+    def _path(self):
+        return os.path.join(self.directory, f"{self.name}-{self.instance}-{os.getpid()}.json")
+
+    def start(self):
+        """Restore the files left by stopped processes and start saving (once per process, after fork)"""
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.restore(at_start=True)
+        self._thread = threading.Thread(target=self._run, name=f"sketch-store-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.save()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.save()
+            self.restore()
+
+    def save(self):
+        path = self._path()
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self.sketch.to_dict(), f)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning("Failed to save sketch %s: %s", path, e)
+
+    def _files(self):
+        """(instance, pid, path) of the saved files of this sketch, of every instance"""
+        prefix = os.path.join(self.directory, f"{self.name}-")
+        for path in glob.glob(f"{glob.escape(prefix)}*.json"):
+            instance, _, pid = path[len(prefix):-len(".json")].rpartition("-")
+            if instance and pid.isdigit():
+                yield instance, int(pid), path
+
+    def _stale(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) > self.stale_after
+        except OSError:
+            return False
+
+    def _left_behind(self, instance, pid, path, at_start):
+        """Whether the file belongs to a process that is gone"""
+        if self._stale(path):
+            return True
+        if instance != self.instance:
+            # The pids of another host or container say nothing here
+            return False
+        if pid == os.getpid():
+            # Our own file, or at start one of an earlier process that had our pid
+            return at_start
+        return not _alive(pid)
+
+    def restore(self, at_start=False):
+        """
+        Merge the files left by stopped processes: those of this instance
+        whose process is gone and those of any instance not saved for
+        stale_after seconds
+        """
+        restored = 0
+        for instance, pid, path in self._files():
+            if not self._left_behind(instance, pid, path, at_start):
+                continue
+            # The rename makes sure only one of the starting workers takes a file over
+            claimed = f"{path}.claimed-{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed) as f:
+                    self.sketch.merge(RollingQuantiles.from_dict(json.load(f), self.sketch.slots))
+                restored += 1
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Ignoring unreadable sketch %s: %s", path, e)
+            finally:
+                os.unlink(claimed)
+        if restored:
+            logger.info("Restored %d saved %s sketch(es)", restored, self.name)
+
+    def siblings(self):
+        """RollingQuantiles last saved by the other live processes of this instance (other uvicorn workers)"""
+        if not self.enabled:
+            return []
+        sketches = []
+        for instance, pid, path in self._files():
+            if instance != self.instance or pid == os.getpid() or self._left_behind(instance, pid, path, False):
+                continue
+            try:
+                with open(path) as f:
+                    sketches.append(RollingQuantiles.from_dict(json.load(f), self.sketch.slots))
+            except (OSError, ValueError, KeyError):
+                continue
+        return sketches
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
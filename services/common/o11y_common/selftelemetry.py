@@ -0,0 +1,319 @@
+"""
+Self-telemetry of the span / log / metric export pipeline
+
+When spans are missing in Tempo the cause is usually one of:
+- the BatchSpanProcessor / BatchLogRecordProcessor queue was full and the SDK
+  silently dropped the oldest items (it only logs the first occurrence)
+- exports time out or are refused by the collector and the exporter gives up
+  after its retries
+
+PipelineTelemetry creates drop-counting batch processors and wraps the
+exporters, and exports (through the services' own MeterProvider):
+
+    telemetry_processor_queue_size{signal}              gauge
+    telemetry_processor_queue_capacity{signal}          gauge
+    telemetry_processor_dropped_total{signal}           counter
+    telemetry_exporter_batch_size{signal}               histogram (items per export)
+    telemetry_exporter_duration_seconds{signal,result}  histogram (retries included)
+    telemetry_exporter_items_total{signal,result}       counter
+    telemetry_exporter_rpc_errors_total{signal,code}    counter (every failed gRPC attempt)
+    telemetry_exporter_failures_total{signal,reason}    counter (exports given up)
+    telemetry_exporter_seconds_since_success{signal}    gauge
+
+Everything is recorded once per export batch, except the drop counter which
+costs one len() per span; queue sizes are only read at metric collection.
+
+The queues and the metric exporter's preferred temporality / aggregation are
+SDK internals, read through _sdk_attribute(): an SDK upgrade
+that renames them turns the affected metric off with one warning instead of
+breaking the export pipeline.
+"""
+import logging
+import threading
+import time
+
+from opentelemetry import metrics
+
+from .views import HistogramView
+
+logger = logging.getLogger(__name__)
+
+# Attribute names of opentelemetry-sdk==1.21.0, the version pinned in the services' requirements:
+# BatchSpanProcessor.queue / .max_queue_size, BatchLogRecordProcessor._queue / ._max_queue_size,
+# OTLPMetricExporter._preferred_temporality / ._preferred_aggregation, and the OTLP gRPC exporters'
+# ._client (optional, other exporters have none). Check them again when bumping the SDK.
+_MISSING = object()
+_warned = set()
+_warned_lock = threading.Lock()
+
+
+def _sdk_attribute(obj, name, default=None):
+    """`obj.name`, or `default` with a one-time warning when this SDK version does not have it"""
+    value = getattr(obj, name, _MISSING)
+    if value is not _MISSING:
+        return value
+    key = (type(obj).__name__, name)
+    with _warned_lock:
+        if key in _warned:
+            return default
+        _warned.add(key)
+    logger.warning(
+        "%s has no attribute %s (self-telemetry was written against opentelemetry-sdk 1.21.0), using %r",
+        key[0], name, default,
+    )
+    return default
+
+# Export calls include the exporter's retries (backoff up to 63s) and its 10s RPC timeout
+EXPORT_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# BatchSpanProcessor / BatchLogRecordProcessor export at most 512 items per call
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+
+
+def pipeline_views():
+    """Views of the two self-telemetry histograms, always explicit buckets"""
+    return [
+        HistogramView("telemetry_exporter_duration_seconds", EXPORT_DURATION_BUCKETS, ["signal", "result"], exponential=False),
+        HistogramView("telemetry_exporter_batch_size", BATCH_SIZE_BUCKETS, ["signal"], exponential=False),
+    ]
+
+
+class PipelineTelemetry:
+    """Instruments shared by the processors and exporters of one process"""
+
+    def __init__(self):
+        meter = metrics.get_meter(__name__)
+        self._queues = []       # (signal, deque, capacity)
+        self._last_success = {}
+        self._lock = threading.Lock()
+
+        meter.create_observable_gauge(
+            "telemetry_processor_queue_size", callbacks=[self._observe_queue_size],
+            description="Items waiting in the batch processor queue", unit="1",
+        )
+        meter.create_observable_gauge(
+            "telemetry_processor_queue_capacity", callbacks=[self._observe_queue_capacity],
+            description="Maximum size of the batch processor queue", unit="1",
+        )
+        meter.create_observable_gauge(
+            "telemetry_exporter_seconds_since_success", callbacks=[self._observe_since_success],
+            description="Seconds since the last successful export", unit="s",
+        )
+        self.dropped = meter.create_counter(
+            "telemetry_processor_dropped_total",
+            description="Items dropped because the batch processor queue was full", unit="1",
+        )
+        self.batch_size = meter.create_histogram(
+            "telemetry_exporter_batch_size", description="Items per export call", unit="1",
+        )
+        self.duration = meter.create_histogram(
+            "telemetry_exporter_duration_seconds",
+            description="Duration of export calls including retries", unit="s",
+        )
+        self.items = meter.create_counter(
+            "telemetry_exporter_items_total", description="Items passed to the exporter", unit="1",
+        )
+        self.rpc_errors = meter.create_counter(
+            "telemetry_exporter_rpc_errors_total", description="Failed export RPC attempts by status code", unit="1",
+        )
+        self.failures = meter.create_counter(
+            "telemetry_exporter_failures_total", description="Exports given up by reason", unit="1",
+        )
+
+    # ---- processors / exporters
+
+    def span_processor(self, exporter, **kwargs):
+        """BatchSpanProcessor that counts dropped spans, exporting through a wrapped `exporter`"""
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        telemetry = self
+        attributes = {"signal": "traces"}
+
+        class _CountingBatchSpanProcessor(BatchSpanProcessor):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self._watched_queue = _sdk_attribute(self, "queue")
+                self._watched_capacity = _sdk_attribute(self, "max_queue_size")
+
+            def on_end(self, span):
+                # The deque has maxlen, appending to a full queue discards the oldest span
+                queue = self._watched_queue
+                if (queue is not None and len(queue) == self._watched_capacity
+                        and span.context.trace_flags.sampled):
+                    telemetry.dropped.add(1, attributes)
+                super().on_end(span)
+
+        processor = _CountingBatchSpanProcessor(self.span_exporter(exporter), **kwargs)
+        self._watch_queue("traces", processor._watched_queue, processor._watched_capacity)
+        return processor
+
+    def log_processor(self, exporter, **kwargs):
+        """BatchLogRecordProcessor that counts dropped log records, exporting through a wrapped `exporter`"""
+        from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+
+        telemetry = self
+        attributes = {"signal": "logs"}
+
+        class _CountingBatchLogRecordProcessor(BatchLogRecordProcessor):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self._watched_queue = _sdk_attribute(self, "_queue")
+                self._watched_capacity = _sdk_attribute(self, "_max_queue_size")
+
+            def emit(self, log_data):
+                queue = self._watched_queue
+                if queue is not None and len(queue) == self._watched_capacity:
+                    telemetry.dropped.add(1, attributes)
+                super().emit(log_data)
+
+        processor = _CountingBatchLogRecordProcessor(self.log_exporter(exporter), **kwargs)
+        self._watch_queue("logs", processor._watched_queue, processor._watched_capacity)
+        return processor
+
+    def span_exporter(self, exporter):
+        from opentelemetry.sdk.trace.export import SpanExporter
+
+        recorder = _ExportRecorder(self, "traces", exporter)
+
+        class _SpanExporter(SpanExporter):
+            def export(self, spans):
+                return recorder.export(len(spans), exporter.export, spans)
+
+            def shutdown(self):
+                exporter.shutdown()
+
+            def force_flush(self, timeout_millis=30000):
+                return exporter.force_flush(timeout_millis)
+
+        return _SpanExporter()
+
+    def log_exporter(self, exporter):
+        from opentelemetry.sdk._logs.export import LogExporter
+
+        recorder = _ExportRecorder(self, "logs", exporter)
+
+        class _LogExporter(LogExporter):
+            def export(self, batch):
+                return recorder.export(len(batch), exporter.export, batch)
+
+            def shutdown(self):
+                exporter.shutdown()
+
+            def force_flush(self, timeout_millis=30000):
+                return exporter.force_flush(timeout_millis)
+
+        return _LogExporter()
+
+    def metric_exporter(self, exporter):
+        from opentelemetry.sdk.metrics.export import MetricExporter
+
+        recorder = _ExportRecorder(self, "metrics", exporter)
+
+        class _MetricExporter(MetricExporter):
+            def export(self, metrics_data, timeout_millis=10_000, **kwargs):
+                return recorder.export(
+                    _count_points(metrics_data), exporter.export, metrics_data, timeout_millis=timeout_millis, **kwargs
+                )
+
+            def shutdown(self, timeout_millis=30_000, **kwargs):
+                exporter.shutdown(timeout_millis=timeout_millis, **kwargs)
+
+            def force_flush(self, timeout_millis=10_000):
+                return exporter.force_flush(timeout_millis=timeout_millis)
+
+        # Without them the SDK defaults apply (cumulative, default aggregation)
+        return _MetricExporter(
+            preferred_temporality=_sdk_attribute(exporter, "_preferred_temporality"),
+            preferred_aggregation=_sdk_attribute(exporter, "_preferred_aggregation"),
+        )
+
+    # ---- observable callbacks
+
+    def _watch_queue(self, signal, queue, capacity):
+        if queue is None or capacity is None:
+            return
+        with self._lock:
+            self._queues.append((signal, queue, capacity))
+
+    def _observe_queue_size(self, options):
+        return [metrics.Observation(len(queue), {"signal": signal}) for signal, queue, _ in self._queues]
+
+    def _observe_queue_capacity(self, options):
+        return [metrics.Observation(capacity, {"signal": signal}) for signal, _, capacity in self._queues]
+
+    def _observe_since_success(self, options):
+        now = time.monotonic()
+        return [
+            metrics.Observation(now - last, {"signal": signal})
+            for signal, last in list(self._last_success.items())
+        ]
+
+
+def _count_points(metrics_data):
+    return sum(
+        len(metric.data.data_points)
+        for rm in metrics_data.resource_metrics
+        for sm in rm.scope_metrics
+        for metric in sm.metrics
+    )
+
+
+class _ExportRecorder:
+    """Times one exporter's export calls and records why they failed"""
+
+    def __init__(self, telemetry, signal, exporter):
+        self.telemetry = telemetry
+        self.signal = signal
+        self.attributes = {"signal": signal}
+        self.success = {"signal": signal, "result": "success"}
+        self.failure = {"signal": signal, "result": "failure"}
+        # Each exporter is driven by a single thread (processor worker / metric reader)
+        self.last_rpc_error = None
+        telemetry._last_success[signal] = time.monotonic()
+
+        # The OTLP gRPC exporters retry internally and only return FAILURE, so
+        # the status code of each attempt is taken from the stub they call
+        # Only the OTLP gRPC exporters have a stub, the others are timed without per-attempt codes
+        client = getattr(exporter, "_client", None)
+        if client is not None and hasattr(client, "Export"):
+            exporter._client = _RecordingStub(client, self)
+
+    def export(self, count, fn, *args, **kwargs):
+        telemetry = self.telemetry
+        self.last_rpc_error = None
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._record(start, count, False, type(e).__name__)
+            raise
+        ok = result.name == "SUCCESS"
+        self._record(start, count, ok, self.last_rpc_error or "export_failed")
+        if ok:
+            telemetry._last_success[self.signal] = time.monotonic()
+        return result
+
+    def _record(self, start, count, ok, reason):
+        telemetry = self.telemetry
+        attributes = self.success if ok else self.failure
+        telemetry.duration.record(time.monotonic() - start, attributes)
+        telemetry.batch_size.record(count, self.attributes)
+        telemetry.items.add(count, attributes)
+        if not ok:
+            telemetry.failures.add(1, {"signal": self.signal, "reason": reason})
+
+
+class _RecordingStub:
+    """gRPC stub proxy counting failed Export attempts by status code"""
+
+    def __init__(self, stub, recorder):
+        self._stub = stub
+        self._recorder = recorder
+
+    def Export(self, *args, **kwargs):
+        try:
+            return self._stub.Export(*args, **kwargs)
+        except Exception as e:
+            code = e.code().name if hasattr(e, "code") else type(e).__name__
+            self._recorder.last_rpc_error = code
+            self._recorder.telemetry.rpc_errors.add(1, {"signal": self._recorder.signal, "code": code})
+            raise
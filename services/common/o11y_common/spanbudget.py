@@ -0,0 +1,261 @@
+"""
+Attribute and event budget of the spans, applied before they are exported
+
+Some span data is redundant or oversized: Service A's `trace_id` attribute
+repeats the span context, `error.message` and exception events carry whole
+exception texts, and the hybrid variant's business spans repeat
+`instrumentation.type`, which is already a resource attribute, and
+`external.api.url`, the `http.url` of their HTTP client child span. Every such
+attribute is queued, encoded and sent with each span.
+
+SpanBudgetProcessor runs in on_end, before the exporting processor (see
+TelemetryBootstrap(span_processors=...)), and rewrites the ended span:
+
+- rules by attribute key (glob patterns), for span and event attributes:
+  `drop`, `truncate:<characters>` or `hash` (first 16 hex digits of the
+  SHA-256, still usable to group or compare values)
+- at most `max_attributes` attributes and `max_events` events per span, the
+  first ones set are kept
+
+Dropped attributes and events are added to the span's dropped counts, so the
+backend shows that something was removed. The processor estimates what each
+change saves from the key and value sizes (not the exact protobuf encoding,
+see benchmarks/bench_span_budget.py for that) and exports:
+
+    span_budget_saved_bytes_total{action}      counter
+    span_budget_changes_total{action}          counter, attributes / events changed
+
+with action = drop / truncate / hash / attribute_limit / event_limit.
+
+The SDK hands the same ReadableSpan to every processor, so replacing its
+attributes and events here changes what the exporting processor queues.
+Configured with SPAN_BUDGET (default false), SPAN_BUDGET_RULES,
+SPAN_BUDGET_MAX_ATTRIBUTES and SPAN_BUDGET_MAX_EVENTS.
+"""
+import fnmatch
+import hashlib
+import os
+import re
+
+from opentelemetry import metrics
+from opentelemetry.attributes import BoundedAttributes
+
+DEFAULT_RULES = (
+    "trace_id=drop,instrumentation.type=drop,external.api.url=drop,"
+    "error.message=truncate:256,exception.message=truncate:256,exception.stacktrace=truncate:2048"
+)
+
+_HASH_LENGTH = 16
+# Keys seen per process are a fixed set; the cache only guards against unbounded dynamic keys
+_MAX_CACHED_KEYS = 4096
+
+
+def span_budget_enabled():
+    return os.getenv("SPAN_BUDGET", "false").lower() == "true"
+
+
+def parse_rules(spec):
+    """`key=action,...` -> [(key pattern, action, truncate length)]"""
+    rules = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        key, sep, action = entry.partition("=")
+        action, _, length = action.strip().partition(":")
+        if not sep or action not in ("drop", "truncate", "hash") or (action == "truncate") != bool(length):
+            raise ValueError(f"Invalid span budget rule {entry!r}, expected key=drop|hash|truncate:<n>")
+        rules.append((key.strip(), action, int(length) if length else None))
+    return rules
+
+
+class SpanBudgetProcessor:
+    """
+    A span processor by duck typing, so that importing this module does not
+    import the SDK (see bootstrap).
+
+    Args:
+        rules: `key=action,...` (default: SPAN_BUDGET_RULES or DEFAULT_RULES)
+        max_attributes: per span (default: SPAN_BUDGET_MAX_ATTRIBUTES or 32, 0 = no limit)
+        max_events: per span (default: SPAN_BUDGET_MAX_EVENTS or 16, 0 = no limit)
+        enabled: default SPAN_BUDGET
+    """
+
+    def __init__(self, rules=None, max_attributes=None, max_events=None, enabled=None):
+        self.enabled = span_budget_enabled() if enabled is None else enabled
+        self.rules = parse_rules(os.getenv("SPAN_BUDGET_RULES", DEFAULT_RULES) if rules is None else rules)
+        self.max_attributes = (
+            int(os.getenv("SPAN_BUDGET_MAX_ATTRIBUTES", "32")) if max_attributes is None else max_attributes
+        )
+        self.max_events = int(os.getenv("SPAN_BUDGET_MAX_EVENTS", "16")) if max_events is None else max_events
+        self._exact = {}
+        self._patterns = []
+        for key, action, length in self.rules:
+            if any(c in key for c in "*?["):
+                self._patterns.append((re.compile(fnmatch.translate(key)), (action, length)))
+            else:
+                self._exact.setdefault(key, (action, length))
+        self._cache = {}
+
+        meter = metrics.get_meter(__name__)
+        self.saved_bytes = meter.create_counter(
+            "span_budget_saved_bytes_total",
+            description="Estimated span bytes removed before export by the span budget", unit="By",
+        )
+        self.changes = meter.create_counter(
+            "span_budget_changes_total",
+            description="Span attributes and events dropped, truncated or hashed before export", unit="1",
+        )
+
+    def span_processors(self):
+        """Span processors to pass to TelemetryBootstrap(span_processors=...)"""
+        return [self] if self.enabled else []
+
+    def install_first(self, tracer_provider):
+        """
+        Run before the processors already added to an SDK TracerProvider
+
+        For providers created by opentelemetry-instrument (main_hybrid.py),
+        whose exporting processor is added before the application starts.
+        Relies on the SDK's SynchronousMultiSpanProcessor internals.
+        """
+        if not self.enabled:
+            return
+        active = getattr(tracer_provider, "_active_span_processor", None)
+        if active is None or not hasattr(active, "_span_processors"):
+            return
+        with active._lock:
+            active._span_processors = (self,) + tuple(active._span_processors)
+
+    def _rule(self, key):
+        rule = self._cache.get(key, False)
+        if rule is not False:
+            return rule
+        rule = self._exact.get(key)
+        if rule is None:
+            for pattern, pattern_rule in self._patterns:
+                if pattern.match(key):
+                    rule = pattern_rule
+                    break
+        if len(self._cache) < _MAX_CACHED_KEYS:
+            self._cache[key] = rule
+        return rule
+
+    # ---- span processor interface
+
+    def on_start(self, span, parent_context=None):
+        pass
+
+    def on_end(self, span):
+        savings = {}
+        attributes = span._attributes
+        if attributes:
+            rewritten = self._apply(attributes, self.max_attributes, savings)
+            if rewritten is not None:
+                span._attributes = rewritten
+        events = span._events
+        if events:
+            rewritten = self._apply_events(events, savings)
+            if rewritten is not None:
+                span._events = rewritten
+        for action, (count, saved) in savings.items():
+            self.changes.add(count, {"action": action})
+            self.saved_bytes.add(saved, {"action": action})
+
+    def shutdown(self):
+        pass
+
+    def force_flush(self, timeout_millis=30000):
+        return True
+
+    # ---- rewriting
+
+    def _apply(self, attributes, limit, savings):
+        """New BoundedAttributes with the rules and the limit applied, None if nothing changes"""
+        result = None
+        dropped = 0
+        kept = 0
+        for position, (key, value) in enumerate(attributes.items()):
+            rule = self._rule(key)
+            new_value = value
+            if rule is not None:
+                action, length = rule
+                if action == "drop":
+                    new_value = None
+                elif action == "truncate":
+                    if isinstance(value, str) and len(value) > length:
+                        new_value = value[:length]
+                elif isinstance(value, str):
+                    new_value = hashlib.sha256(value.encode("utf-8", "replace")).hexdigest()[:_HASH_LENGTH]
+                if new_value is not value:
+                    saved = _size(key, value) - (_size(key, new_value) if new_value is not None else 0)
+                    if saved <= 0 and new_value is not None:
+                        # Hash of a value shorter than the hash
+                        new_value = value
+                    else:
+                        _count(savings, action, saved)
+                        if result is None:
+                            result = dict(list(attributes.items())[:position])
+                        if new_value is None:
+                            dropped += 1
+                            continue
+            if limit and kept >= limit:
+                _count(savings, "attribute_limit", _size(key, new_value))
+                dropped += 1
+                if result is None:
+                    result = dict(list(attributes.items())[:position])
+                continue
+            kept += 1
+            if result is not None:
+                result[key] = new_value
+        if result is None:
+            return None
+        rewritten = BoundedAttributes(attributes=result, immutable=True)
+        rewritten.dropped = getattr(attributes, "dropped", 0) + dropped
+        return rewritten
+
+    def _apply_events(self, events, savings):
+        """New event list with the event limit and the attribute rules applied, None if nothing changes"""
+        from opentelemetry.sdk.trace import Event
+        from opentelemetry.sdk.util import BoundedList
+
+        kept = list(events)
+        dropped = 0
+        if self.max_events and len(kept) > self.max_events:
+            for event in kept[self.max_events:]:
+                _count(savings, "event_limit", len(event.name) + sum(
+                    _size(key, value) for key, value in (event.attributes or {}).items()
+                ))
+            dropped = len(kept) - self.max_events
+            kept = kept[:self.max_events]
+        changed = dropped > 0
+        for i, event in enumerate(kept):
+            if not event.attributes:
+                continue
+            attributes = self._apply(event.attributes, 0, savings)
+            if attributes is not None:
+                kept[i] = Event(event.name, attributes, event.timestamp)
+                changed = True
+        if not changed:
+            return None
+        rewritten = BoundedList.from_seq(None, kept)
+        rewritten.dropped = getattr(events, "dropped", 0) + dropped
+        return rewritten
+
+
+def _count(savings, action, saved):
+    count, total = savings.get(action, (0, 0))
+    savings[action] = (count + 1, total + max(0, saved))
+
+
+def _size(key, value):
+    """Rough encoded size of an attribute: key, value and a few bytes of framing"""
+    if isinstance(value, str):
+        size = len(value)
+    elif isinstance(value, (bool, int, float)):
+        size = 8
+    elif isinstance(value, (tuple, list)):
+        size = sum(len(item) if isinstance(item, str) else 8 for item in value)
+    else:
+        size = 8
+    return len(key) + size + 4
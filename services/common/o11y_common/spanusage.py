@@ -0,0 +1,153 @@
+"""
+CPU time, GIL wait and allocations of selected spans
+
+A span's duration mixes the CPU work done in it with time spent waiting: for
+the GIL, for a CPU (run queue) or in I/O. For spans that run in one thread
+and do no I/O, such as Service D's compute stages, SpanUsage splits the
+duration up and records on the span and as histograms per span name:
+
+    span.cpu_time_seconds          CPU time of the thread (time.thread_time)
+    span.runqueue_wait_seconds     time runnable but not scheduled by the OS
+                                   (Linux /proc/self/task/<tid>/schedstat)
+    span.gil_wait_seconds          estimate: duration - CPU time - run queue
+                                   wait; for a span that does no I/O or
+                                   sleep() the thread was waiting for the GIL
+    span.alloc.peak_bytes          sampled: peak memory allocated while the
+    span.alloc.retained_bytes      span ran, and what was still allocated at
+                                   its end (tracemalloc)
+
+tracemalloc slows down every allocation of the process while it traces, so it
+only runs for a sampled fraction of the measured spans and for one span at a
+time. It counts the allocations of all threads, so with concurrent requests
+the numbers are an upper bound for the span, and the CPU time of a sampled
+span includes the tracing overhead.
+
+Spans are measured explicitly, which keeps the cost off all other spans:
+
+    with tracer.start_as_current_span("service_d.fibonacci") as span, span_usage.measure(span):
+        ...
+
+Disabled unless SPAN_USAGE=true.
+"""
+import contextlib
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from opentelemetry import metrics
+
+from .views import HistogramView
+
+CPU_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+ALLOC_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+_NOT_MEASURED = contextlib.nullcontext()
+
+
+def span_usage_views():
+    return [
+        HistogramView("span_cpu_time_seconds", CPU_BUCKETS, attribute_keys={"span.name"}, exponential=False),
+        HistogramView("span_gil_wait_seconds", CPU_BUCKETS, attribute_keys={"span.name"}, exponential=False),
+        HistogramView("span_allocated_bytes", ALLOC_BUCKETS, attribute_keys={"span.name"}, exponential=False),
+    ]
+
+
+class SpanUsage:
+    """
+    Args:
+        enabled: measure spans passed to measure() (default: SPAN_USAGE)
+        alloc_sample_rate: fraction of the measured spans whose allocations
+            are traced (default: SPAN_USAGE_ALLOC_SAMPLE_RATE or 0.01)
+    """
+
+    def __init__(self, enabled=None, alloc_sample_rate=None):
+        self.enabled = (
+            os.getenv("SPAN_USAGE", "false").lower() == "true" if enabled is None else enabled
+        )
+        self.alloc_sample_rate = (
+            float(os.getenv("SPAN_USAGE_ALLOC_SAMPLE_RATE", "0.01"))
+            if alloc_sample_rate is None else alloc_sample_rate
+        )
+        self._tracing = threading.Lock()
+
+        meter = metrics.get_meter(__name__)
+        self.cpu_time = meter.create_histogram(
+            "span_cpu_time_seconds", description="CPU time of the thread while the span ran", unit="s",
+        )
+        self.gil_wait = meter.create_histogram(
+            "span_gil_wait_seconds",
+            description="Estimated GIL wait of the span: duration minus CPU time and run queue wait", unit="s",
+        )
+        self.allocated = meter.create_histogram(
+            "span_allocated_bytes", description="Peak memory allocated while the span ran (sampled)", unit="By",
+        )
+
+    def measure(self, span):
+        """Context manager measuring the block the span is active in"""
+        if not self.enabled or not span.is_recording():
+            return _NOT_MEASURED
+        return _Measurement(self, span)
+
+    def _start_tracing(self):
+        """Start tracemalloc for a sampled span, if no other span or code is tracing"""
+        if random.random() >= self.alloc_sample_rate or not self._tracing.acquire(blocking=False):
+            return False
+        if tracemalloc.is_tracing():
+            self._tracing.release()
+            return False
+        tracemalloc.start(1)
+        return True
+
+    def _stop_tracing(self):
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._tracing.release()
+        return retained, peak
+
+
+class _Measurement:
+    __slots__ = ("usage", "span", "native_id", "wall", "cpu", "runqueue", "tracing")
+
+    def __init__(self, usage, span):
+        self.usage = usage
+        self.span = span
+
+    def __enter__(self):
+        self.native_id = threading.get_native_id()
+        self.tracing = self.usage._start_tracing()
+        self.runqueue = _runqueue_seconds(self.native_id)
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        runqueue = _runqueue_seconds(self.native_id)
+        runqueue = runqueue - self.runqueue if runqueue is not None and self.runqueue is not None else 0.0
+        gil_wait = max(0.0, wall - cpu - runqueue)
+
+        usage, span = self.usage, self.span
+        attributes = {"span.name": span.name}
+        span.set_attribute("span.cpu_time_seconds", round(cpu, 6))
+        span.set_attribute("span.runqueue_wait_seconds", round(runqueue, 6))
+        span.set_attribute("span.gil_wait_seconds", round(gil_wait, 6))
+        usage.cpu_time.record(cpu, attributes)
+        usage.gil_wait.record(gil_wait, attributes)
+        if self.tracing:
+            retained, peak = usage._stop_tracing()
+            span.set_attribute("span.alloc.peak_bytes", peak)
+            span.set_attribute("span.alloc.retained_bytes", retained)
+            usage.allocated.record(peak, attributes)
+        return False
+
+
+def _runqueue_seconds(native_id):
+    """Seconds the thread spent waiting for a CPU, None without schedstats"""
+    try:
+        with open(f"/proc/self/task/{native_id}/schedstat") as f:
+            return int(f.read().split()[1]) / 1e9
+    except (OSError, IndexError, ValueError):
+        return None
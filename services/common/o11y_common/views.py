@@ -0,0 +1,105 @@
+"""
+Metric views for the services' MeterProvider
+
+The SDK's default explicit buckets (0, 5, 10, 25, ..., 10000) are meant for
+milliseconds. The services record seconds, so nearly every observation of
+service_a_db_query_duration_seconds or service_d_compute_duration_seconds
+lands in the (0, 5] bucket and histogram_quantile() cannot say anything
+useful, while the 16 mostly empty buckets still become Prometheus series.
+
+HistogramView describes, per instrument:
+- explicit bucket boundaries fitted to the expected range, or
+- a base-2 exponential histogram (OTEL_METRICS_EXPONENTIAL_HISTOGRAMS=true)
+- an attribute allow-list; any other attribute is dropped before aggregation,
+  which caps the number of series
+
+Views are plain descriptions so services can declare them at import time;
+the SDK View objects are built by TelemetryBootstrap when the MeterProvider
+is created.
+
+Exemplars are not configured here: SDK 1.21 has no exemplar support, the
+trace exemplars in Grafana come from the collector's spanmetrics connector.
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Before 1.25 the SDK exported the exponential histogram's circular bucket array
+# without un-rotating it, so bucket counts were misaligned for unsorted input
+_MIN_EXPONENTIAL_SDK_VERSION = (1, 25)
+
+
+def exponential_histograms_enabled():
+    """OTEL_METRICS_EXPONENTIAL_HISTOGRAMS=true switches tuned histograms to base-2 exponential"""
+    return os.getenv("OTEL_METRICS_EXPONENTIAL_HISTOGRAMS", "false").lower() == "true"
+
+
+def exponential_histograms_supported():
+    """Whether the installed SDK exports correct exponential histogram buckets"""
+    from opentelemetry.sdk.version import __version__
+
+    version = tuple(int(part) for part in __version__.split(".")[:2])
+    return version >= _MIN_EXPONENTIAL_SDK_VERSION
+
+
+class HistogramView:
+    """
+    Aggregation and attribute allow-list for one histogram instrument
+
+    Args:
+        instrument_name: name passed to meter.create_histogram()
+        boundaries: explicit bucket upper bounds, in the instrument's unit
+        attribute_keys: attributes to keep (None keeps all)
+        exponential: use a base-2 exponential histogram instead of `boundaries`
+            (default: OTEL_METRICS_EXPONENTIAL_HISTOGRAMS). Falls back to
+            `boundaries` with a warning on SDKs older than 1.25
+        max_size: maximum number of buckets of the exponential histogram
+    """
+
+    def __init__(self, instrument_name, boundaries=None, attribute_keys=None, exponential=None, max_size=160):
+        if boundaries is not None and list(boundaries) != sorted(boundaries):
+            raise ValueError(f"{instrument_name}: bucket boundaries must be increasing")
+        self.instrument_name = instrument_name
+        self.boundaries = tuple(boundaries) if boundaries is not None else None
+        self.attribute_keys = set(attribute_keys) if attribute_keys is not None else None
+        self.exponential = exponential_histograms_enabled() if exponential is None else exponential
+        self.max_size = max_size
+
+    def to_sdk_view(self):
+        from opentelemetry.sdk.metrics.view import (
+            DefaultAggregation,
+            ExplicitBucketHistogramAggregation,
+            ExponentialBucketHistogramAggregation,
+            View,
+        )
+
+        exponential = self.exponential
+        if exponential and not exponential_histograms_supported():
+            logger.warning(
+                "%s: exponential histograms need opentelemetry-sdk >= 1.25, using explicit buckets",
+                self.instrument_name,
+            )
+            exponential = False
+
+        if exponential:
+            aggregation = ExponentialBucketHistogramAggregation(max_size=self.max_size)
+        elif self.boundaries is not None:
+            aggregation = ExplicitBucketHistogramAggregation(boundaries=self.boundaries)
+        else:
+            aggregation = DefaultAggregation()
+
+        return View(
+            instrument_name=self.instrument_name,
+            attribute_keys=self.attribute_keys,
+            aggregation=aggregation,
+        )
+
+
+# Bucket layouts for the latency ranges seen in the lab, in seconds
+# Sub-millisecond to tens of milliseconds: database round trips
+DB_QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+# 0.1 - 0.5s with fine resolution: Service D compute (random sleep 0.1-0.5s + CPU work)
+COMPUTE_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.6, 0.75, 1.0, 2.0)
+# Full request through the gateway: Service A fans out to D, B, the DB and a third-party API
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0, 30.0)
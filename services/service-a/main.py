@@ -6,35 +6,44 @@ Service A - 核心业务服务
 - 第三方 API 调用
 """
 import os
+import asyncio
 import logging
 import time
 import random
+from functools import partial
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
 import httpx
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from opentelemetry import trace, metrics
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
-from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
-from opentelemetry.instrumentation.logging import LoggingInstrumentor
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
-from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME, SERVICE_VERSION
-from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
-from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+from o11y_common.adaptivetimeout import AdaptiveTimeouts
+from o11y_common.bootstrap import (
+    TelemetryBootstrap, instrument_fastapi, instrument_httpx, instrument_httpx_client, instrument_psycopg2,
+    worker_count,
+)
+from o11y_common.deadline import DeadlineExceeded, DeadlineMiddleware, current_deadline
+from o11y_common.health import HealthChecks, exporter_backlog_check, http_check, install_probe_log_filter
+from o11y_common.jsonlog import configure_logging
+from o11y_common.lazylog import Truncated, install_hot_path_filters
+from o11y_common.loopmonitor import LoopMonitor, loop_monitor_views
+from o11y_common.microbatch import MicroBatcher, item_context, item_links, microbatch_views
+from o11y_common.profiler import SpanProfiler
+from o11y_common.spanbudget import SpanBudgetProcessor
+from o11y_common.quantilesketch import RollingQuantiles, SketchStore
+from o11y_common.views import HistogramView, DB_QUERY_BUCKETS
 
 # 配置结构化日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='{"time":"%(asctime)s", "level":"%(levelname)s", "service":"service-a", "trace_id":"%(otelTraceID)s", "span_id":"%(otelSpanID)s", "message":"%(message)s"}'
-)
+configure_logging("service-a")
 logger = logging.getLogger(__name__)
+# 热路径日志: 按调用点限流, 未采样的 trace 只保留 WARNING 及以上
+install_hot_path_filters(
+    logger,
+    rate=float(os.getenv("LOG_CALLSITE_RATE", "10")),
+    unsampled_level=os.getenv("LOG_UNSAMPLED_LEVEL", "WARNING"),
+)
+# 探针请求 (/health, /health/live, /health/ready) 不写 access log
+install_probe_log_filter()
 
 # 环境变量配置
 SERVICE_B_URL = os.getenv("SERVICE_B_URL", "http://service-b:8002")
@@ -46,58 +55,89 @@ DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "o11ylab")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
+# SERVICE_B_BATCHING=true: 多个请求的 enqueue 合并成一次 POST /enqueue/batch (MICROBATCH_MAX_SIZE, MICROBATCH_MAX_WAIT_MS)
+SERVICE_B_BATCHING = os.getenv("SERVICE_B_BATCHING", "false").lower() == "true"
+# 其他副本的地址 (逗号分隔), /stats 合并它们的 duration sketch
+STATS_PEERS = [url.strip() for url in os.getenv("STATS_PEERS", "").split(",") if url.strip()]
 
-# 配置 OpenTelemetry Resource
-resource = Resource(attributes={
-    SERVICE_NAME: "service-a",
-    SERVICE_VERSION: "1.0.0",
-    "service.namespace": "o11y-lab",
-    "deployment.environment": "lab"
-})
-
-# 配置 Tracer Provider
-trace_provider = TracerProvider(resource=resource)
-trace_provider.add_span_processor(
-    BatchSpanProcessor(OTLPSpanExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True))
-)
-trace.set_tracer_provider(trace_provider)
-
-# 配置 Meter Provider
-metric_reader = PeriodicExportingMetricReader(
-    OTLPMetricExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True)
-)
-meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
-metrics.set_meter_provider(meter_provider)
-
-# 配置 Logger Provider for OTLP log export
-logger_provider = LoggerProvider(resource=resource)
-logger_provider.add_log_record_processor(
-    BatchLogRecordProcessor(OTLPLogExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True))
-)
-
-# 添加 OTLP logging handler
-handler = LoggingHandler(level=logging.NOTSET, logger_provider=logger_provider)
-logging.getLogger().addHandler(handler)
-
-# 自动埋点日志（添加 trace context）
-LoggingInstrumentor().instrument(set_logging_format=True)
-
-# 自动埋点 psycopg2 (PostgreSQL)
-Psycopg2Instrumentor().instrument()
+# WEB_CONCURRENCY > 1: 多 worker 进程, 每个 worker 启动后各自初始化 telemetry
+WORKERS = worker_count()
 
 # 创建 FastAPI app
 app = FastAPI(title="Service A", version="1.0.0")
+# 请求预算 (x-request-budget-ms) 由 gateway 设定, 每一跳扣除已用时间后继续传递
+app.add_middleware(DeadlineMiddleware)
+
+# 采样 profiler (PROFILER_HZ > 0 时启用), 样本按 span / trace 归类
+profiler = SpanProfiler("service-a")
+# 导出前按规则删除 / 截断 / hash span 属性, 限制属性与事件数 (SPAN_BUDGET=true 时启用)
+span_budget = SpanBudgetProcessor()
+
+# batch 共用一个连接池
+# lazy / 多 worker 模式下 instrument_httpx 在创建之后才执行, 所以由 instrument_httpx_client 单独埋点
+service_b_client = httpx.AsyncClient() if SERVICE_B_BATCHING else None
+
+# Tracer / Meter / Logger Provider + psycopg2, FastAPI, HTTPX 自动埋点
+telemetry = TelemetryBootstrap(
+    resource_attributes={
+        "service.name": "service-a",
+        "service.version": "1.0.0",
+        "service.namespace": "o11y-lab",
+        "deployment.environment": "lab"
+    },
+    endpoint=OTEL_COLLECTOR_ENDPOINT,
+    per_worker=WORKERS > 1,
+    span_processors=profiler.span_processors() + span_budget.span_processors(),
+    views=[
+        HistogramView("service_a_db_query_duration_seconds", DB_QUERY_BUCKETS, attribute_keys={"operation"}),
+        *loop_monitor_views(),
+        *microbatch_views(),
+    ],
+    instrumentors=[
+        instrument_psycopg2, partial(instrument_fastapi, app),
+        *([partial(instrument_httpx_client, service_b_client)] if service_b_client else []),
+        instrument_httpx,
+    ],
+)
+# OTEL_LAZY_INIT=true 或多 worker 时延迟到 startup 初始化
+telemetry.init_at_import()
 
-# 自动埋点 FastAPI
-FastAPIInstrumentor.instrument_app(app)
-
-# 自动埋点 HTTPX
-HTTPXClientInstrumentor().instrument()
+# Event loop 延迟 / 阻塞调用监控 (LOOP_MONITOR_INTERVAL, LOOP_SLOW_CALLBACK_THRESHOLD)
+loop_monitor = LoopMonitor()
 
 # 获取 tracer 和 meter
 tracer = trace.get_tracer(__name__)
 meter = metrics.get_meter(__name__)
 
+# 下游超时 = 观测到的 p99 x 倍数, 限制在 floor / ceiling 之间 (ADAPTIVE_TIMEOUTS=false: 固定 ceiling)
+timeouts = AdaptiveTimeouts(timeout_errors=(httpx.TimeoutException,))
+third_party_timeout = timeouts.downstream("third_party_api", floor=0.5, ceiling=5.0)
+service_d_timeout = timeouts.downstream("service_d", floor=1.0, ceiling=10.0)
+service_b_timeout = timeouts.downstream("service_b", floor=0.5, ceiling=10.0)
+# POST /enqueue/batch 的延迟分布与单条 /enqueue 不同, 单独计算超时
+service_b_batch_timeout = timeouts.downstream("service_b_batch", floor=0.5, ceiling=10.0)
+
+async def send_enqueue_batch(messages):
+    """一次把一批消息发给 Service B, 返回每条消息的结果; batch span 以 link 关联各请求的 span"""
+    with tracer.start_as_current_span("service_a.enqueue_batch", links=item_links(messages)) as span:
+        span.set_attribute("messaging.batch.message_count", len(messages))
+        with service_b_batch_timeout.track() as timeout:
+            response = await service_b_client.post(
+                f"{SERVICE_B_URL}/enqueue/batch",
+                json={"messages": messages},
+                timeout=timeout
+            )
+        span.set_attribute("http.status_code", response.status_code)
+        response.raise_for_status()
+        return response.json()["results"]
+
+enqueue_batcher = MicroBatcher("service_b_enqueue", send_enqueue_batch)
+
+# /process 的 duration_ms: 每分钟一个 DDSketch, 保留 1 小时; 定期保存, 重启后恢复
+STATS_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+duration_sketch = RollingQuantiles(slot_seconds=60, slots=60)
+sketch_store = SketchStore("service-a-duration", duration_sketch)
+
 # 自定义 metrics
 process_counter = meter.create_counter(
     name="service_a_process_total",
@@ -129,9 +169,29 @@ def get_db_connection():
         )
         return conn
     except Exception as e:
-        logger.error(f"Failed to connect to database: {str(e)}")
+        logger.error("Failed to connect to database: %s", e)
         raise
 
+def check_database():
+    """只建立连接不执行查询, 不产生 psycopg2 span"""
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        connect_timeout=2
+    )
+    conn.close()
+
+# 依赖检查在后台定期执行 (HEALTH_CHECK_INTERVAL), /health/ready 直接返回缓存的结果
+# 数据库不可用时 not ready; 下游服务与 exporter 队列只算 degraded
+health_checks = HealthChecks("service-a")
+health_checks.add("database", check_database)
+health_checks.add("service_d", http_check(f"{SERVICE_D_URL}/health/live"), critical=False)
+health_checks.add("service_b", http_check(f"{SERVICE_B_URL}/health"), critical=False)
+health_checks.add("exporter_backlog", exporter_backlog_check(telemetry), critical=False)
+
 def init_db():
     """Initialize the database schema"""
     try:
@@ -154,20 +214,46 @@ def init_db():
         conn.close()
         logger.info("Database initialized successfully")
     except Exception as e:
-        logger.error(f"Failed to initialize database: {str(e)}")
+        logger.error("Failed to initialize database: %s", e)
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize resources on startup"""
     logger.info("Service A starting up...")
+    telemetry.init_at_startup()
+    if not telemetry.disabled:
+        loop_monitor.start()
+        profiler.start()
     init_db()
+    sketch_store.start()
+    health_checks.start()
     logger.info("Service A startup complete")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Send the pending enqueue batch, save the duration sketch"""
+    health_checks.stop()
+    sketch_store.stop()
+    if service_b_client is not None:
+        await enqueue_batcher.close()
+        await service_b_client.aclose()
+
 @app.get("/health")
 async def health():
-    """Health check endpoint"""
-    logger.info("Health check called")
-    return {"status": "healthy", "service": "service-a"}
+    """Liveness check endpoint (kept for existing probes), not logged or traced"""
+    return health_checks.live()[1]
+
+@app.get("/health/live")
+async def health_live():
+    """Liveness: 进程能处理请求即可"""
+    code, body = health_checks.live()
+    return JSONResponse(body, status_code=code)
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness: 后台依赖检查的缓存结果"""
+    code, body = health_checks.ready()
+    return JSONResponse(body, status_code=code)
 
 @app.get("/process")
 async def process():
@@ -176,6 +262,7 @@ async def process():
     Invokes database operations, third-party API, Service D and Service B
     """
     start_time = time.time()
+    deadline = current_deadline()
     logger.info("Starting process request in Service A")
 
     process_counter.add(1, {"endpoint": "/process"})
@@ -191,6 +278,7 @@ async def process():
             db_start = time.time()
 
             with tracer.start_as_current_span("service_a.database_query"):
+                deadline.check("database_query")
                 conn = get_db_connection()
                 cur = conn.cursor(cursor_factory=RealDictCursor)
 
@@ -211,20 +299,24 @@ async def process():
 
             db_duration = time.time() - db_start
             db_query_duration.record(db_duration, {"operation": "insert_and_query"})
-            logger.info(f"Database query completed in {db_duration:.3f}s, log_id={log_id}, recent_requests={recent_requests}")
+            logger.info("Database query completed in %.3fs, log_id=%s, recent_requests=%s", db_duration, log_id, recent_requests)
 
             # 2. Invoke third-party API
-            logger.info(f"Calling third-party API: {THIRD_PARTY_API}")
+            logger.info("Calling third-party API: %s", THIRD_PARTY_API)
             external_call_counter.add(1, {"target": "third_party_api"})
 
             with tracer.start_as_current_span("service_a.call_third_party_api"):
+                deadline.check("call_third_party_api")
                 async with httpx.AsyncClient() as client:
                     try:
-                        third_party_response = await client.get(THIRD_PARTY_API, timeout=5.0)
+                        with third_party_timeout.track(deadline) as timeout:
+                            third_party_response = await client.get(THIRD_PARTY_API, timeout=timeout)
                         third_party_data = third_party_response.text
-                        logger.info(f"Third-party API response: {third_party_data[:50]}...")
+                        logger.info("Third-party API response: %s", Truncated(third_party_data, 50))
                     except Exception as e:
-                        logger.warning(f"Third-party API call failed: {str(e)}")
+                        if deadline.expired():
+                            raise deadline.exceeded("call_third_party_api")
+                        logger.warning("Third-party API call failed: %s", e)
                         third_party_data = "unavailable"
 
             # 3. invoke Service D and Service B
@@ -234,35 +326,56 @@ async def process():
 
             async with httpx.AsyncClient() as client:
                 with tracer.start_as_current_span("service_a.call_service_d"):
+                    deadline.check("call_service_d")
                     try:
-                        service_d_response = await client.get(
-                            f"{SERVICE_D_URL}/compute",
-                            params={"value": random.randint(1, 100)},
-                            timeout=10.0
-                        )
+                        with service_d_timeout.track(deadline) as timeout:
+                            service_d_response = await client.get(
+                                f"{SERVICE_D_URL}/compute",
+                                params={"value": random.randint(1, 100)},
+                                headers=deadline.headers(),
+                                timeout=timeout
+                            )
                         service_d_data = service_d_response.json()
-                        logger.info(f"Service D response: {service_d_data}")
+                        logger.info("Service D response: %s", Truncated(service_d_data))
                     except Exception as e:
-                        logger.error(f"Failed to call Service D: {str(e)}")
+                        if deadline.expired():
+                            raise deadline.exceeded("call_service_d")
+                        logger.error("Failed to call Service D: %s", e)
                         service_d_data = {"error": str(e)}
 
                 with tracer.start_as_current_span("service_a.call_service_b"):
+                    deadline.check("call_service_b")
                     try:
-                        service_b_response = await client.post(
-                            f"{SERVICE_B_URL}/enqueue",
-                            json={"message": "Process request", "trace_id": trace_id},
-                            timeout=10.0
-                        )
-                        service_b_data = service_b_response.json()
-                        logger.info(f"Service B response: {service_b_data}")
+                        if SERVICE_B_BATCHING:
+                            # 消息带上当前 span 的 trace context, 等待它所在 batch 的结果
+                            service_b_data = await asyncio.wait_for(
+                                enqueue_batcher.submit(
+                                    {"message": "Process request", "trace_id": trace_id, "context": item_context()}
+                                ),
+                                deadline.timeout(service_b_batch_timeout.current())
+                            )
+                        else:
+                            with service_b_timeout.track(deadline) as timeout:
+                                service_b_response = await client.post(
+                                    f"{SERVICE_B_URL}/enqueue",
+                                    json={"message": "Process request", "trace_id": trace_id},
+                                    headers=deadline.headers(),
+                                    timeout=timeout
+                                )
+                            service_b_data = service_b_response.json()
+                        logger.info("Service B response: %s", Truncated(service_b_data))
                     except Exception as e:
-                        logger.error(f"Failed to call Service B: {str(e)}")
+                        if deadline.expired():
+                            raise deadline.exceeded("call_service_b")
+                        logger.error("Failed to call Service B: %s", e)
                         service_b_data = {"error": str(e)}
 
             with tracer.start_as_current_span("service_a.update_database"):
+                deadline.check("update_database")
                 conn = get_db_connection()
                 cur = conn.cursor()
                 duration_ms = int((time.time() - start_time) * 1000)
+                duration_sketch.add(duration_ms)
                 cur.execute(
                     "UPDATE request_logs SET status = %s, duration_ms = %s WHERE id = %s",
                     ("completed", duration_ms, log_id)
@@ -272,7 +385,7 @@ async def process():
                 conn.close()
 
             total_duration = time.time() - start_time
-            logger.info(f"Process request completed in {total_duration:.3f}s")
+            logger.info("Process request completed in %.3fs", total_duration)
 
             span.set_attribute("response.status", "success")
             span.set_attribute("request.duration_ms", duration_ms)
@@ -292,18 +405,65 @@ async def process():
                 }
             }
 
+        except DeadlineExceeded as e:
+            # 调用方已放弃该请求, 剩余步骤跳过
+            logger.warning("Request budget exhausted: %s", e)
+            span.set_attribute("error", True)
+            raise HTTPException(status_code=504, detail=str(e))
         except Exception as e:
-            logger.error(f"Error processing request: {str(e)}", exc_info=True)
+            logger.error("Error processing request: %s", e, exc_info=True)
             span.set_attribute("error", True)
             span.set_attribute("error.type", type(e).__name__)
             span.set_attribute("error.message", str(e))
             raise HTTPException(status_code=500, detail=str(e))
 
+def local_duration_sketch():
+    """本进程的 sketch 合并同主机其他 worker 最近保存的 sketch"""
+    merged = RollingQuantiles(duration_sketch.slot_seconds, duration_sketch.slots).merge(duration_sketch)
+    for sibling in sketch_store.siblings():
+        merged.merge(sibling)
+    return merged
+
+async def peer_duration_sketches():
+    """STATS_PEERS 中各副本的 sketch, 取不到的副本跳过"""
+    async with httpx.AsyncClient() as client:
+        responses = await asyncio.gather(
+            *(client.get(f"{peer}/stats/sketch", timeout=1.0) for peer in STATS_PEERS),
+            return_exceptions=True
+        )
+    sketches = []
+    for peer, response in zip(STATS_PEERS, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            response.raise_for_status()
+            sketches.append(RollingQuantiles.from_dict(response.json()["sketch"], duration_sketch.slots))
+        except Exception as e:
+            logger.warning("Failed to get duration sketch from %s: %s", peer, e)
+    return sketches
+
+@app.get("/stats/sketch")
+async def get_stats_sketch():
+    """本主机 (所有 worker) 的 duration sketch, 供其他副本合并"""
+    return {"service": "service-a", "sketch": local_duration_sketch().to_dict()}
+
 @app.get("/stats")
-async def get_stats():
-    """Get service statistics from the database"""
+async def get_stats(window: int = 3600):
+    """Get service statistics from the database, duration percentiles from the sketches"""
     logger.info("Getting statistics")
 
+    # percentile 由 sketch 计算, 不在 request_logs 上跑 percentile_cont
+    window = max(1, min(window, duration_sketch.slot_seconds * duration_sketch.slots))
+    sketch = local_duration_sketch()
+    peers = await peer_duration_sketches() if STATS_PEERS else []
+    for peer in peers:
+        sketch.merge(peer)
+    merged = sketch.window(window)
+    percentiles = {
+        f"p{q * 100:g}": None if value is None else round(value, 1)
+        for q, value in merged.quantiles(STATS_QUANTILES).items()
+    }
+
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -323,12 +483,33 @@ async def get_stats():
 
         return {
             "service": "service-a",
-            "stats": dict(stats) if stats else {}
+            "stats": dict(stats) if stats else {},
+            "duration_ms_percentiles": {
+                "window_seconds": window,
+                "count": merged.count,
+                "replicas": 1 + len(peers),
+                "relative_accuracy": merged.relative_accuracy,
+                **percentiles
+            }
         }
     except Exception as e:
-        logger.error(f"Failed to get stats: {str(e)}")
+        logger.error("Failed to get stats: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/debug/profile")
+async def debug_profile(endpoint: str = None, trace_id: str = None, span_id: str = None, format: str = "folded"):
+    """采样 profiler 的 folded stacks (µs), 可按 endpoint 或 trace_id / span_id 过滤"""
+    if not profiler.enabled:
+        raise HTTPException(status_code=404, detail="Profiler disabled, set PROFILER_HZ")
+    filters = {"endpoint": endpoint, "trace_id": trace_id, "span_id": span_id}
+    if format == "json":
+        return profiler.report(**filters)
+    return PlainTextResponse(profiler.folded(**filters))
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    if WORKERS > 1:
+        # worker 进程重新 import main, telemetry 在各自的 startup 中初始化
+        uvicorn.run("main:app", host="0.0.0.0", port=8001, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -8,11 +8,13 @@ Usage:
 3. Start command: opentelemetry-instrument python main.py
 """
 import os
+import asyncio
 import logging
 import time
 import random
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 import httpx
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -24,16 +26,26 @@ from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
 from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
 from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from o11y_common.adaptivetimeout import AdaptiveTimeouts
+from o11y_common.deadline import DeadlineExceeded, DeadlineMiddleware, current_deadline
+from o11y_common.health import HealthChecks, exporter_backlog_check, http_check, install_probe_log_filter
+from o11y_common.jsonlog import configure_logging
+from o11y_common.lazylog import Truncated, install_hot_path_filters
+from o11y_common.loopmonitor import LoopMonitor
+from o11y_common.quantilesketch import RollingQuantiles, SketchStore
+from o11y_common.spanbudget import SpanBudgetProcessor
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='{"time":"%(asctime)s", "level":"%(levelname)s", "service":"service-a-hybrid", "trace_id":"%(otelTraceID)s", "span_id":"%(otelSpanID)s", "message":"%(message)s"}',
-    handlers=[
-        logging.StreamHandler()  # export log to console
-    ]
-)
+configure_logging("service-a-hybrid")
 logger = logging.getLogger(__name__)
+# Hot-path logs: rate limited per callsite, unsampled traces keep WARNING and above only
+install_hot_path_filters(
+    logger,
+    rate=float(os.getenv("LOG_CALLSITE_RATE", "10")),
+    unsampled_level=os.getenv("LOG_UNSAMPLED_LEVEL", "WARNING"),
+)
+# No access log lines for the probes (/health, /health/live, /health/ready)
+install_probe_log_filter()
 
 
 SERVICE_B_URL = os.getenv("SERVICE_B_URL", "http://service-b:8002")
@@ -45,6 +57,8 @@ DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "o11ylab")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
+# Other replicas (comma separated base URLs) whose duration sketches /stats merges
+STATS_PEERS = [url.strip() for url in os.getenv("STATS_PEERS", "").split(",") if url.strip()]
 
 # ============================================================
 # Hybrid Mode Logger Configuration
@@ -73,6 +87,15 @@ handler = LoggingHandler(level=logging.NOTSET, logger_provider=logger_provider)
 logging.getLogger().addHandler(handler)
 
 
+# Event loop lag / blocking call monitor (LOOP_MONITOR_INTERVAL, LOOP_SLOW_CALLBACK_THRESHOLD)
+loop_monitor = LoopMonitor()
+
+# duration_ms of /process: one DDSketch per minute for an hour, saved periodically and restored on restart
+STATS_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+duration_sketch = RollingQuantiles(slot_seconds=60, slots=60)
+sketch_store = SketchStore("service-a-duration", duration_sketch)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -83,11 +106,17 @@ async def lifespan(app: FastAPI):
     logger.info("Auto instrumentation: FastAPI, httpx, psycopg2")
     logger.info("Custom instrumentation: Business spans, metrics, attributes")
     init_db()
+    loop_monitor.start()
+    sketch_store.start()
+    health_checks.start()
     logger.info("Service A startup complete")
 
     yield 
 
     # Shutdown 
+    health_checks.stop()
+    loop_monitor.stop()
+    sketch_store.stop()
     logger.info("Service A shutting down...")
 
 app = FastAPI(
@@ -95,10 +124,23 @@ app = FastAPI(
     version="2.0.0",
     lifespan=lifespan
 )
+# Request budget set by the gateway (x-request-budget-ms), shrunk per hop
+app.add_middleware(DeadlineMiddleware)
+
+# Drop / truncate / hash span attributes and cap attributes and events before export (SPAN_BUDGET=true).
+# opentelemetry-instrument already added its exporting processor, so this one is put in front of it.
+span_budget = SpanBudgetProcessor()
+span_budget.install_first(trace.get_tracer_provider())
 
 tracer = trace.get_tracer(__name__)
 meter = metrics.get_meter(__name__)
 
+# Downstream timeouts: multiple of the observed p99 between floor and ceiling
+timeouts = AdaptiveTimeouts(timeout_errors=(httpx.TimeoutException,))
+third_party_timeout = timeouts.downstream("third_party_api", floor=0.5, ceiling=5.0)
+service_d_timeout = timeouts.downstream("service_d", floor=1.0, ceiling=10.0)
+service_b_timeout = timeouts.downstream("service_b", floor=0.5, ceiling=10.0)
+
 
 process_counter = meter.create_counter(
     name="service_a_process_total",
@@ -133,9 +175,31 @@ def get_db_connection():
         )
         return conn
     except Exception as e:
-        logger.error(f"Failed to connect to database: {str(e)}")
+        logger.error("Failed to connect to database: %s", e)
         raise
 
+def check_database():
+    """Connects without running a query, so no psycopg2 span is created"""
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        connect_timeout=2
+    )
+    conn.close()
+
+# Dependencies are checked in the background every HEALTH_CHECK_INTERVAL seconds,
+# /health/ready answers from the last result. The database is critical (unready),
+# the downstream services and the export queues only make the service degraded.
+# The exporting processors are the ones opentelemetry-instrument set up.
+health_checks = HealthChecks("service-a-hybrid")
+health_checks.add("database", check_database)
+health_checks.add("service_d", http_check(f"{SERVICE_D_URL}/health/live"), critical=False)
+health_checks.add("service_b", http_check(f"{SERVICE_B_URL}/health"), critical=False)
+health_checks.add("exporter_backlog", exporter_backlog_check(), critical=False)
+
 def init_db():
     try:
         conn = get_db_connection()
@@ -158,13 +222,24 @@ def init_db():
         conn.close()
         logger.info("Database initialized successfully")
     except Exception as e:
-        logger.error(f"Failed to initialize database: {str(e)}")
+        logger.error("Failed to initialize database: %s", e)
 
 @app.get("/health")
 async def health():
-    """Health check endpoint"""
-    logger.info("Health check called")
-    return {"status": "healthy", "service": "service-a-hybrid", "instrumentation": "hybrid"}
+    """Liveness check endpoint (kept for existing probes), not logged or traced"""
+    return {**health_checks.live()[1], "instrumentation": "hybrid"}
+
+@app.get("/health/live")
+async def health_live():
+    """Liveness: the process serves requests"""
+    code, body = health_checks.live()
+    return JSONResponse(body, status_code=code)
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness: cached result of the background dependency checks"""
+    code, body = health_checks.ready()
+    return JSONResponse(body, status_code=code)
 
 @app.get("/process")
 async def process():
@@ -182,6 +257,7 @@ async def process():
     - Business metrics
     """
     start_time = time.time()
+    deadline = current_deadline()
     logger.info("Starting process request in Service A (Hybrid)")
 
     process_counter.add(1, {"endpoint": "/process", "instrumentation": "hybrid"})
@@ -199,6 +275,7 @@ async def process():
 
             with tracer.start_as_current_span("service_a.database_business_logic") as db_span:
                 db_span.set_attribute("db.operation", "insert_and_query")
+                deadline.check("database_query")
 
                 conn = get_db_connection()
                 cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -222,26 +299,30 @@ async def process():
 
             db_duration = time.time() - db_start
             db_query_duration.record(db_duration, {"operation": "insert_and_query", "instrumentation": "hybrid"})
-            logger.info(f"Database query completed in {db_duration:.3f}s, log_id={log_id}")
+            logger.info("Database query completed in %.3fs, log_id=%s", db_duration, log_id)
 
             # ============================================================
             # 2. Invoke third-party API
             # httpx will be auto-instrumented, we add business span and attributes
             # ============================================================
-            logger.info(f"Calling third-party API: {THIRD_PARTY_API}")
+            logger.info("Calling third-party API: %s", THIRD_PARTY_API)
             external_call_counter.add(1, {"target": "third_party_api", "instrumentation": "hybrid"})
 
             with tracer.start_as_current_span("service_a.external_api_business") as api_span:
                 api_span.set_attribute("external.api.url", THIRD_PARTY_API)
+                deadline.check("call_third_party_api")
 
                 async with httpx.AsyncClient() as client:
                     try:
-                        third_party_response = await client.get(THIRD_PARTY_API, timeout=5.0)
+                        with third_party_timeout.track(deadline) as timeout:
+                            third_party_response = await client.get(THIRD_PARTY_API, timeout=timeout)
                         third_party_data = third_party_response.text
                         api_span.set_attribute("external.api.status", "success")
-                        logger.info(f"Third-party API response: {third_party_data[:50]}...")
+                        logger.info("Third-party API response: %s", Truncated(third_party_data, 50))
                     except Exception as e:
-                        logger.warning(f"Third-party API call failed: {str(e)}")
+                        if deadline.expired():
+                            raise deadline.exceeded("call_third_party_api")
+                        logger.warning("Third-party API call failed: %s", e)
                         third_party_data = "unavailable"
                         api_span.set_attribute("external.api.status", "failed")
 
@@ -252,40 +333,52 @@ async def process():
             async with httpx.AsyncClient() as client:
                 with tracer.start_as_current_span("service_a.call_service_d_business") as d_span:
                     d_span.set_attribute("service.target", "service-d")
+                    deadline.check("call_service_d")
                     try:
-                        service_d_response = await client.get(
-                            f"{SERVICE_D_URL}/compute",
-                            params={"value": random.randint(1, 100)},
-                            timeout=10.0
-                        )
+                        with service_d_timeout.track(deadline) as timeout:
+                            service_d_response = await client.get(
+                                f"{SERVICE_D_URL}/compute",
+                                params={"value": random.randint(1, 100)},
+                                headers=deadline.headers(),
+                                timeout=timeout
+                            )
                         service_d_data = service_d_response.json()
                         d_span.set_attribute("service.d.status", "success")
-                        logger.info(f"Service D response: {service_d_data}")
+                        logger.info("Service D response: %s", Truncated(service_d_data))
                     except Exception as e:
-                        logger.error(f"Failed to call Service D: {str(e)}")
+                        if deadline.expired():
+                            raise deadline.exceeded("call_service_d")
+                        logger.error("Failed to call Service D: %s", e)
                         service_d_data = {"error": str(e)}
                         d_span.set_attribute("service.d.status", "failed")
 
                 with tracer.start_as_current_span("service_a.call_service_b_business") as b_span:
                     b_span.set_attribute("service.target", "service-b")
+                    deadline.check("call_service_b")
                     try:
-                        service_b_response = await client.post(
-                            f"{SERVICE_B_URL}/enqueue",
-                            json={"message": "Process request", "trace_id": trace_id},
-                            timeout=10.0
-                        )
+                        with service_b_timeout.track(deadline) as timeout:
+                            service_b_response = await client.post(
+                                f"{SERVICE_B_URL}/enqueue",
+                                json={"message": "Process request", "trace_id": trace_id},
+                                headers=deadline.headers(),
+                                timeout=timeout
+                            )
                         service_b_data = service_b_response.json()
                         b_span.set_attribute("service.b.status", "success")
-                        logger.info(f"Service B response: {service_b_data}")
+                        logger.info("Service B response: %s", Truncated(service_b_data))
                     except Exception as e:
-                        logger.error(f"Failed to call Service B: {str(e)}")
+                        if deadline.expired():
+                            raise deadline.exceeded("call_service_b")
+                        logger.error("Failed to call Service B: %s", e)
                         service_b_data = {"error": str(e)}
                         b_span.set_attribute("service.b.status", "failed")
 
             with tracer.start_as_current_span("service_a.update_status"):
+                deadline.check("update_database")
                 conn = get_db_connection()
                 cur = conn.cursor()
                 duration_ms = int((time.time() - start_time) * 1000)
+                duration_sketch.add(duration_ms)
                 cur.execute(
                     "UPDATE request_logs SET status = %s, duration_ms = %s WHERE id = %s",
                     ("completed", duration_ms, log_id)
@@ -295,7 +388,7 @@ async def process():
                 conn.close()
 
             total_duration = time.time() - start_time
-            logger.info(f"Process request completed in {total_duration:.3f}s")
+            logger.info("Process request completed in %.3fs", total_duration)
 
             span.set_attribute("response.status", "success")
             span.set_attribute("request.duration_ms", duration_ms)
@@ -316,18 +409,65 @@ async def process():
                 }
             }
 
+        except DeadlineExceeded as e:
+            # The caller gave up on this request, the remaining steps are skipped
+            logger.warning("Request budget exhausted: %s", e)
+            span.set_attribute("error", True)
+            raise HTTPException(status_code=504, detail=str(e))
         except Exception as e:
-            logger.error(f"Error processing request: {str(e)}", exc_info=True)
+            logger.error("Error processing request: %s", e, exc_info=True)
             span.set_attribute("error", True)
             span.set_attribute("error.type", type(e).__name__)
             span.set_attribute("error.message", str(e))
             raise HTTPException(status_code=500, detail=str(e))
 
+def local_duration_sketch():
+    """This process's sketch merged with the ones last saved by the other workers of the host"""
+    merged = RollingQuantiles(duration_sketch.slot_seconds, duration_sketch.slots).merge(duration_sketch)
+    for sibling in sketch_store.siblings():
+        merged.merge(sibling)
+    return merged
+
+async def peer_duration_sketches():
+    """Sketches of the STATS_PEERS replicas, skipping the ones that do not answer"""
+    async with httpx.AsyncClient() as client:
+        responses = await asyncio.gather(
+            *(client.get(f"{peer}/stats/sketch", timeout=1.0) for peer in STATS_PEERS),
+            return_exceptions=True
+        )
+    sketches = []
+    for peer, response in zip(STATS_PEERS, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            response.raise_for_status()
+            sketches.append(RollingQuantiles.from_dict(response.json()["sketch"], duration_sketch.slots))
+        except Exception as e:
+            logger.warning("Failed to get duration sketch from %s: %s", peer, e)
+    return sketches
+
+@app.get("/stats/sketch")
+async def get_stats_sketch():
+    """Duration sketch of this host (all workers), merged by the other replicas"""
+    return {"service": "service-a-hybrid", "sketch": local_duration_sketch().to_dict()}
+
 @app.get("/stats")
-async def get_stats():
-    """Get service statistics from the last hour"""
+async def get_stats(window: int = 3600):
+    """Get service statistics from the last hour, duration percentiles from the sketches"""
     logger.info("Getting statistics")
 
+    # Percentiles come from the sketches instead of percentile_cont over request_logs
+    window = max(1, min(window, duration_sketch.slot_seconds * duration_sketch.slots))
+    sketch = local_duration_sketch()
+    peers = await peer_duration_sketches() if STATS_PEERS else []
+    for peer in peers:
+        sketch.merge(peer)
+    merged = sketch.window(window)
+    percentiles = {
+        f"p{q * 100:g}": None if value is None else round(value, 1)
+        for q, value in merged.quantiles(STATS_QUANTILES).items()
+    }
+
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -348,10 +488,17 @@ async def get_stats():
 
         return {
             "service": "service-a-hybrid",
-            "stats": dict(stats) if stats else {}
+            "stats": dict(stats) if stats else {},
+            "duration_ms_percentiles": {
+                "window_seconds": window,
+                "count": merged.count,
+                "replicas": 1 + len(peers),
+                "relative_accuracy": merged.relative_accuracy,
+                **percentiles
+            }
         }
     except Exception as e:
-        logger.error(f"Failed to get stats: {str(e)}")
+        logger.error("Failed to get stats: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/info")
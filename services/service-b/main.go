@@ -3,6 +3,7 @@ package main
 import (
 	"context"
 	"encoding/json"
+	"errors"
 	"fmt"
 	"log"
 	"log/slog"
@@ -39,6 +40,7 @@ var (
 	kafkaWriter    *kafka.Writer
 	messageCounter metric.Int64Counter
 	kafkaDuration  metric.Float64Histogram
+	batchSize      metric.Int64Histogram
 )
 
 // StructuredLog
@@ -244,11 +246,20 @@ type EnqueueRequest struct {
 	TraceID string `json:"trace_id"`
 }
 
-// healthHandler
-func healthHandler(c *gin.Context) {
-	ctx := c.Request.Context()
-	logStructured(ctx, "INFO", "Health check called")
+// EnqueueBatchRequest messages coalesced by Service A's micro-batcher
+type EnqueueBatchRequest struct {
+	Messages []BatchMessage `json:"messages" binding:"required,min=1,dive"`
+}
+
+// BatchMessage one enqueue request with the trace context (traceparent / tracestate) of the span that sent it
+type BatchMessage struct {
+	Message string            `json:"message" binding:"required"`
+	TraceID string            `json:"trace_id"`
+	Context map[string]string `json:"context"`
+}
 
+// healthHandler 被探针与 Service A 的后台健康检查频繁调用, 不记录日志也不产生 span
+func healthHandler(c *gin.Context) {
 	c.JSON(http.StatusOK, gin.H{
 		"status":  "healthy",
 		"service": "service-b",
@@ -361,6 +372,147 @@ func enqueueHandler(c *gin.Context) {
 	})
 }
 
+// enqueueBatchHandler publishes a batch of messages with one Kafka write.
+// Every Kafka message carries the trace context of the request that sent it,
+// the batch spans link to all of them.
+func enqueueBatchHandler(c *gin.Context) {
+	ctx := c.Request.Context()
+
+	var req EnqueueBatchRequest
+	if err := c.ShouldBindJSON(&req); err != nil {
+		logStructured(ctx, "ERROR", fmt.Sprintf("Failed to parse batch request: %v", err))
+		c.JSON(http.StatusBadRequest, gin.H{"error": err.Error()})
+		return
+	}
+
+	propagator := otel.GetTextMapPropagator()
+	messageContexts := make([]context.Context, len(req.Messages))
+	links := make([]trace.Link, 0, len(req.Messages))
+	for i, m := range req.Messages {
+		messageContexts[i] = propagator.Extract(context.Background(), propagation.MapCarrier(m.Context))
+		if sc := trace.SpanContextFromContext(messageContexts[i]); sc.IsValid() {
+			links = append(links, trace.Link{SpanContext: sc})
+		}
+	}
+
+	ctx, span := tracer.Start(ctx, "service_b.enqueue_batch",
+		trace.WithSpanKind(trace.SpanKindServer),
+		trace.WithLinks(links...),
+	)
+	defer span.End()
+
+	count := len(req.Messages)
+	span.SetAttributes(attribute.Int("messaging.batch.message_count", count))
+	logStructured(ctx, "INFO", fmt.Sprintf("Received enqueue batch of %d messages", count))
+
+	messageCounter.Add(ctx, int64(count), metric.WithAttributes(
+		attribute.String("operation", "enqueue_batch"),
+	))
+	batchSize.Record(ctx, int64(count))
+
+	kafkaStart := time.Now()
+	_, kafkaSpan := tracer.Start(ctx, "service_b.kafka_publish_batch",
+		trace.WithSpanKind(trace.SpanKindProducer),
+		trace.WithLinks(links...),
+	)
+
+	kafkaMsgs := make([]kafka.Message, count)
+	totalSize := 0
+	for i, m := range req.Messages {
+		messageJSON, err := json.Marshal(map[string]interface{}{
+			"message":   m.Message,
+			"trace_id":  m.TraceID,
+			"timestamp": time.Now().Unix(),
+			"source":    "service-b",
+		})
+		if err != nil {
+			logStructured(ctx, "ERROR", fmt.Sprintf("Failed to marshal message: %v", err))
+			kafkaSpan.SetStatus(codes.Error, "Failed to marshal message")
+			kafkaSpan.RecordError(err)
+			kafkaSpan.End()
+			c.JSON(http.StatusInternalServerError, gin.H{"error": "Failed to marshal message"})
+			return
+		}
+		totalSize += len(messageJSON)
+
+		kafkaMsgs[i] = kafka.Message{
+			Key:   []byte(m.TraceID),
+			Value: messageJSON,
+			Headers: []kafka.Header{
+				{Key: "trace_id", Value: []byte(m.TraceID)},
+				{Key: "source", Value: []byte("service-b")},
+			},
+		}
+		// The consumer continues the trace of the request that sent the message
+		messageCtx := messageContexts[i]
+		if !trace.SpanContextFromContext(messageCtx).IsValid() {
+			messageCtx = ctx
+		}
+		propagator.Inject(messageCtx, &kafkaHeaderCarrier{headers: &kafkaMsgs[i].Headers})
+	}
+
+	err := kafkaWriter.WriteMessages(ctx, kafkaMsgs...)
+	kafkaDurationSeconds := time.Since(kafkaStart).Seconds()
+
+	// kafka.WriteErrors reports the messages that failed, by index
+	var writeErrors kafka.WriteErrors
+	if err != nil && !errors.As(err, &writeErrors) {
+		writeErrors = make(kafka.WriteErrors, count)
+		for i := range writeErrors {
+			writeErrors[i] = err
+		}
+	}
+
+	results := make([]gin.H, count)
+	failed := 0
+	for i, m := range req.Messages {
+		if writeErrors != nil && writeErrors[i] != nil {
+			failed++
+			results[i] = gin.H{"status": "error", "service": "service-b", "error": writeErrors[i].Error(), "trace_id": m.TraceID}
+			continue
+		}
+		results[i] = gin.H{"status": "success", "service": "service-b", "message": "Message enqueued to Kafka", "trace_id": m.TraceID}
+	}
+
+	kafkaSpan.SetAttributes(
+		attribute.String("kafka.topic", "o11y-lab-events"),
+		attribute.Int("messaging.batch.message_count", count),
+		attribute.Int("kafka.failed_messages", failed),
+		attribute.Int("kafka.message_size", totalSize),
+	)
+	if err != nil {
+		logStructured(ctx, "ERROR", fmt.Sprintf("Failed to write %d of %d messages to Kafka: %v", failed, count, err))
+		kafkaSpan.SetStatus(codes.Error, "Failed to write to Kafka")
+		kafkaSpan.RecordError(err)
+		span.SetStatus(codes.Error, "Failed to enqueue messages")
+	} else {
+		kafkaSpan.SetStatus(codes.Ok, "Batch published successfully")
+		span.SetStatus(codes.Ok, "Batch enqueued successfully")
+	}
+	kafkaSpan.End()
+
+	kafkaDuration.Record(ctx, kafkaDurationSeconds, metric.WithAttributes(
+		attribute.String("operation", "publish_batch"),
+		attribute.String("topic", "o11y-lab-events"),
+	))
+
+	logStructured(ctx, "INFO", fmt.Sprintf("Batch of %d messages published to Kafka, duration: %.3fs", count, kafkaDurationSeconds))
+
+	status, batchStatus := http.StatusOK, "success"
+	if failed == count {
+		status, batchStatus = http.StatusInternalServerError, "error"
+	} else if failed > 0 {
+		batchStatus = "partial"
+	}
+	c.JSON(status, gin.H{
+		"status":  batchStatus,
+		"service": "service-b",
+		"count":   count,
+		"failed":  failed,
+		"results": results,
+	})
+}
+
 // infoHandler
 func infoHandler(c *gin.Context) {
 	ctx := c.Request.Context()
@@ -463,6 +615,16 @@ func main() {
 		log.Fatalf("Failed to create kafka duration histogram: %v", err)
 	}
 
+	batchSize, err = meter.Int64Histogram(
+		"service_b_batch_size",
+		metric.WithDescription("Messages per enqueue batch"),
+		metric.WithUnit("1"),
+		metric.WithExplicitBucketBoundaries(1, 2, 4, 8, 16, 32, 64, 128, 256),
+	)
+	if err != nil {
+		log.Fatalf("Failed to create batch size histogram: %v", err)
+	}
+
 	initKafka()
 	defer kafkaWriter.Close()
 
@@ -470,7 +632,9 @@ func main() {
 
 	r.Use(gin.Recovery())
 
-	r.Use(otelgin.Middleware("service-b"))
+	r.Use(otelgin.Middleware("service-b", otelgin.WithFilter(func(req *http.Request) bool {
+		return req.URL.Path != "/health"
+	})))
 
 	r.Use(func(c *gin.Context) {
 		start := time.Now()
@@ -479,6 +643,10 @@ func main() {
 
 		c.Next()
 
+		if path == "/health" {
+			return
+		}
+
 		ctx := c.Request.Context()
 		spanCtx := trace.SpanContextFromContext(ctx)
 
@@ -496,6 +664,7 @@ func main() {
 
 	r.GET("/health", healthHandler)
 	r.POST("/enqueue", enqueueHandler)
+	r.POST("/enqueue/batch", enqueueBatchHandler)
 	r.GET("/info", infoHandler)
 
 	log.Println("Service B listening on :8002")
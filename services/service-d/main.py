@@ -8,75 +8,74 @@ import random
 import time
 from flask import Flask, request, jsonify
 from opentelemetry import trace, metrics
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.logging import LoggingInstrumentor
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
-from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME, SERVICE_VERSION
-from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
-from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+from o11y_common.bootstrap import TelemetryBootstrap, instrument_flask, sdk_disabled
+from o11y_common.deadline import DeadlineExceeded, current_deadline, install_flask_deadline
+from o11y_common.health import HealthChecks, exporter_backlog_check, install_probe_log_filter
+from o11y_common.jsonlog import configure_logging
+from o11y_common.lazylog import Truncated, install_hot_path_filters
+from o11y_common.profiler import SpanProfiler
+from o11y_common.spanbudget import SpanBudgetProcessor
+from o11y_common.spanusage import SpanUsage, span_usage_views
+from o11y_common.views import HistogramView, COMPUTE_BUCKETS
 
 # 配置结构化日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='{"time":"%(asctime)s", "level":"%(levelname)s", "service":"service-d", "trace_id":"%(otelTraceID)s", "span_id":"%(otelSpanID)s", "message":"%(message)s"}'
-)
+configure_logging("service-d")
 logger = logging.getLogger(__name__)
+# 热路径日志: 按调用点限流, 未采样的 trace 只保留 WARNING 及以上
+install_hot_path_filters(
+    logger,
+    rate=float(os.getenv("LOG_CALLSITE_RATE", "10")),
+    unsampled_level=os.getenv("LOG_UNSAMPLED_LEVEL", "WARNING"),
+)
 
 # 环境变量配置
 OTEL_COLLECTOR_ENDPOINT = os.getenv("OTEL_COLLECTOR_ENDPOINT", "http://otel-collector:4317")
 
-# 配置 OpenTelemetry Resource
-resource = Resource(attributes={
-    SERVICE_NAME: "service-d",
-    SERVICE_VERSION: "1.0.0",
-    "service.namespace": "o11y-lab",
-    "deployment.environment": "lab",
-    "service.framework": "flask"
-})
-
-# 配置 Tracer Provider
-trace_provider = TracerProvider(resource=resource)
-trace_provider.add_span_processor(
-    BatchSpanProcessor(OTLPSpanExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True))
-)
-trace.set_tracer_provider(trace_provider)
-
-# 配置 Meter Provider
-metric_reader = PeriodicExportingMetricReader(
-    OTLPMetricExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True)
-)
-meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
-metrics.set_meter_provider(meter_provider)
-
-# 配置 Logger Provider for OTLP log export
-logger_provider = LoggerProvider(resource=resource)
-logger_provider.add_log_record_processor(
-    BatchLogRecordProcessor(OTLPLogExporter(endpoint=OTEL_COLLECTOR_ENDPOINT, insecure=True))
-)
-
-# 添加 OTLP logging handler
-handler = LoggingHandler(level=logging.NOTSET, logger_provider=logger_provider)
-logging.getLogger().addHandler(handler)
-
-# 自动埋点日志（添加 trace context）
-LoggingInstrumentor().instrument(set_logging_format=True)
-
 # 创建 Flask app
 app = Flask(__name__)
+# 调用方传来的请求预算 (x-request-budget-ms), 每个计算阶段前检查
+install_flask_deadline(app)
+
+# 自动埋点 Flask (Flask 不允许在第一个请求之后注册 hook, 因此总是在启动前执行)
+if not sdk_disabled():
+    instrument_flask(app)
+
+# 采样 profiler (PROFILER_HZ > 0 时启用), 样本按 span / trace 归类
+profiler = SpanProfiler("service-d")
+# 导出前按规则删除 / 截断 / hash span 属性, 限制属性与事件数 (SPAN_BUDGET=true 时启用)
+span_budget = SpanBudgetProcessor()
+
+# Tracer / Meter / Logger Provider
+telemetry = TelemetryBootstrap(
+    resource_attributes={
+        "service.name": "service-d",
+        "service.version": "1.0.0",
+        "service.namespace": "o11y-lab",
+        "deployment.environment": "lab",
+        "service.framework": "flask"
+    },
+    endpoint=OTEL_COLLECTOR_ENDPOINT,
+    span_processors=profiler.span_processors() + span_budget.span_processors(),
+    views=[
+        HistogramView("service_d_compute_duration_seconds", COMPUTE_BUCKETS, attribute_keys={"operation"}),
+        *span_usage_views(),
+    ],
+)
+# OTEL_LAZY_INIT=true: SDK / exporter 在服务启动后于后台初始化
+telemetry.init_at_import()
 
-# 自动埋点 Flask
-FlaskInstrumentor().instrument_app(app)
+# 探针请求不写 werkzeug access log; Service D 没有外部依赖, 只检查 exporter 队列
+install_probe_log_filter()
+health_checks = HealthChecks("service-d")
+health_checks.add("exporter_backlog", exporter_backlog_check(telemetry), critical=False)
 
 # 获取 tracer 和 meter
 tracer = trace.get_tracer(__name__)
 meter = metrics.get_meter(__name__)
 
+# 计算 span 的 CPU 时间 / GIL 等待 / 内存分配 (SPAN_USAGE=true 时启用)
+span_usage = SpanUsage()
+
 # 自定义 metrics
 compute_counter = meter.create_counter(
     name="service_d_compute_total",
@@ -117,9 +116,20 @@ def prime_factors(n):
 
 @app.route('/health', methods=['GET'])
 def health():
-    """健康检查"""
-    logger.info("Health check called")
-    return jsonify({"status": "healthy", "service": "service-d"})
+    """健康检查 (保留给现有探针), 不记录日志也不产生 span"""
+    return jsonify(health_checks.live()[1])
+
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    """Liveness: 进程能处理请求即可"""
+    code, body = health_checks.live()
+    return jsonify(body), code
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness: 后台依赖检查的缓存结果"""
+    code, body = health_checks.ready()
+    return jsonify(body), code
 
 @app.route('/compute', methods=['GET'])
 def compute():
@@ -129,8 +139,9 @@ def compute():
     """
     start_time = time.time()
     value = request.args.get('value', default=10, type=int)
+    deadline = current_deadline()
 
-    logger.info(f"Starting computation with value={value}")
+    logger.info("Starting computation with value=%s", value)
 
     # 增加计数器
     compute_counter.add(1, {"operation": "compute"})
@@ -142,31 +153,36 @@ def compute():
 
         try:
             # 1. 斐波那契计算
-            with tracer.start_as_current_span("service_d.fibonacci") as fib_span:
+            with tracer.start_as_current_span("service_d.fibonacci") as fib_span, span_usage.measure(fib_span):
+                deadline.check("fibonacci")
                 fib_input = min(value, 20)  # 限制最大值避免太慢
-                logger.info(f"Computing fibonacci({fib_input})")
+                logger.info("Computing fibonacci(%s)", fib_input)
                 fib_result = fibonacci(fib_input)
                 fib_span.set_attribute("fibonacci.input", fib_input)
                 fib_span.set_attribute("fibonacci.result", fib_result)
-                logger.info(f"Fibonacci result: {fib_result}")
+                logger.info("Fibonacci result: %s", fib_result)
 
             # 2. 质因数分解
-            with tracer.start_as_current_span("service_d.prime_factors") as prime_span:
+            with tracer.start_as_current_span("service_d.prime_factors") as prime_span, span_usage.measure(prime_span):
+                deadline.check("prime_factors")
                 prime_input = max(value, 2)
-                logger.info(f"Computing prime factors of {prime_input}")
+                logger.info("Computing prime factors of %s", prime_input)
                 factors = prime_factors(prime_input)
                 prime_span.set_attribute("prime.input", prime_input)
                 prime_span.set_attribute("prime.factors_count", len(factors))
-                logger.info(f"Prime factors: {factors}")
+                logger.info("Prime factors: %s", Truncated(factors))
 
             # 3. 随机延迟模拟
             with tracer.start_as_current_span("service_d.simulate_processing"):
+                deadline.check("simulate_processing")
                 delay = random.uniform(0.1, 0.5)
-                logger.info(f"Simulating processing delay: {delay:.3f}s")
-                time.sleep(delay)
+                logger.info("Simulating processing delay: %.3fs", delay)
+                # 预算在等待中用完时提前结束, 由下一阶段的检查取消请求
+                time.sleep(max(0.0, min(delay, deadline.remaining())))
 
             # 4. 统计计算
-            with tracer.start_as_current_span("service_d.statistics"):
+            with tracer.start_as_current_span("service_d.statistics") as stats_span, span_usage.measure(stats_span):
+                deadline.check("statistics")
                 numbers = [random.randint(1, 100) for _ in range(10)]
                 stats = {
                     "mean": sum(numbers) / len(numbers),
@@ -174,7 +190,7 @@ def compute():
                     "min": min(numbers),
                     "sum": sum(numbers)
                 }
-                logger.info(f"Statistics computed: {stats}")
+                logger.info("Statistics computed: %s", stats)
 
             duration = time.time() - start_time
             compute_duration.record(duration, {"operation": "compute"})
@@ -201,12 +217,21 @@ def compute():
 
             span.set_attribute("response.status", "success")
             span.set_attribute("compute.duration_seconds", duration)
-            logger.info(f"Computation completed in {duration:.3f}s")
+            logger.info("Computation completed in %.3fs", duration)
 
             return jsonify(result)
 
+        except DeadlineExceeded as e:
+            logger.warning("Request budget exhausted: %s", e)
+            span.set_attribute("error", True)
+            return jsonify({
+                "status": "deadline_exceeded",
+                "service": "service-d",
+                "error": str(e)
+            }), 504
+
         except Exception as e:
-            logger.error(f"Error during computation: {str(e)}", exc_info=True)
+            logger.error("Error during computation: %s", e, exc_info=True)
             span.set_attribute("error", True)
             span.set_attribute("error.type", type(e).__name__)
             span.set_attribute("error.message", str(e))
@@ -232,6 +257,20 @@ def info():
         ]
     })
 
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """采样 profiler 的 folded stacks (µs), 可按 endpoint 或 trace_id / span_id 过滤"""
+    if not profiler.enabled:
+        return jsonify({"error": "Profiler disabled, set PROFILER_HZ"}), 404
+    filters = {name: request.args.get(name) for name in ("endpoint", "trace_id", "span_id")}
+    if request.args.get("format") == "json":
+        return jsonify(profiler.report(**filters))
+    return profiler.folded(**filters), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
 if __name__ == '__main__':
     logger.info("Starting Service D")
+    telemetry.init_at_startup()
+    if not sdk_disabled():
+        profiler.start()
+    health_checks.start()
     app.run(host='0.0.0.0', port=8004, debug=False)
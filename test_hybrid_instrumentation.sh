@@ -20,11 +20,11 @@ echo "3. Send test requests"
 echo "4. View results"
 echo ""
 
-cd services/service-a
+cd services
 
 # 1. Build image
 echo -e "${YELLOW}Step 1: Building image...${NC}"
-docker build -f Dockerfile.hybrid -t service-a-hybrid:test . 2>&1 | tail -5
+docker build -f service-a/Dockerfile.hybrid -t service-a-hybrid:test . 2>&1 | tail -5
 
 if [ $? -eq 0 ]; then
     echo -e "${GREEN}✅ Image built successfully${NC}"